@@ -0,0 +1,119 @@
+"""Dependency xác thực dùng chung cho mọi router.
+
+Token hợp lệ → UserPublic được cache trong process (TTL ngắn, không vượt quá
+``exp`` của JWT) để không phải query users ở mỗi request. Admin sửa/xóa user
+→ gọi ``invalidate_user`` để bỏ cache của user đó.
+Cache là per-process: với nhiều worker, dữ liệu cũ tồn tại tối đa TTL giây.
+"""
+
+from __future__ import annotations
+
+import time
+from typing import Dict, Optional, Set, Tuple
+
+from fastapi import Depends, HTTPException, status
+from fastapi.security import OAuth2PasswordBearer
+
+from .config import settings
+from .database import get_database
+from .security import decode_token
+from ..models.user import UserPublic, get_user_by_id
+
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
+
+
+class AuthCache:
+    """token → (hết hạn lúc, UserPublic), kèm index user_id → tokens để invalidate."""
+
+    def __init__(self, ttl_seconds: float, max_entries: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: Dict[str, Tuple[float, UserPublic]] = {}
+        self._tokens_by_user: Dict[str, Set[str]] = {}
+
+    def get(self, token: str) -> Optional[UserPublic]:
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at <= time.monotonic():
+            self._discard(token, user.id)
+            return None
+        return user
+
+    def set(self, token: str, user: UserPublic, token_exp: Optional[float] = None) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        ttl = self.ttl_seconds
+        if token_exp is not None:
+            # Không cache quá thời điểm JWT hết hạn
+            ttl = min(ttl, token_exp - time.time())
+            if ttl <= 0:
+                return
+        if len(self._entries) >= self.max_entries:
+            self._evict()
+        self._entries[token] = (time.monotonic() + ttl, user)
+        self._tokens_by_user.setdefault(user.id, set()).add(token)
+
+    def invalidate_user(self, user_id: str) -> None:
+        for token in self._tokens_by_user.pop(user_id, set()):
+            self._entries.pop(token, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._tokens_by_user.clear()
+
+    def _discard(self, token: str, user_id: str) -> None:
+        self._entries.pop(token, None)
+        tokens = self._tokens_by_user.get(user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                self._tokens_by_user.pop(user_id, None)
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        expired = [(t, u.id) for t, (exp, u) in self._entries.items() if exp <= now]
+        for token, user_id in expired:
+            self._discard(token, user_id)
+        # Vẫn đầy → bỏ entry cũ nhất (dict giữ thứ tự insert)
+        while len(self._entries) >= self.max_entries:
+            token, (_, user) = next(iter(self._entries.items()))
+            self._discard(token, user.id)
+
+
+auth_cache = AuthCache(ttl_seconds=settings.auth_cache_ttl_seconds)
+
+
+def invalidate_user(user_id: str) -> None:
+    auth_cache.invalidate_user(user_id)
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserPublic:
+    cached = auth_cache.get(token)
+    if cached is not None:
+        return cached
+    payload = decode_token(token)
+    if not payload or "sub" not in payload:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    db = get_database()
+    try:
+        user = await get_user_by_id(db, payload["sub"])
+    except Exception as exc:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Database is unavailable. Please try again later.",
+        ) from exc
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
+    current = UserPublic(id=user.id, email=user.email, full_name=user.full_name, is_admin=user.is_admin)
+    exp = payload.get("exp")
+    auth_cache.set(token, current, token_exp=float(exp) if isinstance(exp, (int, float)) else None)
+    return current
+
+
+async def get_current_admin(current_user: UserPublic = Depends(get_current_user)) -> UserPublic:
+    if not current_user.is_admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin privileges required")
+    return current_user
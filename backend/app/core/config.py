@@ -4,6 +4,9 @@ from pydantic import BaseModel, Field
 
 class Settings(BaseModel):
     environment: str = os.getenv("ENV", "development")
+    log_level: str = os.getenv("LOG_LEVEL", "INFO")
+    # Log theo từng candidate/chunk (DEBUG) chỉ ghi 1/N dòng
+    log_sample_rate: int = int(os.getenv("LOG_SAMPLE_RATE", "20"))
     api_port: int = int(os.getenv("API_PORT", "8000"))
 
     mongodb_uri: str = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
@@ -14,6 +17,13 @@ class Settings(BaseModel):
 
     faiss_index_dir: str = os.getenv("FAISS_INDEX_DIR", "./data/faiss")
     upload_dir: str = os.getenv("UPLOAD_DIR", "./data/uploads")
+    # Dung lượng tối đa 1 file upload (MB) → 413
+    max_upload_size_mb: int = int(os.getenv("MAX_UPLOAD_SIZE_MB", "200"))
+    # Upload nhiều file: số file tối đa mỗi request, số file parse song song
+    upload_batch_max_files: int = int(os.getenv("UPLOAD_BATCH_MAX_FILES", "50"))
+    upload_parse_workers: int = int(os.getenv("UPLOAD_PARSE_WORKERS", "4"))
+    # Tổng dung lượng tối đa của 1 request upload nhiều file (MB) → 413
+    max_batch_upload_size_mb: int = int(os.getenv("MAX_BATCH_UPLOAD_SIZE_MB", "500"))
 
     embedding_provider: str = os.getenv("EMBEDDING_PROVIDER", "local")  # Default to local (sentence-transformers)
     embedding_model: str = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")  # Only used if provider=openai
@@ -31,7 +41,44 @@ class Settings(BaseModel):
     rag_low_similarity_threshold: float = float(os.getenv("RAG_LOW_SIMILARITY_THRESHOLD", "0.4"))
     rag_low_confidence_threshold: float = float(os.getenv("RAG_LOW_CONFIDENCE_THRESHOLD", "0.3"))
     rag_max_context_length_tokens: int = int(os.getenv("RAG_MAX_CONTEXT_LENGTH_TOKENS", "8000"))
+    # DOCUMENT_OVERVIEW cần phủ mọi phần của tài liệu → ngân sách context lớn hơn
+    rag_overview_context_tokens: int = int(os.getenv("RAG_OVERVIEW_CONTEXT_TOKENS", "12000"))
     rag_max_references: int = int(os.getenv("RAG_MAX_REFERENCES", "5"))
+    # Ghi history nền (không chờ MongoDB trước khi trả lời) + kích thước queue tối đa
+    history_async_writes: bool = os.getenv("HISTORY_ASYNC_WRITES", "false").lower() == "true"
+    history_write_queue_size: int = int(os.getenv("HISTORY_WRITE_QUEUE_SIZE", "1000"))
+    # Chu kỳ tính lại bộ đếm /admin/stats từ dữ liệu thật (sửa sai lệch), 0 = tắt
+    stats_reconcile_interval_seconds: int = int(os.getenv("STATS_RECONCILE_INTERVAL_SECONDS", "3600"))
+    # Số ngày gần nhất của stats_daily được bù 1 lần từ histories/documents (lần reconcile đầu), 0 = tắt
+    stats_daily_backfill_days: int = int(os.getenv("STATS_DAILY_BACKFILL_DAYS", "30"))
+    # Hybrid retrieval: số candidate lấy từ mỗi nguồn (FAISS, BM25) trước khi gộp RRF
+    rag_hybrid_search_k: int = int(os.getenv("RAG_HYBRID_SEARCH_K", "40"))
+    rag_rrf_k: int = int(os.getenv("RAG_RRF_K", "60"))
+    # Số thread tối đa cho FAISS/BM25 search (dùng chung cho mọi request)
+    rag_search_workers: int = int(os.getenv("RAG_SEARCH_WORKERS", "4"))
+    # Luôn trả thời gian từng stage của pipeline trong metadata (mặc định chỉ khi request debug=True)
+    rag_debug_metrics: bool = os.getenv("RAG_DEBUG_METRICS", "false").lower() == "true"
+    # Xóa tài liệu: lô xóa mỗi lần, chu kỳ sweeper dọn dữ liệu mồ côi (0 = tắt),
+    # thời gian chờ trước khi coi tombstone / file index là bị bỏ rơi
+    document_delete_batch_size: int = int(os.getenv("DOCUMENT_DELETE_BATCH_SIZE", "500"))
+    document_sweep_interval_seconds: int = int(os.getenv("DOCUMENT_SWEEP_INTERVAL_SECONDS", "3600"))
+    document_sweep_grace_seconds: int = int(os.getenv("DOCUMENT_SWEEP_GRACE_SECONDS", "600"))
+    # Quiz: mỗi lời gọi LLM sinh tối đa N câu từ 1 phần tài liệu, các phần chạy song song
+    quiz_questions_per_shard: int = int(os.getenv("QUIZ_QUESTIONS_PER_SHARD", "4"))
+    quiz_max_shards: int = int(os.getenv("QUIZ_MAX_SHARDS", "5"))
+    quiz_max_concurrent_calls: int = int(os.getenv("QUIZ_MAX_CONCURRENT_CALLS", "5"))
+    # Cosine >= ngưỡng → 2 câu hỏi coi là trùng; số vòng xin câu thay thế cho slot bị loại
+    quiz_dedup_threshold: float = float(os.getenv("QUIZ_DEDUP_THRESHOLD", "0.9"))
+    quiz_replacement_rounds: int = int(os.getenv("QUIZ_REPLACEMENT_ROUNDS", "1"))
+    # Yêu cầu LLM trả JSON (Gemini responseMimeType / OpenAI response_format) thay cho [MC]/[TF]
+    quiz_json_mode: bool = os.getenv("QUIZ_JSON_MODE", "false").lower() == "true"
+    # Ngân hàng câu hỏi sinh sẵn: số câu chưa dùng cần giữ / ngưỡng sinh bổ sung / độ khó sinh ngay sau upload
+    quiz_bank_enabled: bool = os.getenv("QUIZ_BANK_ENABLED", "true").lower() == "true"
+    quiz_bank_target_size: int = int(os.getenv("QUIZ_BANK_TARGET_SIZE", "30"))
+    quiz_bank_low_watermark: int = int(os.getenv("QUIZ_BANK_LOW_WATERMARK", "10"))
+    quiz_bank_prefill_difficulties: list[str] = [
+        d.strip() for d in os.getenv("QUIZ_BANK_PREFILL_DIFFICULTIES", "medium").split(",") if d.strip()
+    ]
     admin_emails: set[str] = Field(
         default_factory=lambda: {
             email.strip().lower()
@@ -49,6 +96,12 @@ class Settings(BaseModel):
     google_client_secret: str | None = os.getenv("GOOGLE_CLIENT_SECRET")
     google_redirect_uri: str | None = os.getenv("GOOGLE_REDIRECT_URI")
     calendar_token_secret: str | None = os.getenv("CALENDAR_TOKEN_SECRET")
+    # Ghi đè rootUrl của Calendar API (vd. stub local khi test), để trống = Google
+    google_calendar_api_root: str | None = os.getenv("GOOGLE_CALENDAR_API_ROOT")
+    calendar_api_workers: int = int(os.getenv("CALENDAR_API_WORKERS", "4"))
+    calendar_api_timeout: int = int(os.getenv("CALENDAR_API_TIMEOUT", "30"))
+    # Bản local calendar_events cũ hơn ngưỡng này (giây) → sync với Google trước khi đọc
+    calendar_sync_max_age_seconds: int = int(os.getenv("CALENDAR_SYNC_MAX_AGE_SECONDS", "300"))
     calendar_success_redirect: str = os.getenv(
         "CALENDAR_SUCCESS_REDIRECT", "http://localhost:5173/settings?calendar=connected"
     )
@@ -60,6 +113,11 @@ class Settings(BaseModel):
     jwt_secret_key: str = os.getenv("JWT_SECRET_KEY", "dev-secret-change-me")
     jwt_algorithm: str = os.getenv("JWT_ALGORITHM", "HS256")
     access_token_expire_minutes: int = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
+    # Cache token → user trong process (giây), 0 = tắt
+    auth_cache_ttl_seconds: int = int(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+    # Thread pool cho hash/verify mật khẩu: số thread + số request tối đa xếp hàng vào pool
+    password_hash_workers: int = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+    password_hash_max_pending: int = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "32"))
 
     # CORS
     cors_allow_origins: list[str] = Field(
@@ -48,6 +48,15 @@ def get_faiss_index_path(namespace: str = "default") -> str:
     return os.path.join(settings.faiss_index_dir, f"{sanitized}.faiss")
 
 
+def get_bm25_index_path(namespace: str = "default") -> str:
+    """BM25 index nằm cạnh file .faiss cùng namespace."""
+    import os
+
+    ensure_faiss_index_dir()
+    sanitized = namespace.replace("/", "_")
+    return os.path.join(settings.faiss_index_dir, f"{sanitized}.bm25.json")
+
+
 def create_or_load_faiss_index(dimension: int, namespace: str = "default"):
     """Create or load a FAISS index file for the given namespace."""
     import os
@@ -0,0 +1,74 @@
+"""Logging có level cho backend (thay cho print trong hot path).
+
+- ``get_logger("rag")`` → logger "studyqna.rag", level lấy từ LOG_LEVEL.
+- Dùng %-style (``logger.debug("chunk %s", idx)``): khi level bị tắt thì không
+  format chuỗi.
+- Handler dạng queue: thread gọi log chỉ đẩy record vào queue; format + ghi
+  stdout chạy ở listener thread (không chặn event loop).
+- ``debug_sampled`` cho các dòng log theo từng candidate: chỉ ghi 1/N lần.
+"""
+
+from __future__ import annotations
+
+import atexit
+import logging
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+from .config import settings
+
+
+_ROOT_NAME = "studyqna"
+_listener: Optional[QueueListener] = None
+_setup_lock = threading.Lock()
+_sample_counts: Dict[str, int] = {}
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """Không format message ở thread gọi log - để listener thread làm.
+
+    QueueHandler mặc định format ngay trong prepare() (để record pickle được);
+    queue ở đây nằm trong cùng process nên giữ nguyên record.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging() -> None:
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        root = logging.getLogger(_ROOT_NAME)
+        root.setLevel(getattr(logging, settings.log_level.upper(), logging.INFO))
+        root.propagate = False
+
+        # sys.stdout lúc này đã được main.py bọc (Windows) → thay emoji ở listener thread
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)-7s [%(name)s] %(message)s")
+        )
+        log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        root.addHandler(_DeferredQueueHandler(log_queue))
+        _listener = QueueListener(log_queue, stream_handler)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def get_logger(name: str) -> logging.Logger:
+    setup_logging()
+    return logging.getLogger(f"{_ROOT_NAME}.{name}")
+
+
+def debug_sampled(logger: logging.Logger, key: str, msg: str, *args) -> None:
+    """logger.debug nhưng chỉ ghi 1 trong LOG_SAMPLE_RATE lần cho mỗi ``key``."""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    count = _sample_counts.get(key, 0)
+    _sample_counts[key] = count + 1
+    if count % max(settings.log_sample_rate, 1) == 0:
+        logger.debug(msg, *args)
@@ -1,5 +1,10 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Any, Optional
+from typing import Any, Callable, Deque, Dict, Optional
 
 from jose import JWTError, jwt
 from passlib.context import CryptContext
@@ -23,6 +28,92 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return password_context.verify(plain_password, hashed_password)
 
 
+class PasswordHashPool:
+    """Chạy hash/verify mật khẩu (pbkdf2, tốn CPU) trên thread pool riêng.
+
+    Số thread giới hạn số phép hash chạy đồng thời; semaphore giới hạn số
+    request được xếp hàng vào pool (phần còn lại chờ trên event loop, không
+    chiếm thread). Ghi lại thời gian chờ trong queue và thời gian hash.
+    """
+
+    def __init__(self, workers: int, max_pending: int, sample_size: int = 500):
+        self.workers = max(workers, 1)
+        self.max_pending = max(max_pending, self.workers)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+        self._queue_samples: Deque[float] = deque(maxlen=sample_size)
+        self._run_samples: Deque[float] = deque(maxlen=sample_size)
+        self.calls = 0
+        self.in_flight = 0
+
+    def _ensure_pool(self) -> None:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="password-hash"
+            )
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        self._ensure_pool()
+        submitted = time.perf_counter()
+
+        def timed_call():
+            started = time.perf_counter()
+            return func(*args), started, time.perf_counter()
+
+        async with self._slots:
+            self.in_flight += 1
+            try:
+                loop = asyncio.get_running_loop()
+                result, started, finished = await loop.run_in_executor(self._executor, timed_call)
+            finally:
+                self.in_flight -= 1
+        with self._lock:
+            self.calls += 1
+            self._queue_samples.append((started - submitted) * 1000)
+            self._run_samples.append((finished - started) * 1000)
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        def summarize(samples) -> Dict[str, float]:
+            if not samples:
+                return {"avg_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0}
+            ordered = sorted(samples)
+            return {
+                "avg_ms": round(sum(ordered) / len(ordered), 2),
+                "p95_ms": round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)], 2),
+                "max_ms": round(ordered[-1], 2),
+            }
+
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "calls": self.calls,
+                "in_flight": self.in_flight,
+                "queue_wait": summarize(self._queue_samples),
+                "hash_time": summarize(self._run_samples),
+            }
+
+
+password_hash_pool = PasswordHashPool(
+    workers=settings.password_hash_workers,
+    max_pending=settings.password_hash_max_pending,
+)
+
+
+async def hash_password_async(plain_password: str) -> str:
+    """hash_password không chặn event loop (dùng trong route async)."""
+    return await password_hash_pool.run(hash_password, plain_password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """verify_password không chặn event loop (dùng trong route async)."""
+    return await password_hash_pool.run(verify_password, plain_password, hashed_password)
+
+
 def create_access_token(subject: str, expires_delta: Optional[timedelta] = None) -> str:
     expire = datetime.now(tz=timezone.utc) + (
         expires_delta or timedelta(minutes=settings.access_token_expire_minutes)
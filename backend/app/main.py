@@ -172,6 +172,25 @@ def safe_print(*args, **kwargs):
 def create_app() -> FastAPI:
     app = FastAPI(title="AI Study QnA", version="0.1.0")
 
+    # Khai báo trước CORS để CORSMiddleware bọc ngoài (response 413 vẫn có CORS header)
+    @app.middleware("http")
+    async def reject_oversized_uploads(request: Request, call_next):
+        # Chặn theo Content-Length trước khi parse multipart (không ghi request quá lớn ra đĩa tạm)
+        if request.url.path.startswith("/documents/upload"):
+            from .services.uploads import max_batch_upload_bytes, max_upload_bytes
+
+            if request.url.path.startswith("/documents/upload/batch"):
+                limit, limit_mb = max_batch_upload_bytes(), settings.max_batch_upload_size_mb
+            else:
+                limit, limit_mb = max_upload_bytes(), settings.max_upload_size_mb
+            length = request.headers.get("content-length")
+            if length and length.isdigit() and int(length) > limit + 1024 * 1024:
+                return JSONResponse(
+                    status_code=413,
+                    content={"detail": f"File vượt quá dung lượng cho phép ({limit_mb} MB)"},
+                )
+        return await call_next(request)
+
     # CORS configuration - must be before other middleware
     app.add_middleware(
         CORSMiddleware,
@@ -184,6 +203,61 @@ def create_app() -> FastAPI:
         max_age=3600,
     )
 
+    @app.on_event("startup")
+    async def create_indexes():
+        # create_index idempotent; Mongo chưa sẵn sàng thì chỉ bỏ qua (query vẫn chạy, chậm hơn)
+        from .core.database import get_database
+        from .models.document import ensure_document_indexes
+        from .models.history import ensure_history_indexes
+        from .models.question_bank import ensure_question_bank_indexes
+        from .models.quiz_analytics import ensure_quiz_analytics_indexes
+
+        try:
+            await ensure_document_indexes(get_database())
+            await ensure_history_indexes(get_database())
+            await ensure_question_bank_indexes(get_database())
+            await ensure_quiz_analytics_indexes(get_database())
+        except Exception as exc:
+            print(f"⚠️ Could not create MongoDB indexes: {exc}")
+
+    @app.on_event("startup")
+    async def start_stats_reconciler():
+        import asyncio
+        from .core.database import get_database
+        from .services.admin import run_stats_reconciler
+
+        if settings.stats_reconcile_interval_seconds > 0:
+            app.state.stats_reconciler = asyncio.create_task(
+                run_stats_reconciler(get_database(), settings.stats_reconcile_interval_seconds)
+            )
+
+    @app.on_event("startup")
+    async def start_document_sweeper():
+        import asyncio
+        from .core.database import get_database
+        from .services.document_cleanup import run_document_sweeper
+
+        if settings.document_sweep_interval_seconds > 0:
+            app.state.document_sweeper = asyncio.create_task(
+                run_document_sweeper(get_database(), settings.document_sweep_interval_seconds)
+            )
+
+    @app.on_event("shutdown")
+    async def flush_background_writes():
+        # Ghi nốt các history đang chờ trong queue trước khi tắt server
+        from .models.history import history_writer
+        from .services.document_cleanup import document_cleanup_service
+        from .services.question_bank import question_bank_service
+
+        # Dừng các task định kỳ trước để sweeper không bắt đầu purge mới trong lúc drain
+        for name in ("stats_reconciler", "document_sweeper"):
+            task = getattr(app.state, name, None)
+            if task is not None:
+                task.cancel()
+        await history_writer.drain()
+        await question_bank_service.drain()
+        await document_cleanup_service.drain()
+
     @app.get("/health")
     async def health():
         return {"status": "ok"}
@@ -6,6 +6,11 @@ from typing import Any, Optional
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from pydantic import BaseModel, Field
+from pymongo import DeleteOne, UpdateOne
+
+
+EVENT_SOURCE_APP = "app"
+EVENT_SOURCE_GOOGLE = "google"
 
 
 class CalendarEventInDB(BaseModel):
@@ -20,8 +25,13 @@ class CalendarEventInDB(BaseModel):
     event_type: Optional[str] = None
     question_id: Optional[str] = None
     document_ids: list[str] = Field(default_factory=list)
+    html_link: Optional[str] = None
+    all_day: bool = False
     created_at: datetime
     updated_at: datetime
+    synced_at: Optional[datetime] = None
+    # "app": tạo từ app (lịch ôn tập...); "google": chỉ nhập về từ lịch Google khi sync
+    source: str = EVENT_SOURCE_APP
 
 
 async def upsert_calendar_event(
@@ -53,6 +63,7 @@ async def upsert_calendar_event(
                 "question_id": question_id,
                 "document_ids": document_ids,
                 "updated_at": now,
+                "source": EVENT_SOURCE_APP,
             },
             "$setOnInsert": {
                 "user_id": user_id,
@@ -78,10 +89,18 @@ async def list_calendar_events(
     db: AsyncIOMotorDatabase,
     user_id: str,
     limit: int = 20,
+    time_min: Optional[datetime] = None,
+    app_only: bool = False,
 ) -> list[CalendarEventInDB]:
+    """``app_only=True`` → bỏ event chỉ nhập về từ Google (record cũ không có source = của app)."""
+    query: dict[str, Any] = {"user_id": user_id}
+    if app_only:
+        query["source"] = {"$ne": EVENT_SOURCE_GOOGLE}
+    if time_min is not None:
+        query["end"] = {"$gte": time_min}
     cursor = (
         db["calendar_events"]
-        .find({"user_id": user_id})
+        .find(query)
         .sort("start", 1)
         .limit(limit)
     )
@@ -93,3 +112,115 @@ async def list_calendar_events(
         results.append(CalendarEventInDB.model_validate(doc))
     return results
 
+
+def _parse_google_time(value: dict[str, Any]) -> tuple[Optional[datetime], bool]:
+    """{"dateTime": ...} hoặc {"date": "YYYY-MM-DD"} (sự kiện cả ngày) → (datetime, all_day)."""
+    if not value:
+        return None, False
+    if value.get("dateTime"):
+        return datetime.fromisoformat(value["dateTime"].replace("Z", "+00:00")), False
+    if value.get("date"):
+        return datetime.fromisoformat(value["date"]), True
+    return None, False
+
+
+async def apply_google_event_changes(
+    db: AsyncIOMotorDatabase,
+    user_id: str,
+    items: list[dict[str, Any]],
+    synced_at: datetime,
+) -> tuple[int, int]:
+    """Ghi các thay đổi từ Google (events.list) vào bản local bằng 1 bulk_write.
+
+    Event "cancelled" → xóa; còn lại upsert các field của Google, giữ nguyên
+    metadata của app (event_type, question_id, document_ids, source). Event chưa
+    có bản local được đánh dấu ``source="google"``.
+    Trả về (số upsert, số xóa).
+    """
+    operations = []
+    upserts = deletes = 0
+    for item in items:
+        event_id = item.get("id")
+        if not event_id:
+            continue
+        key = {"user_id": user_id, "google_event_id": event_id}
+        if item.get("status") == "cancelled":
+            operations.append(DeleteOne(key))
+            deletes += 1
+            continue
+        start, all_day = _parse_google_time(item.get("start") or {})
+        end, _ = _parse_google_time(item.get("end") or {})
+        if start is None or end is None:
+            continue
+        operations.append(
+            UpdateOne(
+                key,
+                {
+                    "$set": {
+                        "summary": item.get("summary") or "",
+                        "start": start,
+                        "end": end,
+                        "timezone": (item.get("start") or {}).get("timeZone") or "UTC",
+                        "description": item.get("description"),
+                        "html_link": item.get("htmlLink"),
+                        "all_day": all_day,
+                        "updated_at": synced_at,
+                        "synced_at": synced_at,
+                    },
+                    "$setOnInsert": {
+                        "user_id": user_id,
+                        "google_event_id": event_id,
+                        "event_type": None,
+                        "question_id": None,
+                        "document_ids": [],
+                        "created_at": synced_at,
+                        # Event app tạo đã có row (source="app") → giữ nguyên
+                        "source": EVENT_SOURCE_GOOGLE,
+                    },
+                },
+                upsert=True,
+            )
+        )
+        upserts += 1
+    if operations:
+        await db["calendar_events"].bulk_write(operations, ordered=False)
+    return upserts, deletes
+
+
+async def delete_stale_calendar_events(
+    db: AsyncIOMotorDatabase,
+    user_id: str,
+    before: datetime,
+) -> int:
+    """Sau full sync: xóa event local không còn trên Google (không được sync lần này)."""
+    result = await db["calendar_events"].delete_many(
+        {
+            "user_id": user_id,
+            "$or": [
+                {"synced_at": {"$lt": before}},
+                {"synced_at": None, "created_at": {"$lt": before}},
+            ],
+        }
+    )
+    return result.deleted_count
+
+
+async def get_calendar_sync_state(db: AsyncIOMotorDatabase, user_id: str) -> Optional[dict[str, Any]]:
+    return await db["calendar_sync"].find_one({"_id": user_id})
+
+
+async def save_calendar_sync_state(
+    db: AsyncIOMotorDatabase,
+    user_id: str,
+    sync_token: Optional[str],
+    synced_at: datetime,
+) -> None:
+    await db["calendar_sync"].update_one(
+        {"_id": user_id},
+        {"$set": {"sync_token": sync_token, "last_synced_at": synced_at}},
+        upsert=True,
+    )
+
+
+async def clear_calendar_sync_state(db: AsyncIOMotorDatabase, user_id: str) -> None:
+    await db["calendar_sync"].delete_one({"_id": user_id})
@@ -3,7 +3,9 @@ from typing import Optional
 from pydantic import BaseModel, Field
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from bson import ObjectId
-from pymongo import UpdateOne
+from pymongo import ReturnDocument, UpdateOne
+
+from .stats import record_stats
 
 
 class DocumentInDB(BaseModel):
@@ -21,6 +23,9 @@ class DocumentInDB(BaseModel):
     embedding_model: Optional[str] = None
     embedding_dimension: Optional[int] = None
     faiss_namespace: Optional[str] = None
+    section_index: Optional[list[dict]] = None  # cây PHẦN/subsection, dựng lúc upload
+    deleted_at: Optional[datetime] = None  # tombstone: đang chờ job nền xóa hẳn
+    content_hash: Optional[str] = None  # sha256 nội dung file → dùng lại kết quả xử lý khi upload trùng
 
 
 class DocumentPublic(BaseModel):
@@ -52,6 +57,8 @@ async def create_document(
     file_size: int,
     chunk_count: int = 0,
     content_preview: Optional[str] = None,
+    section_index: Optional[list[dict]] = None,
+    content_hash: Optional[str] = None,
 ) -> DocumentInDB:
     doc_data = {
         "user_id": user_id,
@@ -67,6 +74,8 @@ async def create_document(
         "embedding_model": None,
         "embedding_dimension": None,
         "faiss_namespace": None,
+        "section_index": section_index,
+        "content_hash": content_hash,
     }
     result = await db["documents"].insert_one(doc_data)
     doc_data["_id"] = str(result.inserted_id)
@@ -77,16 +86,131 @@ async def create_document(
         {"_id": ObjectId(result.inserted_id)},
         {"$set": {"faiss_namespace": namespace}},
     )
+    await record_stats(db, documents=1, uploads=1, storage_bytes=file_size or 0)
+
+    return DocumentInDB.model_validate(doc_data)
+
+
+async def ensure_document_indexes(db: AsyncIOMotorDatabase) -> None:
+    await db["documents"].create_index(
+        [("content_hash", 1), ("embedding_model", 1)],
+        name="content_hash",
+        partialFilterExpression={"content_hash": {"$type": "string"}},
+    )
+
+
+async def find_document_by_hash(
+    db: AsyncIOMotorDatabase,
+    content_hash: str,
+    embedding_model: str,
+) -> Optional[DocumentInDB]:
+    """Tài liệu đã xử lý xong (đã embed bằng đúng model hiện tại) có cùng nội dung file."""
+    doc = await db["documents"].find_one(
+        {
+            "content_hash": content_hash,
+            "embedding_model": embedding_model,
+            "is_embedded": True,
+            "deleted_at": None,
+        },
+        sort=[("upload_date", 1)],
+    )
+    if not doc:
+        return None
+    doc["_id"] = str(doc["_id"])
+    doc.setdefault("faiss_namespace", f"user_{doc['user_id']}_doc_{doc['_id']}")
+    return DocumentInDB.model_validate(doc)
+
 
+async def clone_document(
+    db: AsyncIOMotorDatabase,
+    source: DocumentInDB,
+    user_id: str,
+    filename: str,
+) -> DocumentInDB:
+    """Tạo document mới cho ``user_id`` dùng lại kết quả xử lý của ``source``.
+
+    File gốc và FAISS/BM25 index được dùng chung (cùng ``file_path`` /
+    ``faiss_namespace``, copy-on-write: chỉ xóa khi không còn document nào trỏ tới).
+    Chunks và bản ghi embeddings được sao chép (cùng vector_index) để mọi truy vấn
+    theo document_id giữ nguyên.
+    """
+    now = datetime.now(tz=timezone.utc)
+    doc_data = {
+        "user_id": user_id,
+        "filename": filename,
+        "file_type": source.file_type,
+        "file_path": source.file_path,
+        "file_size": source.file_size,
+        "upload_date": now,
+        "chunk_count": source.chunk_count,
+        "content_preview": source.content_preview,
+        "is_embedded": True,
+        "embedded_at": now,
+        "embedding_model": source.embedding_model,
+        "embedding_dimension": source.embedding_dimension,
+        "faiss_namespace": source.faiss_namespace or f"user_{source.user_id}_doc_{source.id}",
+        "section_index": source.section_index,
+        "content_hash": source.content_hash,
+        "cloned_from": source.id,
+    }
+    result = await db["documents"].insert_one(doc_data)
+    document_id = str(result.inserted_id)
+
+    chunk_id_map: dict[str, str] = {}
+    chunk_copies = []
+    async for chunk in db["chunks"].find({"document_id": source.id}).sort("chunk_index", 1):
+        old_id = str(chunk.pop("_id"))
+        chunk["_id"] = ObjectId()
+        chunk["document_id"] = document_id
+        chunk_id_map[old_id] = str(chunk["_id"])
+        chunk_copies.append(chunk)
+    if chunk_copies:
+        await db["chunks"].insert_many(chunk_copies)
+
+    embedding_copies = []
+    async for record in db["embeddings"].find({"document_id": source.id}):
+        record.pop("_id")
+        record["document_id"] = document_id
+        record["user_id"] = user_id
+        record["chunk_id"] = chunk_id_map.get(str(record.get("chunk_id")), record.get("chunk_id"))
+        record["created_at"] = now
+        embedding_copies.append(record)
+    if embedding_copies:
+        await db["embeddings"].insert_many(embedding_copies)
+
+    # File dùng chung với source → không tốn thêm dung lượng
+    await record_stats(db, documents=1, uploads=1)
+    doc_data["_id"] = document_id
     return DocumentInDB.model_validate(doc_data)
 
 
-async def get_document_by_id(db: AsyncIOMotorDatabase, document_id: str) -> Optional[DocumentInDB]:
+async def is_shared_with_other_documents(
+    db: AsyncIOMotorDatabase,
+    document: DocumentInDB,
+    field: str,
+    value: Optional[str],
+) -> bool:
+    """``file_path`` / ``faiss_namespace`` còn được document khác (bản clone) dùng không."""
+    if not value:
+        return False
+    # Bản clone đã tombstone cũng đang chờ purge → không tính là còn dùng
+    query = {field: value, "_id": {"$ne": ObjectId(document.id)}, "deleted_at": None}
+    return await db["documents"].count_documents(query, limit=1) > 0
+
+
+async def get_document_by_id(
+    db: AsyncIOMotorDatabase,
+    document_id: str,
+    include_deleted: bool = False,
+) -> Optional[DocumentInDB]:
     try:
         oid = ObjectId(document_id)
     except Exception:
         return None
-    doc = await db["documents"].find_one({"_id": oid})
+    query: dict = {"_id": oid}
+    if not include_deleted:
+        query["deleted_at"] = None
+    doc = await db["documents"].find_one(query)
     if not doc:
         return None
     doc["_id"] = str(doc["_id"])
@@ -95,7 +219,7 @@ async def get_document_by_id(db: AsyncIOMotorDatabase, document_id: str) -> Opti
 
 
 async def get_documents_by_user(db: AsyncIOMotorDatabase, user_id: str) -> list[DocumentInDB]:
-    cursor = db["documents"].find({"user_id": user_id}).sort("upload_date", -1)
+    cursor = db["documents"].find({"user_id": user_id, "deleted_at": None}).sort("upload_date", -1)
     docs = await cursor.to_list(length=None)
     for doc in docs:
         doc["_id"] = str(doc["_id"])
@@ -103,15 +227,55 @@ async def get_documents_by_user(db: AsyncIOMotorDatabase, user_id: str) -> list[
     return [DocumentInDB.model_validate(doc) for doc in docs]
 
 
+def _storage_bytes(doc: dict) -> int:
+    """Dung lượng file tính cho document; bản clone dùng chung file nên = 0."""
+    return 0 if doc.get("cloned_from") else int(doc.get("file_size") or 0)
+
+
+async def tombstone_document(db: AsyncIOMotorDatabase, document_id: str) -> Optional[DocumentInDB]:
+    """Đánh dấu xóa (đọc/tìm kiếm bỏ qua ngay); dữ liệu liên quan do job nền xóa sau."""
+    try:
+        oid = ObjectId(document_id)
+    except Exception:
+        return None
+    doc = await db["documents"].find_one_and_update(
+        {"_id": oid, "deleted_at": None},
+        {"$set": {"deleted_at": datetime.now(timezone.utc)}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not doc:
+        return None
+    await record_stats(db, documents=-1, storage_bytes=-_storage_bytes(doc))
+    doc["_id"] = str(doc["_id"])
+    doc.setdefault("faiss_namespace", f"user_{doc['user_id']}_doc_{doc['_id']}")
+    return DocumentInDB.model_validate(doc)
+
+
+async def list_tombstoned_documents(
+    db: AsyncIOMotorDatabase,
+    deleted_before: datetime,
+    limit: int = 100,
+) -> list[DocumentInDB]:
+    cursor = db["documents"].find({"deleted_at": {"$ne": None, "$lt": deleted_before}}).limit(limit)
+    docs = await cursor.to_list(length=limit)
+    for doc in docs:
+        doc["_id"] = str(doc["_id"])
+        doc.setdefault("faiss_namespace", f"user_{doc['user_id']}_doc_{doc['_id']}")
+    return [DocumentInDB.model_validate(doc) for doc in docs]
+
+
 async def delete_document(db: AsyncIOMotorDatabase, document_id: str) -> bool:
+    """Xóa hẳn document (bước cuối của cascade). Bộ đếm đã trừ lúc tombstone."""
     try:
         oid = ObjectId(document_id)
     except Exception:
         return False
-    result = await db["documents"].delete_one({"_id": oid})
-    # Xóa cả chunks liên quan
-    await db["chunks"].delete_many({"document_id": document_id})
-    return result.deleted_count > 0
+    deleted = await db["documents"].find_one_and_delete(
+        {"_id": oid}, projection={"file_size": 1, "deleted_at": 1, "cloned_from": 1}
+    )
+    if deleted and not deleted.get("deleted_at"):
+        await record_stats(db, documents=-1, storage_bytes=-_storage_bytes(deleted))
+    return deleted is not None
 
 
 async def get_chunks_by_document(db: AsyncIOMotorDatabase, document_id: str) -> list[dict]:
@@ -124,27 +288,53 @@ async def get_chunks_by_document(db: AsyncIOMotorDatabase, document_id: str) ->
 
 async def save_chunks(db: AsyncIOMotorDatabase, document_id: str, chunks: list[dict]) -> list[dict]:
     """Lưu chunks vào collection chunks. Mỗi chunk có: document_id, chunk_index, content, metadata."""
-    if not chunks:
-        return []
+    saved = await save_chunks_bulk(db, [(document_id, chunks)])
+    return saved[0]
+
+
+async def save_chunks_bulk(
+    db: AsyncIOMotorDatabase,
+    items: list[tuple[str, list[dict]]],
+) -> list[list[dict]]:
+    """Như save_chunks cho nhiều tài liệu: 1 insert_many cho cả lô, trả về chunks theo từng tài liệu."""
     chunk_docs = []
-    for idx, chunk_data in enumerate(chunks):
-        chunk_docs.append({
-            "document_id": document_id,
-            "chunk_index": idx,
-            "content": chunk_data.get("content", ""),
-            "metadata": chunk_data.get("metadata", {}),
-            "has_embedding": False,
-            "embedding_index": None,
-            "embedding_model": None,
-            "embedded_at": None,
-        })
-    saved_chunks: list[dict] = []
+    for document_id, chunks in items:
+        for idx, chunk_data in enumerate(chunks):
+            chunk_docs.append({
+                "document_id": document_id,
+                "chunk_index": idx,
+                "content": chunk_data.get("content", ""),
+                "metadata": chunk_data.get("metadata", {}),
+                "has_embedding": False,
+                "embedding_index": None,
+                "embedding_model": None,
+                "embedded_at": None,
+            })
     if chunk_docs:
         result = await db["chunks"].insert_many(chunk_docs)
         for inserted_id, chunk_doc in zip(result.inserted_ids, chunk_docs):
             chunk_doc["_id"] = str(inserted_id)
-            saved_chunks.append(chunk_doc)
-    return saved_chunks
+    saved: list[list[dict]] = []
+    offset = 0
+    for _, chunks in items:
+        saved.append(chunk_docs[offset : offset + len(chunks)])
+        offset += len(chunks)
+    return saved
+
+
+async def save_section_index(
+    db: AsyncIOMotorDatabase,
+    document_id: str,
+    section_index: list[dict],
+) -> None:
+    try:
+        oid = ObjectId(document_id)
+    except Exception:
+        return
+    await db["documents"].update_one(
+        {"_id": oid},
+        {"$set": {"section_index": section_index}},
+    )
 
 
 async def mark_document_embedded(
@@ -1,10 +1,18 @@
+import asyncio
+import base64
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Optional, Set
 
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from pydantic import BaseModel, Field
 
+from ..core.config import settings
+from ..core.logger import get_logger
+from .stats import record_stats
+
+logger = get_logger("history")
+
 
 class HistoryReference(BaseModel):
     document_id: Optional[str] = None
@@ -22,7 +30,7 @@ class HistoryInDB(BaseModel):
     id: str = Field(alias="_id")
     user_id: str
     question: str
-    answer: str
+    answer: Optional[str] = None  # None khi list ở chế độ summary
     references: List[HistoryReference] = []
     document_id: Optional[str] = None
     conversation_id: Optional[str] = None  # Group Q&As in the same conversation
@@ -33,34 +41,285 @@ class HistoryPublic(BaseModel):
     id: str
     user_id: str
     question: str
-    answer: str
+    answer: Optional[str] = None  # None khi list ở chế độ summary
     references: List[HistoryReference] = []
     document_id: Optional[str] = None
     conversation_id: Optional[str] = None  # Group Q&As in the same conversation
     created_at: datetime
 
 
-async def create_history(
-    db: AsyncIOMotorDatabase,
+def build_history_document(
     user_id: str,
     question: str,
     answer: str,
     references: List[HistoryReference],
     document_id: Optional[str] = None,
     conversation_id: Optional[str] = None,
-) -> HistoryInDB:
-    payload = {
+) -> dict:
+    """Dựng document history hoàn chỉnh với _id sinh phía client.
+
+    Cuộc hội thoại mới dùng chính history_id làm conversation_id → chỉ cần 1 lần insert,
+    không phải update lại sau khi có id.
+    """
+    oid = ObjectId()
+    return {
+        "_id": oid,
         "user_id": user_id,
         "question": question,
         "answer": answer,
         "references": [ref.model_dump() for ref in references],
         "document_id": document_id,
-        "conversation_id": conversation_id,
+        "conversation_id": conversation_id or str(oid),
         "created_at": datetime.utcnow(),
     }
-    result = await db["histories"].insert_one(payload)
-    payload["_id"] = str(result.inserted_id)
-    return HistoryInDB.model_validate(payload)
+
+
+def _to_history(payload: dict) -> HistoryInDB:
+    return HistoryInDB.model_validate({**payload, "_id": str(payload["_id"])})
+
+
+async def _apply_side_writes(db: AsyncIOMotorDatabase, payload: dict) -> None:
+    """Tóm tắt conversation + bộ đếm stats (song song, lỗi chỉ log)."""
+    try:
+        await asyncio.gather(
+            _record_conversation_message(db, payload),
+            record_stats(
+                db,
+                histories=1,
+                questions=1,
+                active_user_id=payload.get("user_id"),
+                when=payload.get("created_at"),
+            ),
+        )
+    except Exception as exc:
+        logger.error("History side writes failed for %s: %s", payload.get("_id"), exc)
+
+
+async def _insert_history(db: AsyncIOMotorDatabase, payload: dict) -> None:
+    await db["histories"].insert_one(payload)
+    await _apply_side_writes(db, payload)
+
+
+class HistoryWriter:
+    """Ghi history nền qua queue có giới hạn (fire-and-forget cho /query/ask).
+
+    Queue đầy → ghi trực tiếp (backpressure) thay vì bỏ record.
+    """
+
+    def __init__(self, max_queue_size: int = 1000):
+        self._max_queue_size = max_queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._side_tasks: Set[asyncio.Task] = set()
+
+    def schedule_side_writes(self, db: AsyncIOMotorDatabase, payload: dict) -> None:
+        """Chạy side writes của 1 record vừa insert mà không bắt request chờ."""
+        task = asyncio.create_task(_apply_side_writes(db, payload))
+        self._side_tasks.add(task)
+        task.add_done_callback(self._side_tasks.discard)
+
+    def _ensure_worker(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self._max_queue_size)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return self._queue
+
+    async def _run(self) -> None:
+        queue = self._queue
+        while True:
+            db, payload = await queue.get()
+            try:
+                await _insert_history(db, payload)
+            except Exception as exc:
+                logger.error("Background history write failed for %s: %s", payload.get("_id"), exc)
+            finally:
+                queue.task_done()
+
+    async def submit(self, db: AsyncIOMotorDatabase, payload: dict) -> None:
+        queue = self._ensure_worker()
+        try:
+            queue.put_nowait((db, payload))
+        except asyncio.QueueFull:
+            logger.warning("History write queue full (%s), writing inline", self._max_queue_size)
+            await _insert_history(db, payload)
+
+    async def drain(self) -> None:
+        """Chờ ghi hết các record đang chờ (gọi khi shutdown)."""
+        if self._queue is not None:
+            await self._queue.join()
+        if self._side_tasks:
+            await asyncio.gather(*self._side_tasks, return_exceptions=True)
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+
+history_writer = HistoryWriter(max_queue_size=settings.history_write_queue_size)
+
+
+async def create_history(
+    db: AsyncIOMotorDatabase,
+    user_id: str,
+    question: str,
+    answer: str,
+    references: List[HistoryReference],
+    document_id: Optional[str] = None,
+    conversation_id: Optional[str] = None,
+    background: bool = False,
+) -> HistoryInDB:
+    """Lưu 1 Q&A bằng đúng 1 lần insert. ``background=True`` → không chờ ghi xong."""
+    payload = build_history_document(
+        user_id, question, answer, references, document_id, conversation_id
+    )
+    if background:
+        await history_writer.submit(db, payload)
+    else:
+        # Request chỉ chờ insert; tóm tắt conversation + stats ghi nền
+        await db["histories"].insert_one(payload)
+        history_writer.schedule_side_writes(db, payload)
+    return _to_history(payload)
+
+
+# Sidebar chỉ cần câu hỏi + thời gian → bỏ answer/references (phần nặng nhất của record)
+SUMMARY_PROJECTION = {"answer": 0, "references": 0}
+
+
+class ConversationSummary(BaseModel):
+    conversation_id: str
+    first_question: str
+    last_question: str
+    message_count: int
+    document_id: Optional[str] = None
+    started_at: datetime
+    last_activity_at: datetime
+
+
+# ``conversations``: 1 document / (user_id, conversation_id), cập nhật mỗi lần ghi
+# history → sidebar phân trang theo keyset trên collection nhỏ, không group lại histories
+CONVERSATIONS = "conversations"
+
+
+async def _record_conversation_message(db: AsyncIOMotorDatabase, payload: dict) -> None:
+    created_at = payload["created_at"]
+    await db[CONVERSATIONS].update_one(
+        {"user_id": payload["user_id"], "conversation_id": payload["conversation_id"]},
+        {
+            "$inc": {"message_count": 1},
+            "$min": {"started_at": created_at},
+            "$max": {"last_activity_at": created_at},
+            "$set": {"last_question": payload["question"], "document_id": payload.get("document_id")},
+            "$setOnInsert": {"first_question": payload["question"]},
+        },
+        upsert=True,
+    )
+
+
+def _conversation_group_stages(match: dict) -> list:
+    """Tóm tắt conversation từ histories (chỉ dùng để dựng lại / backfill)."""
+    return [
+        {"$match": match},
+        {"$sort": {"created_at": -1}},
+        {
+            "$group": {
+                # Record cũ chưa có conversation_id → mỗi record là 1 conversation
+                "_id": {
+                    "user_id": "$user_id",
+                    "conversation_id": {"$ifNull": ["$conversation_id", {"$toString": "$_id"}]},
+                },
+                "last_activity_at": {"$first": "$created_at"},
+                "last_question": {"$first": "$question"},
+                "started_at": {"$last": "$created_at"},
+                "first_question": {"$last": "$question"},
+                "document_id": {"$first": "$document_id"},
+                "message_count": {"$sum": 1},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "user_id": "$_id.user_id",
+                "conversation_id": "$_id.conversation_id",
+                "last_activity_at": 1,
+                "last_question": 1,
+                "started_at": 1,
+                "first_question": 1,
+                "document_id": 1,
+                "message_count": 1,
+            }
+        },
+    ]
+
+
+async def refresh_conversation_summaries(
+    db: AsyncIOMotorDatabase,
+    user_id: str,
+    conversation_ids: List[str],
+) -> None:
+    """Dựng lại tóm tắt các conversation vừa bị xóa bớt record (O(conversation))."""
+    conversation_ids = [cid for cid in set(conversation_ids) if cid]
+    if not conversation_ids:
+        return
+    rows = await db["histories"].aggregate(
+        _conversation_group_stages({"user_id": user_id, "conversation_id": {"$in": conversation_ids}})
+    ).to_list(length=None)
+    remaining = {row["conversation_id"] for row in rows}
+    for row in rows:
+        await db[CONVERSATIONS].replace_one(
+            {"user_id": user_id, "conversation_id": row["conversation_id"]}, row, upsert=True
+        )
+    emptied = [cid for cid in conversation_ids if cid not in remaining]
+    if emptied:
+        await db[CONVERSATIONS].delete_many({"user_id": user_id, "conversation_id": {"$in": emptied}})
+
+
+async def conversation_ids_for(db: AsyncIOMotorDatabase, query: dict) -> List[str]:
+    """conversation_id của các record khớp ``query`` (record cũ: chính _id)."""
+    rows = await db["histories"].find(query, {"conversation_id": 1}).to_list(length=None)
+    return list({row.get("conversation_id") or str(row["_id"]) for row in rows})
+
+
+async def backfill_conversation_summaries(db: AsyncIOMotorDatabase) -> None:
+    """Lần đầu chạy (collection conversations còn trống) → dựng từ histories hiện có."""
+    if await db[CONVERSATIONS].estimated_document_count() or not await db["histories"].find_one({}, {"_id": 1}):
+        return
+    await db["histories"].aggregate(
+        _conversation_group_stages({})
+        + [{"$merge": {"into": CONVERSATIONS, "on": ["user_id", "conversation_id"], "whenMatched": "keepExisting"}}]
+    ).to_list(length=None)
+    logger.info("Backfilled conversation summaries from histories")
+
+
+def encode_cursor(created_at: datetime, record_id: str) -> str:
+    raw = f"{created_at.isoformat()}|{record_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Optional[tuple]:
+    """Cursor → (created_at, id); cursor hỏng → None."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        created_at, record_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), record_id
+    except Exception:
+        return None
+
+
+async def ensure_history_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Index cho keyset pagination theo (created_at, _id) và theo conversation."""
+    await db["histories"].create_index(
+        [("user_id", 1), ("created_at", -1), ("_id", -1)], name="user_created_at"
+    )
+    await db["histories"].create_index(
+        [("user_id", 1), ("conversation_id", 1), ("created_at", -1)], name="user_conversation"
+    )
+    await db[CONVERSATIONS].create_index(
+        [("user_id", 1), ("conversation_id", 1)], name="user_conversation", unique=True
+    )
+    await db[CONVERSATIONS].create_index(
+        [("user_id", 1), ("last_activity_at", -1), ("conversation_id", -1)], name="user_last_activity"
+    )
+    await backfill_conversation_summaries(db)
 
 
 async def list_history_by_user(
@@ -68,26 +327,93 @@ async def list_history_by_user(
     user_id: str,
     limit: int = 20,
     document_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    summary: bool = False,
 ) -> List[HistoryInDB]:
+    """Trang history mới nhất trước, keyset theo (created_at, _id).
+
+    ``cursor`` là giá trị encode_cursor của record cuối trang trước.
+    ``summary=True`` bỏ answer/references.
+    """
     query = {"user_id": user_id}
     if document_id:
         query["document_id"] = document_id
-    cursor = (
-        db["histories"].find(query).sort("created_at", -1).limit(limit)
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        created_at, record_id = position
+        try:
+            oid = ObjectId(record_id)
+        except Exception:
+            oid = None
+        if oid is not None:
+            query["$or"] = [
+                {"created_at": {"$lt": created_at}},
+                {"created_at": created_at, "_id": {"$lt": oid}},
+            ]
+    cursor_obj = (
+        db["histories"]
+        .find(query, SUMMARY_PROJECTION if summary else None)
+        .sort([("created_at", -1), ("_id", -1)])
+        .limit(limit)
     )
-    records = await cursor.to_list(length=limit)
+    records = await cursor_obj.to_list(length=limit)
     for record in records:
         record["_id"] = str(record["_id"])
+        if summary:
+            record["answer"] = None
     return [HistoryInDB.model_validate(record) for record in records]
 
 
+async def list_conversations_by_user(
+    db: AsyncIOMotorDatabase,
+    user_id: str,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+) -> List[ConversationSummary]:
+    """1 dòng tóm tắt / conversation, mới hoạt động nhất trước (keyset trên ``conversations``).
+
+    ``cursor`` = encode_cursor(last_activity_at, conversation_id) của dòng cuối trang trước.
+    """
+    query: dict = {"user_id": user_id}
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        last_at, conversation_id = position
+        query["$or"] = [
+            {"last_activity_at": {"$lt": last_at}},
+            {"last_activity_at": last_at, "conversation_id": {"$lt": conversation_id}},
+        ]
+    rows = await (
+        db[CONVERSATIONS]
+        .find(query)
+        .sort([("last_activity_at", -1), ("conversation_id", -1)])
+        .limit(limit)
+        .to_list(length=limit)
+    )
+    return [
+        ConversationSummary(
+            conversation_id=row["conversation_id"],
+            first_question=row.get("first_question") or "",
+            last_question=row.get("last_question") or "",
+            message_count=row.get("message_count", 0),
+            document_id=row.get("document_id"),
+            started_at=row["started_at"],
+            last_activity_at=row["last_activity_at"],
+        )
+        for row in rows
+    ]
+
+
 async def clear_history_for_document(
     db: AsyncIOMotorDatabase,
     user_id: str,
     document_id: str,
 ) -> None:
     query = {"user_id": user_id, "document_id": document_id}
-    await db["histories"].delete_many(query)
+    conversation_ids = await conversation_ids_for(db, query)
+    result = await db["histories"].delete_many(query)
+    if result.deleted_count:
+        await record_stats(db, histories=-result.deleted_count)
+        await refresh_conversation_summaries(db, user_id, conversation_ids)
  
 
 async def delete_history_record(
@@ -99,12 +425,22 @@ async def delete_history_record(
         oid = ObjectId(history_id)
     except Exception:
         return False
-    result = await db["histories"].delete_one({"_id": oid, "user_id": user_id})
-    return result.deleted_count > 0
+    deleted = await db["histories"].find_one_and_delete(
+        {"_id": oid, "user_id": user_id}, projection={"conversation_id": 1}
+    )
+    if deleted:
+        await record_stats(db, histories=-1)
+        await refresh_conversation_summaries(
+            db, user_id, [deleted.get("conversation_id") or str(deleted["_id"])]
+        )
+    return deleted is not None
 
 
 async def clear_history_for_user(db: AsyncIOMotorDatabase, user_id: str) -> None:
-    await db["histories"].delete_many({"user_id": user_id})
+    result = await db["histories"].delete_many({"user_id": user_id})
+    await db[CONVERSATIONS].delete_many({"user_id": user_id})
+    if result.deleted_count:
+        await record_stats(db, histories=-result.deleted_count)
 
 
 async def delete_history_by_conversation(
@@ -135,5 +471,8 @@ async def delete_history_by_conversation(
         except Exception:
             pass
     
+    await db[CONVERSATIONS].delete_many({"user_id": user_id, "conversation_id": conversation_id})
+    if result.deleted_count:
+        await record_stats(db, histories=-result.deleted_count)
     return result.deleted_count
 
@@ -0,0 +1,145 @@
+"""Ngân hàng câu hỏi sinh sẵn cho từng tài liệu (theo độ khó, loại câu, section).
+
+Mỗi document trong ``question_bank`` là 1 câu hỏi. ``served_count`` đếm số lần
+câu hỏi đã được đưa vào quiz: lúc lấy đề ưu tiên câu chưa dùng, hết câu mới
+thì dùng lại câu ít dùng nhất.
+"""
+
+import re
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import BulkWriteError
+
+from .quiz import QuizQuestion
+
+
+def normalize_question_text(text: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+async def ensure_question_bank_indexes(db: AsyncIOMotorDatabase) -> None:
+    await db["question_bank"].create_index(
+        [("document_id", 1), ("difficulty", 1), ("question_type", 1), ("served_count", 1)],
+        name="bank_lookup",
+    )
+    # Chặn câu trùng trong cùng tài liệu + độ khó
+    await db["question_bank"].create_index(
+        [("document_id", 1), ("difficulty", 1), ("normalized_text", 1)],
+        name="bank_unique_text",
+        unique=True,
+    )
+
+
+async def add_bank_questions(
+    db: AsyncIOMotorDatabase,
+    user_id: str,
+    document_id: str,
+    difficulty: str,
+    questions: List[QuizQuestion],
+) -> int:
+    """Thêm câu hỏi vào ngân hàng, bỏ qua câu trùng. Trả về số câu đã thêm."""
+    if not questions:
+        return 0
+    now = datetime.utcnow()
+    docs = [
+        {
+            "user_id": user_id,
+            "document_id": document_id,
+            "difficulty": difficulty,
+            "question_type": question.question_type,
+            "section": question.section,
+            "normalized_text": normalize_question_text(question.question_text),
+            "question": question.model_dump(),
+            "served_count": 0,
+            "created_at": now,
+        }
+        for question in questions
+    ]
+    try:
+        result = await db["question_bank"].insert_many(docs, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as exc:
+        return exc.details.get("nInserted", 0)
+
+
+async def count_fresh_bank_questions(
+    db: AsyncIOMotorDatabase,
+    user_id: str,
+    document_id: str,
+    difficulty: str,
+) -> Dict[str, int]:
+    """Số câu chưa dùng theo loại: {"multiple_choice": n, "true_false": m}."""
+    rows = await db["question_bank"].aggregate([
+        {"$match": {"user_id": user_id, "document_id": document_id, "difficulty": difficulty, "served_count": 0}},
+        {"$group": {"_id": "$question_type", "count": {"$sum": 1}}},
+    ]).to_list(length=None)
+    return {row["_id"]: row["count"] for row in rows}
+
+
+async def draw_bank_questions(
+    db: AsyncIOMotorDatabase,
+    user_id: str,
+    document_id: str,
+    difficulty: str,
+    counts: Dict[str, int],
+) -> Optional[Dict[str, object]]:
+    """Lấy ngẫu nhiên ``counts[type]`` câu mỗi loại (1 aggregation), ưu tiên câu chưa dùng.
+
+    Trả về {"questions": [...], "fresh_remaining": {type: n}} hoặc None nếu
+    ngân hàng không đủ câu cho mọi loại.
+    """
+    base = {"user_id": user_id, "document_id": document_id, "difficulty": difficulty}
+    facets: Dict[str, list] = {
+        "fresh_counts": [
+            {"$match": {"served_count": 0}},
+            {"$group": {"_id": "$question_type", "count": {"$sum": 1}}},
+        ],
+    }
+    for question_type, wanted in counts.items():
+        if wanted <= 0:
+            continue
+        facets[f"{question_type}__fresh"] = [
+            {"$match": {"question_type": question_type, "served_count": 0}},
+            {"$sample": {"size": wanted}},
+        ]
+        facets[f"{question_type}__used"] = [
+            {"$match": {"question_type": question_type, "served_count": {"$gt": 0}}},
+            {"$sort": {"served_count": 1}},
+            {"$limit": wanted},
+        ]
+    result = await db["question_bank"].aggregate([
+        {"$match": base},
+        {"$facet": facets},
+    ]).to_list(length=1)
+    if not result:
+        return None
+    rows = result[0]
+
+    chosen: List[dict] = []
+    for question_type, wanted in counts.items():
+        if wanted <= 0:
+            continue
+        picked = (rows.get(f"{question_type}__fresh", []) + rows.get(f"{question_type}__used", []))[:wanted]
+        if len(picked) < wanted:
+            return None
+        chosen.extend(picked)
+
+    await db["question_bank"].update_many(
+        {"_id": {"$in": [row["_id"] for row in chosen]}},
+        {"$inc": {"served_count": 1}},
+    )
+    fresh_remaining = {row["_id"]: row["count"] for row in rows.get("fresh_counts", [])}
+    for row in chosen:
+        if row.get("served_count", 0) == 0:
+            fresh_remaining[row["question_type"]] = fresh_remaining.get(row["question_type"], 1) - 1
+    return {
+        "questions": [QuizQuestion(**row["question"]) for row in chosen],
+        "fresh_remaining": fresh_remaining,
+    }
+
+
+async def delete_bank_for_document(db: AsyncIOMotorDatabase, document_id: str) -> int:
+    result = await db["question_bank"].delete_many({"document_id": document_id})
+    return result.deleted_count
@@ -49,8 +49,12 @@ class QuizAttemptAnswer(BaseModel):
     """User's answer for one question"""
     question_index: int
     user_answer: str
-    is_correct: bool
+    is_correct: bool = False  # Server chấm lại (giá trị client gửi lên bị bỏ qua)
     time_spent: Optional[int] = None  # seconds spent on this question
+    # Ghi kèm lúc chấm để thống kê không phải đọc lại quiz
+    question_type: Optional[str] = None
+    section: Optional[str] = None
+    correct_answer: Optional[str] = None
 
 
 class QuizAttemptInDB(BaseModel):
@@ -58,6 +62,7 @@ class QuizAttemptInDB(BaseModel):
     id: str = Field(default_factory=lambda: str(ObjectId()), alias="_id")
     user_id: str
     quiz_id: str
+    document_id: Optional[str] = None
     mode: str  # "practice" or "test"
     answers: List[QuizAttemptAnswer]
     score: int  # Number of correct answers
@@ -84,6 +89,48 @@ class QuizAttemptPublic(BaseModel):
     completed_at: datetime
 
 
+def _normalize_answer(text: str) -> str:
+    return " ".join((text or "").split()).casefold()
+
+
+def grade_quiz_answers(
+    questions: List[QuizQuestion],
+    answers: List[QuizAttemptAnswer],
+) -> List[QuizAttemptAnswer]:
+    """Chấm bài theo đáp án đã lưu trong quiz.
+
+    Mỗi câu của quiz có đúng 1 kết quả (câu không trả lời → user_answer rỗng, sai);
+    index ngoài phạm vi bị bỏ, index trùng lấy câu trả lời cuối. Chấp nhận cả chữ
+    cái (A/B) lẫn nội dung đáp án, True/False cho câu đúng/sai.
+    """
+    submitted = {a.question_index: a for a in answers if 0 <= a.question_index < len(questions)}
+    graded: List[QuizAttemptAnswer] = []
+    for index, question in enumerate(questions):
+        answer = submitted.get(index)
+        user_answer = answer.user_answer if answer else ""
+        given = _normalize_answer(user_answer)
+        correct = _normalize_answer(question.correct_answer)
+        accepted = {correct}
+        if question.question_type == "multiple_choice":
+            accepted |= {
+                letter.casefold()
+                for letter, option in zip("ABCD", question.options)
+                if _normalize_answer(option) == correct
+            }
+        elif question.question_type == "true_false":
+            accepted |= {"true", "t"} if question.correct_answer == "Đúng" else {"false", "f"}
+        graded.append(QuizAttemptAnswer(
+            question_index=index,
+            user_answer=user_answer,
+            is_correct=bool(given) and given in accepted,
+            time_spent=answer.time_spent if answer else None,
+            question_type=question.question_type,
+            section=question.section,
+            correct_answer=question.correct_answer,
+        ))
+    return graded
+
+
 # Database operations
 
 async def create_quiz(
@@ -199,6 +246,7 @@ async def create_quiz_attempt(
     score: int,
     total_questions: int,
     time_taken: Optional[int] = None,
+    document_id: Optional[str] = None,
 ) -> QuizAttemptInDB:
     """Save quiz attempt/result"""
     percentage = (score / total_questions * 100) if total_questions > 0 else 0
@@ -206,6 +254,7 @@ async def create_quiz_attempt(
     attempt = QuizAttemptInDB(
         user_id=user_id,
         quiz_id=quiz_id,
+        document_id=document_id,
         mode=mode,
         answers=answers,
         score=score,
@@ -0,0 +1,124 @@
+"""Thống kê kết quả quiz được cộng dồn lúc nộp bài (không quét ``quiz_attempts``).
+
+- ``quiz_question_stats`` (1 document / câu hỏi của 1 quiz): số lượt trả lời,
+  số lượt đúng, tổng thời gian → tỉ lệ đúng / thời gian trung bình từng câu.
+- ``quiz_section_stats`` (1 document / user + tài liệu + section): như trên
+  nhưng gộp theo section → endpoint "chủ đề yếu".
+"""
+
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+from .quiz import QuizAttemptAnswer
+
+
+async def ensure_quiz_analytics_indexes(db: AsyncIOMotorDatabase) -> None:
+    await db["quiz_question_stats"].create_index(
+        [("quiz_id", 1), ("question_index", 1)], name="quiz_question", unique=True
+    )
+    await db["quiz_section_stats"].create_index(
+        [("user_id", 1), ("document_id", 1), ("section", 1)], name="user_section", unique=True
+    )
+
+
+def _outcome_inc(answers: List[QuizAttemptAnswer]) -> Dict[str, int]:
+    timed = [a.time_spent for a in answers if a.time_spent is not None]
+    return {
+        "attempts": len(answers),
+        "correct": sum(1 for a in answers if a.is_correct),
+        "time_total": sum(timed),
+        "time_count": len(timed),
+    }
+
+
+async def record_attempt_outcomes(
+    db: AsyncIOMotorDatabase,
+    user_id: str,
+    quiz_id: str,
+    document_id: str,
+    answers: List[QuizAttemptAnswer],
+) -> None:
+    """``$inc`` bộ đếm theo câu hỏi và theo section cho các câu đã chấm."""
+    if not answers:
+        return
+    now = datetime.utcnow()
+    question_ops = [
+        UpdateOne(
+            {"quiz_id": quiz_id, "question_index": answer.question_index},
+            {
+                "$inc": _outcome_inc([answer]),
+                "$set": {"updated_at": now},
+                "$setOnInsert": {"user_id": user_id, "document_id": document_id, "section": answer.section},
+            },
+            upsert=True,
+        )
+        for answer in answers
+    ]
+    by_section: Dict[Optional[str], List[QuizAttemptAnswer]] = {}
+    for answer in answers:
+        by_section.setdefault(answer.section, []).append(answer)
+    section_ops = [
+        UpdateOne(
+            {"user_id": user_id, "document_id": document_id, "section": section},
+            {"$inc": _outcome_inc(group), "$set": {"updated_at": now}},
+            upsert=True,
+        )
+        for section, group in by_section.items()
+    ]
+    await db["quiz_question_stats"].bulk_write(question_ops, ordered=False)
+    await db["quiz_section_stats"].bulk_write(section_ops, ordered=False)
+
+
+def _summarize(doc: Dict[str, Any]) -> Dict[str, Any]:
+    attempts = int(doc.get("attempts", 0))
+    time_count = int(doc.get("time_count", 0))
+    return {
+        "attempts": attempts,
+        "correct": int(doc.get("correct", 0)),
+        "accuracy": round(doc.get("correct", 0) / attempts, 4) if attempts else 0.0,
+        "avg_time_spent": round(doc.get("time_total", 0) / time_count, 2) if time_count else None,
+    }
+
+
+async def get_quiz_question_stats(db: AsyncIOMotorDatabase, quiz_id: str) -> List[dict]:
+    cursor = db["quiz_question_stats"].find({"quiz_id": quiz_id}).sort("question_index", 1)
+    return [
+        {"question_index": doc["question_index"], "section": doc.get("section"), **_summarize(doc)}
+        async for doc in cursor
+    ]
+
+
+async def get_weak_topics(
+    db: AsyncIOMotorDatabase,
+    user_id: str,
+    document_id: Optional[str] = None,
+    min_attempts: int = 3,
+    limit: int = 10,
+) -> List[dict]:
+    """Các section có tỉ lệ đúng thấp nhất (chỉ section đã trả lời ít nhất ``min_attempts`` câu)."""
+    query: Dict[str, Any] = {"user_id": user_id, "attempts": {"$gte": min_attempts}}
+    if document_id:
+        query["document_id"] = document_id
+    rows = await db["quiz_section_stats"].aggregate([
+        {"$match": query},
+        {"$addFields": {"accuracy": {"$divide": ["$correct", "$attempts"]}}},
+        {"$sort": {"accuracy": 1, "attempts": -1}},
+        {"$limit": limit},
+    ]).to_list(length=limit)
+    return [
+        {"document_id": doc["document_id"], "section": doc.get("section"), **_summarize(doc)}
+        for doc in rows
+    ]
+
+
+async def delete_quiz_question_stats(db: AsyncIOMotorDatabase, quiz_id: str) -> int:
+    result = await db["quiz_question_stats"].delete_many({"quiz_id": quiz_id})
+    return result.deleted_count
+
+
+async def delete_quiz_analytics_for_document(db: AsyncIOMotorDatabase, document_id: str) -> None:
+    await db["quiz_question_stats"].delete_many({"document_id": document_id})
+    await db["quiz_section_stats"].delete_many({"document_id": document_id})
@@ -0,0 +1,178 @@
+"""Thống kê hệ thống được cập nhật dần (không quét collection khi mở trang admin).
+
+- ``stats`` (1 document ``_id="system"``): tổng users / documents / histories /
+  dung lượng file. Các đường upload, xóa, hỏi đáp, tạo user gọi ``record_stats``
+  để ``$inc``.
+- ``stats_daily`` (1 document / ngày UTC, ``_id="YYYY-MM-DD"``): số câu hỏi,
+  số upload, bytes thêm/xóa và user hoạt động trong ngày → biểu đồ xu hướng.
+- ``reconcile_system_stats`` đếm lại từ dữ liệu thật để sửa sai lệch (chạy định kỳ).
+  Lần chạy đầu tiên còn bù ``stats_daily`` của STATS_DAILY_BACKFILL_DAYS ngày gần
+  nhất từ histories / documents (dữ liệu có trước khi có bộ đếm theo ngày), đánh
+  dấu ``daily_backfilled_at`` để không quét lại.
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from ..core.config import settings
+from ..core.logger import get_logger
+
+logger = get_logger("stats")
+
+SYSTEM_STATS_ID = "system"
+_TOTAL_FIELDS = ("total_users", "total_documents", "total_histories", "total_storage_bytes")
+
+
+def _day_key(when: datetime) -> str:
+    # Datetime naive trong repo là UTC (datetime.utcnow()), không phải giờ máy chủ
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.astimezone(timezone.utc).strftime("%Y-%m-%d")
+
+
+async def record_stats(
+    db: AsyncIOMotorDatabase,
+    *,
+    users: int = 0,
+    documents: int = 0,
+    histories: int = 0,
+    storage_bytes: int = 0,
+    questions: int = 0,
+    uploads: int = 0,
+    active_user_id: Optional[str] = None,
+    when: Optional[datetime] = None,
+) -> None:
+    """Cộng dồn bộ đếm tổng + bucket của ngày. Lỗi chỉ log (không làm hỏng request)."""
+    totals = {
+        "total_users": users,
+        "total_documents": documents,
+        "total_histories": histories,
+        "total_storage_bytes": storage_bytes,
+    }
+    totals = {k: v for k, v in totals.items() if v}
+    daily: Dict[str, int] = {}
+    if questions:
+        daily["questions"] = questions
+    if uploads:
+        daily["uploads"] = uploads
+    if storage_bytes > 0:
+        daily["bytes_uploaded"] = storage_bytes
+    elif storage_bytes < 0:
+        daily["bytes_deleted"] = -storage_bytes
+
+    try:
+        # 2 bộ đếm độc lập → ghi song song (1 round trip thay vì 2)
+        writes = []
+        if totals:
+            writes.append(db["stats"].update_one(
+                {"_id": SYSTEM_STATS_ID}, {"$inc": totals}, upsert=True
+            ))
+        if daily or active_user_id:
+            day = _day_key(when or datetime.now(tz=timezone.utc))
+            update: Dict[str, Any] = {"$setOnInsert": {"date": day}}
+            if daily:
+                update["$inc"] = daily
+            if active_user_id:
+                update["$addToSet"] = {"active_users": active_user_id}
+            writes.append(db["stats_daily"].update_one({"_id": day}, update, upsert=True))
+        if writes:
+            await asyncio.gather(*writes)
+    except Exception as exc:
+        logger.warning("⚠️ Failed to update stats counters: %s", exc)
+
+
+async def reconcile_system_stats(db: AsyncIOMotorDatabase) -> Dict[str, Any]:
+    """Đếm lại tổng từ users/documents/histories và ghi đè bộ đếm."""
+    # Document đã tombstone (đang chờ xóa nền) không tính; bản clone dùng chung file
+    storage = await db["documents"].aggregate([
+        {"$match": {"deleted_at": None, "cloned_from": None}},
+        {"$group": {"_id": None, "bytes": {"$sum": {"$ifNull": ["$file_size", 0]}}}},
+    ]).to_list(length=1)
+    totals = {
+        "total_users": await db["users"].count_documents({}),
+        "total_documents": await db["documents"].count_documents({"deleted_at": None}),
+        "total_histories": await db["histories"].count_documents({}),
+        "total_storage_bytes": storage[0]["bytes"] if storage else 0,
+    }
+    previous = await db["stats"].find_one({"_id": SYSTEM_STATS_ID}) or {}
+    drift = {k: totals[k] - previous.get(k, 0) for k in _TOTAL_FIELDS if totals[k] != previous.get(k, 0)}
+    if drift and previous:
+        logger.info("Stats reconciled, drift: %s", drift)
+    await db["stats"].update_one(
+        {"_id": SYSTEM_STATS_ID},
+        {"$set": {**totals, "reconciled_at": datetime.now(tz=timezone.utc)}},
+        upsert=True,
+    )
+    # Bù stats_daily đúng 1 lần (lần reconcile đầu sau deploy), không quét lại mỗi chu kỳ
+    if settings.stats_daily_backfill_days > 0 and not previous.get("daily_backfilled_at"):
+        await backfill_daily_stats(db, settings.stats_daily_backfill_days)
+        await db["stats"].update_one(
+            {"_id": SYSTEM_STATS_ID},
+            {"$set": {"daily_backfilled_at": datetime.now(tz=timezone.utc)}},
+        )
+    return totals
+
+
+async def backfill_daily_stats(db: AsyncIOMotorDatabase, days: int) -> int:
+    """Bù bucket ngày từ histories (câu hỏi, user hoạt động) và documents (upload).
+
+    Chỉ tăng, không giảm (``$max`` / ``$addToSet``): history / document đã bị xóa
+    vẫn được tính trong bộ đếm cũ. Trả về số bucket được ghi.
+    """
+    since = (datetime.now(tz=timezone.utc) - timedelta(days=days - 1)).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    day_expr = {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}
+    histories = await db["histories"].aggregate([
+        {"$match": {"created_at": {"$gte": since}}},
+        {"$group": {"_id": day_expr, "questions": {"$sum": 1}, "active_users": {"$addToSet": "$user_id"}}},
+    ]).to_list(length=None)
+    uploads = await db["documents"].aggregate([
+        {"$match": {"upload_date": {"$gte": since}}},
+        {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$upload_date"}}, "uploads": {"$sum": 1}}},
+    ]).to_list(length=None)
+
+    buckets: Dict[str, Dict[str, Any]] = {}
+    for row in histories:
+        buckets.setdefault(row["_id"], {}).update(questions=row["questions"], active_users=row["active_users"])
+    for row in uploads:
+        buckets.setdefault(row["_id"], {})["uploads"] = row["uploads"]
+    for day, values in buckets.items():
+        update: Dict[str, Any] = {"$setOnInsert": {"date": day}}
+        maxes = {k: values[k] for k in ("questions", "uploads") if values.get(k)}
+        if maxes:
+            update["$max"] = maxes
+        if values.get("active_users"):
+            update["$addToSet"] = {"active_users": {"$each": [u for u in values["active_users"] if u]}}
+        await db["stats_daily"].update_one({"_id": day}, update, upsert=True)
+    return len(buckets)
+
+
+async def get_system_totals(db: AsyncIOMotorDatabase) -> Dict[str, int]:
+    doc = await db["stats"].find_one({"_id": SYSTEM_STATS_ID})
+    if not doc or "reconciled_at" not in doc:
+        # Lần đầu (chưa có bộ đếm nền) → đếm 1 lần
+        return await reconcile_system_stats(db)
+    return {k: int(doc.get(k, 0)) for k in _TOTAL_FIELDS}
+
+
+async def get_daily_stats(db: AsyncIOMotorDatabase, days: int = 30) -> List[dict]:
+    """Bucket theo ngày (cũ → mới) của ``days`` ngày gần nhất, ngày trống = 0."""
+    today = datetime.now(tz=timezone.utc)
+    keys = [_day_key(today - timedelta(days=offset)) for offset in range(days - 1, -1, -1)]
+    cursor = db["stats_daily"].find({"_id": {"$gte": keys[0]}})
+    buckets = {doc["_id"]: doc for doc in await cursor.to_list(length=days + 1)}
+    return [
+        {
+            "date": key,
+            "questions": int(buckets.get(key, {}).get("questions", 0)),
+            "uploads": int(buckets.get(key, {}).get("uploads", 0)),
+            "bytes_uploaded": int(buckets.get(key, {}).get("bytes_uploaded", 0)),
+            "bytes_deleted": int(buckets.get(key, {}).get("bytes_deleted", 0)),
+            "active_users": list(buckets.get(key, {}).get("active_users", [])),
+        }
+        for key in keys
+    ]
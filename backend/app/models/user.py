@@ -5,6 +5,8 @@ from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from pydantic import BaseModel, EmailStr, Field
 
+from .stats import record_stats
+
 
 class UserInCreate(BaseModel):
     email: EmailStr
@@ -58,6 +60,7 @@ async def create_user(
         "google_calendar_token": None,
         "calendar_connected_at": None,
     })
+    await record_stats(db, users=1)
     return UserInDB.model_validate({
         "_id": str(res.inserted_id),
         "email": email,
@@ -1,32 +1,28 @@
 from datetime import datetime
 from typing import List
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.security import OAuth2PasswordBearer
+from fastapi import APIRouter, Depends, HTTPException, Response, status
 from pydantic import BaseModel
 
+from ..core.auth import get_current_admin, invalidate_user
 from ..core.database import get_database
-from ..core.security import decode_token, hash_password
+from ..core.security import hash_password_async, password_hash_pool
 from ..models.user import get_user_by_id, get_user_by_email, create_user, UserPublic
-from ..services.admin import fetch_user_overview, fetch_document_overview, fetch_system_stats
+from ..models.stats import record_stats, reconcile_system_stats
+from ..services.admin import (
+    USER_OVERVIEW_SORT_FIELDS,
+    fetch_daily_stats,
+    fetch_document_overview,
+    fetch_system_stats,
+    fetch_user_overview,
+)
+from ..services.document_cleanup import document_cleanup_service
+from ..services.pipeline import pipeline_metrics
+from ..services.quiz_parser import quiz_parse_metrics
 
 
 router = APIRouter()
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
-
-
-async def get_current_admin(token: str = Depends(oauth2_scheme)) -> UserPublic:
-    payload = decode_token(token)
-    if not payload or "sub" not in payload:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-    db = get_database()
-    user = await get_user_by_id(db, payload["sub"])
-    if not user or not user.is_admin:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin privileges required")
-    return UserPublic(id=user.id, email=user.email, full_name=user.full_name, is_admin=user.is_admin)
-
-
 class AdminUserSummary(BaseModel):
     id: str
     email: str
@@ -50,6 +46,16 @@ class AdminDocumentSummary(BaseModel):
     embedded_at: datetime | None = None
 
 
+class AdminDailyStats(BaseModel):
+    date: str
+    questions: int
+    uploads: int
+    active_users: int
+    bytes_uploaded: int
+    bytes_deleted: int
+    bytes_stored: int
+
+
 class AdminStats(BaseModel):
     total_users: int
     total_documents: int
@@ -60,9 +66,28 @@ class AdminStats(BaseModel):
 
 
 @router.get("/users", response_model=List[AdminUserSummary])
-async def list_users_admin(current_admin: UserPublic = Depends(get_current_admin)):
+async def list_users_admin(
+    response: Response,
+    limit: int = 200,
+    skip: int = 0,
+    sort_by: str = "email",
+    order: str = "asc",
+    current_admin: UserPublic = Depends(get_current_admin),
+):
+    if sort_by not in USER_OVERVIEW_SORT_FIELDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"sort_by must be one of: {', '.join(sorted(USER_OVERVIEW_SORT_FIELDS))}",
+        )
     db = get_database()
-    overview = await fetch_user_overview(db)
+    overview, total = await fetch_user_overview(
+        db,
+        limit=min(max(limit, 1), 500),
+        skip=max(skip, 0),
+        sort_by=sort_by,
+        descending=order.lower() == "desc",
+    )
+    response.headers["X-Total-Count"] = str(total)
     return [AdminUserSummary(**item) for item in overview]
 
 
@@ -80,6 +105,49 @@ async def get_admin_stats(current_admin: UserPublic = Depends(get_current_admin)
     return AdminStats(**stats)
 
 
+@router.get("/stats/daily", response_model=List[AdminDailyStats])
+async def get_admin_daily_stats(
+    days: int = 30,
+    current_admin: UserPublic = Depends(get_current_admin),
+):
+    db = get_database()
+    series = await fetch_daily_stats(db, days=min(max(days, 1), 365))
+    return [AdminDailyStats(**bucket) for bucket in series]
+
+
+@router.post("/stats/reconcile", response_model=AdminStats)
+async def reconcile_admin_stats(current_admin: UserPublic = Depends(get_current_admin)):
+    """Đếm lại bộ đếm ngay (không chờ job định kỳ)."""
+    db = get_database()
+    await reconcile_system_stats(db)
+    stats = await fetch_system_stats(db)
+    return AdminStats(**stats)
+
+
+@router.post("/documents/sweep")
+async def sweep_documents(current_admin: UserPublic = Depends(get_current_admin)):
+    """Purge tài liệu đang chờ xóa + dọn chunks/embeddings/file index mồ côi ngay."""
+    return await document_cleanup_service.sweep(get_database())
+
+
+@router.get("/metrics/rag")
+async def get_rag_metrics(current_admin: UserPublic = Depends(get_current_admin)):
+    """Thời gian từng stage của RAG pipeline (cộng dồn từ lúc process khởi động)."""
+    return pipeline_metrics.snapshot()
+
+
+@router.get("/metrics/auth")
+async def get_auth_metrics(current_admin: UserPublic = Depends(get_current_admin)):
+    """Thời gian chờ queue / thời gian hash của password hash pool."""
+    return password_hash_pool.snapshot()
+
+
+@router.get("/metrics/quiz-parser")
+async def get_quiz_parser_metrics(current_admin: UserPublic = Depends(get_current_admin)):
+    """Số response quiz đã parse, block lỗi và số lần gọi lại LLM do parse hỏng."""
+    return quiz_parse_metrics.snapshot()
+
+
 class UserCreateRequest(BaseModel):
     email: str
     password: str
@@ -114,7 +182,7 @@ async def create_user_admin(
     user = await create_user(
         db,
         payload.email,
-        hash_password(payload.password),
+        await hash_password_async(payload.password),
         payload.full_name,
         is_admin=payload.is_admin,
     )
@@ -165,7 +233,7 @@ async def update_user_admin(
     if payload.email is not None:
         update_data["email"] = payload.email
     if payload.password is not None:
-        update_data["hashed_password"] = hash_password(payload.password)
+        update_data["hashed_password"] = await hash_password_async(payload.password)
     if payload.full_name is not None:
         update_data["full_name"] = payload.full_name
     if payload.is_admin is not None:
@@ -185,6 +253,7 @@ async def update_user_admin(
         {"_id": oid},
         {"$set": update_data}
     )
+    invalidate_user(user_id)
     
     # Fetch updated user
     updated_user = await get_user_by_id(db, user_id)
@@ -242,6 +311,8 @@ async def delete_user_admin(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to delete user"
         )
+    invalidate_user(user_id)
+    await record_stats(db, users=-1)
     
     return {"message": "User deleted successfully"}
 
@@ -1,15 +1,15 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import BaseModel, EmailStr
 
+from ..core.auth import get_current_user
 from ..core.config import settings
 from ..core.database import get_database
-from ..core.security import hash_password, verify_password, create_access_token, decode_token
-from ..models.user import UserInCreate, UserPublic, get_user_by_email, create_user, get_user_by_id
+from ..core.security import hash_password_async, verify_password_async, create_access_token
+from ..models.user import UserInCreate, UserPublic, get_user_by_email, create_user
 
 
 router = APIRouter()
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 
 class Token(BaseModel):
@@ -46,7 +46,7 @@ async def register(payload: UserInCreate):
         user = await create_user(
             db,
             payload.email,
-            hash_password(payload.password),
+            await hash_password_async(payload.password),
             payload.full_name,
             is_admin=is_admin,
         )
@@ -62,7 +62,7 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
         user = await get_user_by_email(db, form_data.username)
     except Exception as exc:
         raise _db_unavailable_http_exc(exc) from exc
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    if not user or not await verify_password_async(form_data.password, user.hashed_password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
     token = create_access_token(user.id)
     return Token(access_token=token, is_admin=user.is_admin)
@@ -75,26 +75,12 @@ async def login_json(payload: LoginJSON):
         user = await get_user_by_email(db, payload.email)
     except Exception as exc:
         raise _db_unavailable_http_exc(exc) from exc
-    if not user or not verify_password(payload.password, user.hashed_password):
+    if not user or not await verify_password_async(payload.password, user.hashed_password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
     token = create_access_token(user.id)
     return Token(access_token=token, is_admin=user.is_admin)
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserPublic:
-    payload = decode_token(token)
-    if not payload or "sub" not in payload:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-    db = get_database()
-    try:
-        user = await get_user_by_id(db, payload["sub"])  # fetch real user
-    except Exception as exc:
-        raise _db_unavailable_http_exc(exc) from exc
-    if not user:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-    return UserPublic(id=user.id, email=user.email, full_name=user.full_name, is_admin=user.is_admin)
-
-
 @router.get("/me", response_model=UserPublic)
 async def me(current_user: UserPublic = Depends(get_current_user)):
     return current_user
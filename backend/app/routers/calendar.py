@@ -6,37 +6,17 @@ from urllib.parse import quote_plus
 
 from fastapi import APIRouter, Depends, HTTPException, Query, status
 from fastapi.responses import RedirectResponse
-from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel, Field
 from pydantic.functional_validators import field_validator
 
+from ..core.auth import get_current_user
 from ..core.config import settings
 from ..core.database import get_database
-from ..core.security import decode_token
 from ..models.user import UserPublic, get_user_by_id
 from ..services.calendar_service import CalendarService, CalendarServiceError
 
 router = APIRouter()
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
-
-
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserPublic:
-    payload = decode_token(token)
-    if not payload or "sub" not in payload:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-    db = get_database()
-    user = await get_user_by_id(db, payload["sub"])
-    if not user:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-    return UserPublic(
-        id=user.id,
-        email=user.email,
-        full_name=user.full_name,
-        is_admin=user.is_admin,
-    )
-
-
 class ReminderSetting(BaseModel):
     method: str
     minutes: int = Field(ge=0, le=40320)  # up to 4 weeks
@@ -69,6 +49,10 @@ class CalendarEventPayload(BaseModel):
         return end_value
 
 
+class CalendarEventBatchPayload(BaseModel):
+    events: list[CalendarEventPayload] = Field(min_length=1, max_length=500)
+
+
 @router.get("/connect")
 async def start_calendar_connect(current_user: UserPublic = Depends(get_current_user)):
     db = get_database()
@@ -154,10 +138,42 @@ async def create_calendar_event(
     return result
 
 
+@router.post("/events/batch")
+async def create_calendar_events_batch(
+    payload: CalendarEventBatchPayload,
+    current_user: UserPublic = Depends(get_current_user),
+):
+    """Tạo nhiều event (vd. cả lịch ôn tập) bằng batch request của Google."""
+    db = get_database()
+    service = CalendarService(db)
+    try:
+        result = await service.create_events_batch(
+            user_id=current_user.id,
+            events=[
+                {
+                    "summary": event.summary,
+                    "start_dt": event.start,
+                    "end_dt": event.end,
+                    "timezone": event.timezone,
+                    "description": event.description,
+                    "reminders": [rem.model_dump() for rem in event.reminders] if event.reminders else None,
+                    "event_type": event.event_type,
+                    "question_id": event.question_id,
+                    "document_ids": event.document_ids,
+                }
+                for event in payload.events
+            ],
+        )
+    except CalendarServiceError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
+    return result
+
+
 @router.get("/events")
 async def list_calendar_events(
     max_results: int = Query(default=10, ge=1, le=50),
     time_min: Optional[datetime] = Query(default=None),
+    refresh: bool = Query(default=False),
     current_user: UserPublic = Depends(get_current_user),
 ):
     db = get_database()
@@ -167,6 +183,7 @@ async def list_calendar_events(
             user_id=current_user.id,
             max_results=max_results,
             time_min=time_min,
+            refresh=refresh,
         )
     except CalendarServiceError as exc:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
@@ -1,49 +1,81 @@
-import os
-import shutil
-from typing import List
+import asyncio
+from typing import Dict, List, Optional, Tuple
 
 from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
-from fastapi.security import OAuth2PasswordBearer
+from pydantic import BaseModel
 
-from ..core.database import get_database, get_faiss_index_path
+from ..core.auth import get_current_user
 from ..core.config import settings
-from ..core.security import decode_token
-from ..models.user import get_user_by_id, UserPublic
+from ..core.database import get_database, get_bm25_index_path
+from ..models.user import UserPublic
 from ..models.document import (
     DocumentPublic,
     DocumentDetail,
+    DocumentInDB,
+    clone_document,
     create_document,
+    find_document_by_hash,
     get_document_by_id,
     get_documents_by_user,
-    delete_document as db_delete_document,
+    tombstone_document,
     get_chunks_by_document,
     save_chunks,
+    save_chunks_bulk,
 )
+from ..services.document_cleanup import document_cleanup_service
 from ..services.embedding import EmbeddingService
-from ..services.parser import parse_file, split_text, get_file_type_from_filename
+from ..services.lexical import BM25Index, save_bm25_index
+from ..services.parser import (
+    parse_file,
+    split_text,
+    build_section_index,
+    get_file_type_from_filename,
+)
+from ..services.question_bank import question_bank_service
+from ..services.uploads import UploadTooLargeError, max_batch_upload_bytes, max_upload_bytes, save_upload
 
 router = APIRouter()
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
+def to_document_public(document: DocumentInDB) -> DocumentPublic:
+    return DocumentPublic(
+        id=document.id,
+        user_id=document.user_id,
+        filename=document.filename,
+        file_type=document.file_type,
+        file_size=document.file_size,
+        upload_date=document.upload_date,
+        chunk_count=document.chunk_count,
+        content_preview=document.content_preview,
+        is_embedded=document.is_embedded,
+        embedded_at=document.embedded_at,
+        embedding_model=document.embedding_model,
+        embedding_dimension=document.embedding_dimension,
+        faiss_namespace=document.faiss_namespace,
+    )
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserPublic:
-    """Lấy user hiện tại từ JWT token."""
-    payload = decode_token(token)
-    if not payload or "sub" not in payload:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-    db = get_database()
-    user = await get_user_by_id(db, payload["sub"])
-    if not user:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-    return UserPublic(id=user.id, email=user.email, full_name=user.full_name)
+def prepare_chunks(file_path: str, file_type: str) -> Tuple[List[dict], List[dict], Optional[str]]:
+    """Parse file → (chunks, section_index, content_preview)."""
+    # Parse nội dung file - trả về list chunks với metadata
+    parsed_chunks = parse_file(file_path, file_type)
+    
+    # Chia nhỏ thành chunks (nếu cần) - giữ metadata
+    # Tăng chunk_size lên 800 để giữ nguyên page content tốt hơn, chỉ chia khi thực sự cần
+    chunks = split_text(parsed_chunks, chunk_size=800, chunk_overlap=100)
+
+    # Dựng section/TOC index 1 lần để RAG tra cứu trực tiếp (không scan lại chunks)
+    section_index = build_section_index(chunks)
+    
+    # Lấy preview từ chunks đầu tiên
+    content_preview = None
+    if chunks and chunks[0].get("content"):
+        content_preview = chunks[0]["content"][:200]
+    return chunks, section_index, content_preview
 
 
-def ensure_upload_dir(user_id: str) -> str:
-    """Tạo thư mục upload cho user nếu chưa có."""
-    user_dir = os.path.join(settings.upload_dir, user_id)
-    os.makedirs(user_dir, exist_ok=True)
-    return user_dir
+def build_bm25_index(chunks: List[dict], path: str) -> None:
+    """Dựng + lưu BM25 index (CPU, gọi qua asyncio.to_thread)."""
+    save_bm25_index(BM25Index.build(chunks), path)
 
 
 @router.post("/upload", response_model=DocumentPublic, status_code=status.HTTP_201_CREATED)
@@ -62,28 +94,26 @@ async def upload_document(
     
     db = get_database()
     
-    # Tạo thư mục cho user
-    user_dir = ensure_upload_dir(current_user.id)
-    
-    # Lưu file tạm
-    file_path = os.path.join(user_dir, file.filename)
-    with open(file_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    # Ghi file theo khối (async, giới hạn dung lượng), tính sha256 trong lúc ghi
+    try:
+        stored = await save_upload(file)
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    file_path = stored.path
+    file_size = stored.size
+    content_hash = stored.content_hash
+    embedding_service = EmbeddingService()
     
-    file_size = os.path.getsize(file_path)
+    # Cùng nội dung đã được xử lý (kể cả của user khác) → dùng lại chunks + index, bỏ qua parse/embed
+    source = await find_document_by_hash(db, content_hash, embedding_service.model)
+    if source is not None:
+        document = await clone_document(db, source, current_user.id, file.filename)
+        question_bank_service.schedule_fill(db, current_user.id, document.id)
+        return to_document_public(document)
     
     try:
-        # Parse nội dung file - trả về list chunks với metadata
-        parsed_chunks = parse_file(file_path, file_type)
-        
-        # Chia nhỏ thành chunks (nếu cần) - giữ metadata
-        # Tăng chunk_size lên 800 để giữ nguyên page content tốt hơn, chỉ chia khi thực sự cần
-        chunks = split_text(parsed_chunks, chunk_size=800, chunk_overlap=100)
-        
-        # Lấy preview từ chunks đầu tiên
-        content_preview = None
-        if chunks and chunks[0].get("content"):
-            content_preview = chunks[0]["content"][:200]
+        # Parse + chia chunks trong thread (CPU) để không chặn event loop
+        chunks, section_index, content_preview = await asyncio.to_thread(prepare_chunks, file_path, file_type)
         
         # Lưu document vào DB
         document = await create_document(
@@ -95,13 +125,21 @@ async def upload_document(
             file_size=file_size,
             chunk_count=len(chunks),
             content_preview=content_preview,
+            section_index=section_index,
+            content_hash=content_hash,
         )
 
         # Lưu chunks vào DB
         saved_chunks = await save_chunks(db, document.id, chunks)
 
+        # BM25 index (lexical) lưu cạnh FAISS index - bắt các truy vấn khớp chính xác
+        namespace = document.faiss_namespace or f"user_{document.user_id}_doc_{document.id}"
+        try:
+            await asyncio.to_thread(build_bm25_index, saved_chunks, get_bm25_index_path(namespace))
+        except Exception as exc:
+            print(f"[bm25] failed for document {document.id}: {exc}")
+
         # Sinh embedding cho các chunks (nếu không có nội dung sẽ đánh dấu embedded = False)
-        embedding_service = EmbeddingService()
         try:
             await embedding_service.embed_document_chunks(
                 db=db,
@@ -115,57 +153,175 @@ async def upload_document(
         except Exception as exc:
             print(f"[embedding] failed for document {document.id}: {exc}")
 
-        return DocumentPublic(
-            id=document.id,
-            user_id=document.user_id,
-            filename=document.filename,
-            file_type=document.file_type,
-            file_size=document.file_size,
-            upload_date=document.upload_date,
-            chunk_count=document.chunk_count,
-            content_preview=document.content_preview,
-            is_embedded=document.is_embedded,
-            embedded_at=document.embedded_at,
-            embedding_model=document.embedding_model,
-            embedding_dimension=document.embedding_dimension,
-            faiss_namespace=document.faiss_namespace,
-        )
+        # Sinh sẵn ngân hàng câu hỏi quiz (chạy nền, không chờ)
+        question_bank_service.schedule_fill(db, current_user.id, document.id)
+
+        return to_document_public(document)
+    # File upload không còn document nào dùng → sweeper xóa sau (có thể đang dùng chung)
     except ValueError as e:
-        # Xóa file nếu parse lỗi
-        if os.path.exists(file_path):
-            os.remove(file_path)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
-        # Xóa file nếu có lỗi
-        if os.path.exists(file_path):
-            os.remove(file_path)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error processing file: {str(e)}",
         )
 
 
+class BatchUploadItem(BaseModel):
+    filename: str
+    status: str  # "created" | "duplicate" | "embedding_failed" | "failed"
+    document: Optional[DocumentPublic] = None
+    error: Optional[str] = None
+
+
+@router.post("/upload/batch", response_model=List[BatchUploadItem])
+async def upload_documents_batch(
+    files: List[UploadFile] = File(...),
+    current_user: UserPublic = Depends(get_current_user),
+):
+    """Upload nhiều tài liệu trong 1 request, trả về trạng thái từng file.
+
+    Các file được parse song song (UPLOAD_PARSE_WORKERS thread), chunks của cả lô
+    lưu bằng 1 insert_many và embed chung (batch đầy thay vì mỗi file 1 lượt).
+    File trùng nội dung (với tài liệu đã có hoặc file khác trong lô) được clone.
+    """
+    if len(files) > settings.upload_batch_max_files:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Tối đa {settings.upload_batch_max_files} file mỗi lần upload",
+        )
+    db = get_database()
+    embedding_service = EmbeddingService()
+    results: List[BatchUploadItem] = [BatchUploadItem(filename=f.filename or "", status="failed") for f in files]
+    
+    # 1. Lưu file (giới hạn dung lượng từng file và tổng cả lô, tính hash)
+    stored: Dict[int, tuple] = {}
+    remaining = max_batch_upload_bytes()
+    for i, file in enumerate(files):
+        file_type = get_file_type_from_filename(file.filename)
+        if file_type not in ["pdf", "docx", "md", "txt"]:
+            results[i].error = "Unsupported file type. Allowed: PDF, DOCX, MD, TXT"
+            continue
+        try:
+            upload = await save_upload(file, max_bytes=min(max_upload_bytes(), remaining))
+        except UploadTooLargeError as e:
+            # Giới hạn bị thu nhỏ vì tổng cả lô → báo theo giới hạn của lô
+            batch_limited = e.max_bytes < max_upload_bytes()
+            results[i].error = str(UploadTooLargeError(max_batch_upload_bytes()) if batch_limited else e)
+            continue
+        remaining -= upload.size
+        stored[i] = (upload, file_type)
+    
+    # 2. Trùng nội dung: với tài liệu đã xử lý → clone ngay; trong lô → chỉ xử lý file đầu tiên
+    to_process: Dict[int, tuple] = {}
+    first_by_hash: Dict[str, int] = {}
+    in_batch_duplicates: Dict[int, int] = {}
+    for i, (upload, file_type) in stored.items():
+        if upload.content_hash in first_by_hash:
+            in_batch_duplicates[i] = first_by_hash[upload.content_hash]
+            continue
+        source = await find_document_by_hash(db, upload.content_hash, embedding_service.model)
+        if source is not None:
+            document = await clone_document(db, source, current_user.id, files[i].filename)
+            question_bank_service.schedule_fill(db, current_user.id, document.id)
+            results[i] = BatchUploadItem(filename=files[i].filename, status="duplicate", document=to_document_public(document))
+            continue
+        first_by_hash[upload.content_hash] = i
+        to_process[i] = (upload, file_type)
+    
+    # 3. Parse song song trong thread pool (giới hạn số file parse cùng lúc)
+    semaphore = asyncio.Semaphore(max(settings.upload_parse_workers, 1))
+    
+    async def parse_one(i: int):
+        upload, file_type = to_process[i]
+        async with semaphore:
+            return await asyncio.to_thread(prepare_chunks, upload.path, file_type)
+    
+    order = list(to_process)
+    parsed = await asyncio.gather(*[parse_one(i) for i in order], return_exceptions=True)
+    
+    # 4. Tạo documents, lưu chunks của cả lô bằng 1 insert
+    created: List[tuple] = []
+    for i, outcome in zip(order, parsed):
+        upload, file_type = to_process[i]
+        if isinstance(outcome, Exception):
+            results[i].error = str(outcome) if isinstance(outcome, ValueError) else f"Error processing file: {outcome}"
+            continue
+        chunks, section_index, content_preview = outcome
+        try:
+            document = await create_document(
+                db=db,
+                user_id=current_user.id,
+                filename=files[i].filename,
+                file_type=file_type,
+                file_path=upload.path,
+                file_size=upload.size,
+                chunk_count=len(chunks),
+                content_preview=content_preview,
+                section_index=section_index,
+                content_hash=upload.content_hash,
+            )
+        except Exception as exc:
+            # Lỗi DB của 1 file chỉ làm hỏng file đó, không cả lô
+            results[i].error = f"Error saving document: {exc}"
+            continue
+        created.append((i, document, chunks))
+    saved_chunks = await save_chunks_bulk(db, [(document.id, chunks) for _, document, chunks in created])
+    
+    # 5. BM25 từng tài liệu + embed chung cả lô
+    for (_, document, _), chunks in zip(created, saved_chunks):
+        namespace = document.faiss_namespace or f"user_{document.user_id}_doc_{document.id}"
+        try:
+            await asyncio.to_thread(build_bm25_index, chunks, get_bm25_index_path(namespace))
+        except Exception as exc:
+            print(f"[bm25] failed for document {document.id}: {exc}")
+    embedding_error: Optional[str] = None
+    try:
+        await embedding_service.embed_documents_chunks(
+            db,
+            [(current_user.id, document, chunks) for (_, document, _), chunks in zip(created, saved_chunks)],
+        )
+    except Exception as exc:
+        print(f"[embedding] batch failed for {len(created)} documents: {exc}")
+        embedding_error = f"Embedding failed: {exc}"
+    
+    for i, document, _ in created:
+        refreshed = await get_document_by_id(db, document.id)
+        document = refreshed or document
+        if embedding_error:
+            # Document đã lưu (chunks + BM25) nhưng chưa có vector → báo riêng, không tạo quiz bank
+            results[i] = BatchUploadItem(
+                filename=files[i].filename,
+                status="embedding_failed",
+                document=to_document_public(document),
+                error=embedding_error,
+            )
+            continue
+        results[i] = BatchUploadItem(filename=files[i].filename, status="created", document=to_document_public(document))
+        question_bank_service.schedule_fill(db, current_user.id, document.id)
+    
+    # 6. File trùng với file khác trong lô → clone bản vừa xử lý
+    for i, first in in_batch_duplicates.items():
+        upload, _ = stored[i]
+        source_item = results[first]
+        if source_item.status != "created":
+            results[i].error = source_item.error or "Duplicate of a file that failed to process"
+            continue
+        source = await get_document_by_id(db, source_item.document.id)
+        document = await clone_document(db, source, current_user.id, files[i].filename)
+        question_bank_service.schedule_fill(db, current_user.id, document.id)
+        results[i] = BatchUploadItem(filename=files[i].filename, status="duplicate", document=to_document_public(document))
+    
+    return results
+
+
 @router.get("/", response_model=List[DocumentPublic])
 async def list_documents(current_user: UserPublic = Depends(get_current_user)):
     """Lấy danh sách tài liệu của user hiện tại."""
     db = get_database()
     documents = await get_documents_by_user(db, current_user.id)
     return [
-        DocumentPublic(
-            id=doc.id,
-            user_id=doc.user_id,
-            filename=doc.filename,
-            file_type=doc.file_type,
-            file_size=doc.file_size,
-            upload_date=doc.upload_date,
-            chunk_count=doc.chunk_count,
-            content_preview=doc.content_preview,
-            is_embedded=doc.is_embedded,
-            embedded_at=doc.embedded_at,
-            embedding_model=doc.embedding_model,
-            embedding_dimension=doc.embedding_dimension,
-            faiss_namespace=doc.faiss_namespace,
-        )
+        to_document_public(doc)
         for doc in documents
     ]
 
@@ -222,26 +378,9 @@ async def delete_document(
     if document.user_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
     
-    # Xóa file trên disk
-    if os.path.exists(document.file_path):
-        try:
-            os.remove(document.file_path)
-        except Exception:
-            pass  # Bỏ qua nếu không xóa được
-    
-    # Xóa metadata embedding
-    await db["embeddings"].delete_many({"document_id": document_id})
-
-    # Xóa FAISS index file
-    namespace = document.faiss_namespace or f"user_{document.user_id}_doc_{document.id}"
-    index_path = get_faiss_index_path(namespace)
-    if os.path.exists(index_path):
-        try:
-            os.remove(index_path)
-        except Exception:
-            pass
-
-    # Xóa trong DB
-    await db_delete_document(db, document_id)
+    # Tombstone ngay (RAG / danh sách bỏ qua), xóa dữ liệu liên quan chạy nền
+    tombstoned = await tombstone_document(db, document_id)
+    if tombstoned:
+        document_cleanup_service.schedule_purge(db, tombstoned)
     
     return None
@@ -1,13 +1,15 @@
 from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.security import OAuth2PasswordBearer
+from fastapi import APIRouter, Depends, HTTPException, Response, status
 
+from ..core.auth import get_current_user
 from ..core.database import get_database
-from ..core.security import decode_token
-from ..models.user import get_user_by_id, UserPublic
+from ..models.user import UserPublic
 from ..models.history import (
+    ConversationSummary,
     HistoryPublic,
+    encode_cursor,
+    list_conversations_by_user,
     list_history_by_user,
     delete_history_record,
     clear_history_for_document,
@@ -18,33 +20,32 @@ from ..models.history import (
 
 router = APIRouter()
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
-
-
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserPublic:
-    payload = decode_token(token)
-    if not payload or "sub" not in payload:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-    db = get_database()
-    user = await get_user_by_id(db, payload["sub"])
-    if not user:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-    return UserPublic(id=user.id, email=user.email, full_name=user.full_name)
-
-
 @router.get("/", response_model=List[HistoryPublic])
 async def list_history(
+    response: Response,
     limit: int = 20,
     document_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    summary: bool = False,
     current_user: UserPublic = Depends(get_current_user),
 ):
+    """Trang history mới nhất trước.
+
+    Trang tiếp theo: gửi lại giá trị header ``X-Next-Cursor`` qua ``cursor``.
+    ``summary=true`` bỏ answer/references (cho sidebar).
+    """
     db = get_database()
+    limit = min(max(limit, 1), 100)
     records = await list_history_by_user(
         db,
         user_id=current_user.id,
-        limit=min(max(limit, 1), 100),
+        limit=limit,
         document_id=document_id,
+        cursor=cursor,
+        summary=summary,
     )
+    if len(records) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(records[-1].created_at, records[-1].id)
     return [
         HistoryPublic(
             id=record.id,
@@ -60,6 +61,25 @@ async def list_history(
     ]
 
 
+@router.get("/conversations", response_model=List[ConversationSummary])
+async def list_conversations(
+    response: Response,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    current_user: UserPublic = Depends(get_current_user),
+):
+    """1 dòng tóm tắt cho mỗi conversation (mới hoạt động nhất trước)."""
+    db = get_database()
+    limit = min(max(limit, 1), 100)
+    conversations = await list_conversations_by_user(
+        db, user_id=current_user.id, limit=limit, cursor=cursor
+    )
+    if len(conversations) == limit:
+        last = conversations[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last.last_activity_at, last.conversation_id)
+    return conversations
+
+
 # IMPORTANT: Define specific routes BEFORE parameterized routes to avoid conflicts
 # Route /all must be defined before /{history_id} to avoid /all being matched as history_id
 
@@ -1,36 +1,22 @@
 from typing import List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel
 
+from ..core.auth import get_current_user
 from ..core.database import get_database
-from ..core.security import decode_token
-from ..models.user import get_user_by_id, UserPublic
+from ..models.user import UserPublic
 from ..models.history import HistoryPublic, list_history_by_user, HistoryReference
 from ..services.rag import rag_service
 
 
 router = APIRouter()
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
-
-
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserPublic:
-    payload = decode_token(token)
-    if not payload or "sub" not in payload:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-    db = get_database()
-    user = await get_user_by_id(db, payload["sub"])
-    if not user:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-    return UserPublic(id=user.id, email=user.email, full_name=user.full_name)
-
-
 class AskRequest(BaseModel):
     question: str
     document_ids: Optional[List[str]] = None  # ← THAY ĐỔI: List thay vì single str
     conversation_id: Optional[str] = None
+    debug: bool = False  # True → trả thêm thời gian từng stage trong metadata
     
     # BACKWARD COMPATIBILITY: Vẫn accept document_id (single) cho old clients
     document_id: Optional[str] = None
@@ -53,6 +39,7 @@ class AskResponse(BaseModel):
     documents_searched: List[str]  # ← THÊM: IDs của documents đã search
     conversation_id: Optional[str] = None
     history_id: Optional[str] = None
+    metadata: Optional[dict] = None  # Chỉ có khi bật debug
 
 
 @router.post("/ask", response_model=AskResponse)
@@ -90,6 +77,7 @@ async def ask_question(payload: AskRequest, current_user: UserPublic = Depends(g
             question=payload.question,
             document_ids=document_ids_to_use,  # ← THAY ĐỔI: Pass list
             conversation_id=payload.conversation_id,
+            debug=payload.debug,
         )
     except ValueError as exc:
         # ValueError from RAG service (e.g., document not found)
@@ -114,9 +102,62 @@ async def ask_question(payload: AskRequest, current_user: UserPublic = Depends(g
         documents_searched=result.get("documents_searched", document_ids_to_use),  # ← THÊM
         conversation_id=result.get("conversation_id"),
         history_id=result.get("history_id"),
+        # metadata chỉ trả khi pipeline trace được bật (debug=True hoặc RAG_DEBUG_METRICS)
+        metadata=result.get("metadata") if "pipeline" in (result.get("metadata") or {}) else None,
     )
 
 
+class SearchRequest(BaseModel):
+    question: str
+    document_ids: Optional[List[str]] = None  # None = tìm trong tất cả tài liệu
+    offset: int = 0
+    limit: int = 10
+
+
+class SearchResult(BaseModel):
+    document_id: Optional[str] = None
+    document_filename: Optional[str] = None
+    document_type: Optional[str] = None
+    chunk_index: Optional[int] = None
+    page_number: Optional[int] = None
+    section: Optional[str] = None
+    heading: Optional[str] = None
+    content: str
+    score: float
+    vector_similarity: float
+    bm25_score: Optional[float] = None
+
+
+class SearchResponse(BaseModel):
+    results: List[SearchResult]
+    total: int
+    offset: int
+    limit: int
+    query_type: str
+
+
+@router.post("/search", response_model=SearchResponse)
+async def search_chunks(payload: SearchRequest, current_user: UserPublic = Depends(get_current_user)):
+    """Chỉ retrieval + re-rank: trả về chunks đã chấm điểm, KHÔNG gọi LLM và không ghi history."""
+    if not payload.question.strip():
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Câu hỏi không được để trống")
+
+    db = get_database()
+    try:
+        result = await rag_service.search(
+            db=db,
+            user_id=current_user.id,
+            question=payload.question,
+            document_ids=payload.document_ids,
+            offset=max(payload.offset, 0),
+            limit=min(max(payload.limit, 1), 50),
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(exc))
+
+    return SearchResponse(**result)
+
+
 @router.get("/history", response_model=List[HistoryPublic])
 async def get_history(
     document_id: Optional[str] = None,
@@ -1,11 +1,13 @@
+import json
 from typing import List, Optional
 from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.security import OAuth2PasswordBearer
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
+from ..core.auth import get_current_user
 from ..core.database import get_database
-from ..core.security import decode_token
-from ..models.user import get_user_by_id, UserPublic
+from ..models.user import UserPublic
+from ..models.document import get_document_by_id
 from ..models.quiz import (
     QuizQuestion,
     QuizPublic,
@@ -16,30 +18,20 @@ from ..models.quiz import (
     list_quizzes_by_user,
     delete_quiz,
     create_quiz_attempt,
+    grade_quiz_answers,
     list_quiz_attempts_by_user,
 )
+from ..models.quiz_analytics import (
+    delete_quiz_question_stats,
+    get_quiz_question_stats,
+    get_weak_topics,
+    record_attempt_outcomes,
+)
+from ..services.question_bank import question_bank_service
 from ..services.quiz_generator import quiz_generator_service
 
 
 router = APIRouter()
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
-
-
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserPublic:
-    payload = decode_token(token)
-    if not payload or "sub" not in payload:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token"
-        )
-    db = get_database()
-    user = await get_user_by_id(db, payload["sub"])
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found"
-        )
-    return UserPublic(id=user.id, email=user.email, full_name=user.full_name)
-
-
 class GenerateQuizRequest(BaseModel):
     document_id: str
     num_questions: int = 5
@@ -54,6 +46,25 @@ class SubmitQuizRequest(BaseModel):
     time_taken: Optional[int] = None
 
 
+def validate_generate_request(payload: GenerateQuizRequest) -> None:
+    # Validate inputs - số câu hỏi phải từ 5-20
+    if payload.num_questions < 5 or payload.num_questions > 20:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Số câu hỏi phải từ 5 đến 20 câu"
+        )
+    
+    if payload.difficulty not in ["easy", "medium", "hard"]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Độ khó phải là 'easy', 'medium', hoặc 'hard'"
+        )
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
 @router.post("/generate", response_model=QuizPublic)
 async def generate_quiz(
     payload: GenerateQuizRequest,
@@ -63,28 +74,26 @@ async def generate_quiz(
     db = get_database()
     
     try:
-        # Validate inputs - số câu hỏi phải từ 5-20
-        if payload.num_questions < 5 or payload.num_questions > 20:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Số câu hỏi phải từ 5 đến 20 câu"
-            )
+        validate_generate_request(payload)
         
-        if payload.difficulty not in ["easy", "medium", "hard"]:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Độ khó phải là 'easy', 'medium', hoặc 'hard'"
-            )
-        
-        # Generate questions using AI
-        questions = await quiz_generator_service.generate_quiz(
-            db=db,
+        # Lấy từ ngân hàng câu hỏi sinh sẵn; chưa đủ câu → sinh trực tiếp bằng AI
+        questions = await question_bank_service.draw(
+            db,
             user_id=current_user.id,
             document_id=payload.document_id,
             num_questions=payload.num_questions,
             difficulty=payload.difficulty,
             question_types=payload.question_types,
         )
+        if questions is None:
+            questions = await quiz_generator_service.generate_quiz(
+                db=db,
+                user_id=current_user.id,
+                document_id=payload.document_id,
+                num_questions=payload.num_questions,
+                difficulty=payload.difficulty,
+                question_types=payload.question_types,
+            )
         
         if not questions:
             raise HTTPException(
@@ -116,7 +125,6 @@ async def generate_quiz(
             print(f"[Quiz Router] ⚠️ Limited questions to {payload.num_questions} (was {original_count})")
         
         # Get document info
-        from ..models.document import get_document_by_id
         doc = await get_document_by_id(db, payload.document_id)
         if not doc:
             raise HTTPException(
@@ -165,6 +173,91 @@ async def generate_quiz(
         )
 
 
+@router.post("/generate/stream")
+async def generate_quiz_stream(
+    payload: GenerateQuizRequest,
+    current_user: UserPublic = Depends(get_current_user),
+):
+    """Generate quiz như /generate nhưng trả về Server-Sent Events.
+    
+    - ``question``: {"index", "question"} - mỗi câu ngay khi LLM viết xong
+    - ``done``: quiz đã lưu (QuizPublic)
+    - ``error``: {"detail"}
+    """
+    validate_generate_request(payload)
+    db = get_database()
+    
+    doc = await get_document_by_id(db, payload.document_id)
+    if not doc or doc.user_id != current_user.id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Document not found"
+        )
+    
+    async def events():
+        questions: List[QuizQuestion] = []
+        try:
+            # Ngân hàng câu hỏi có sẵn → gửi hết ngay; chưa đủ → stream từ LLM
+            drawn = await question_bank_service.draw(
+                db,
+                user_id=current_user.id,
+                document_id=payload.document_id,
+                num_questions=payload.num_questions,
+                difficulty=payload.difficulty,
+                question_types=payload.question_types,
+            )
+            if drawn is not None:
+                for question in drawn:
+                    questions.append(question)
+                    yield sse_event("question", {"index": len(questions) - 1, "question": question.model_dump()})
+            else:
+                async for question in quiz_generator_service.stream_quiz(
+                    db=db,
+                    user_id=current_user.id,
+                    document_id=payload.document_id,
+                    num_questions=payload.num_questions,
+                    difficulty=payload.difficulty,
+                    question_types=payload.question_types,
+                ):
+                    questions.append(question)
+                    yield sse_event("question", {"index": len(questions) - 1, "question": question.model_dump()})
+            
+            if not questions:
+                yield sse_event("error", {"detail": "AI không tạo được câu hỏi nào. Vui lòng thử lại hoặc chọn tài liệu khác."})
+                return
+            
+            quiz = await create_quiz(
+                db=db,
+                user_id=current_user.id,
+                document_id=payload.document_id,
+                document_filename=doc.filename,
+                title=f"Quiz: {doc.filename}",
+                questions=questions,
+                difficulty=payload.difficulty,
+            )
+            yield sse_event("done", QuizPublic(
+                id=quiz.id,
+                user_id=quiz.user_id,
+                document_id=quiz.document_id,
+                document_filename=quiz.document_filename,
+                title=quiz.title,
+                questions=quiz.questions,
+                total_questions=quiz.total_questions,
+                difficulty=quiz.difficulty,
+                created_at=quiz.created_at,
+            ).model_dump())
+        except Exception as e:
+            print(f"[Quiz] Error streaming quiz: {e}")
+            yield sse_event("error", {"detail": f"Lỗi khi tạo quiz: {str(e)}"})
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Tắt buffer của proxy (nginx) để từng event tới client ngay
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.get("/", response_model=List[QuizPublic])
 async def list_quizzes(
     document_id: Optional[str] = None,
@@ -249,6 +342,7 @@ async def delete_quiz_endpoint(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Quiz not found"
         )
+    await delete_quiz_question_stats(db, quiz_id)
     
     return None
 
@@ -269,8 +363,9 @@ async def submit_quiz(
             detail="Quiz not found"
         )
     
-    # Calculate score
-    score = sum(1 for answer in payload.answers if answer.is_correct)
+    # Chấm theo đáp án đã lưu trong quiz (không tin is_correct client gửi lên)
+    graded = grade_quiz_answers(quiz.questions, payload.answers)
+    score = sum(1 for answer in graded if answer.is_correct)
     
     # Save attempt
     attempt = await create_quiz_attempt(
@@ -278,10 +373,19 @@ async def submit_quiz(
         user_id=current_user.id,
         quiz_id=payload.quiz_id,
         mode=payload.mode,
-        answers=payload.answers,
+        answers=graded,
         score=score,
         total_questions=quiz.total_questions,
         time_taken=payload.time_taken,
+        document_id=quiz.document_id,
+    )
+    # Chỉ tính câu đã trả lời vào thống kê (câu bỏ trống không nói lên chủ đề yếu)
+    await record_attempt_outcomes(
+        db,
+        user_id=current_user.id,
+        quiz_id=payload.quiz_id,
+        document_id=quiz.document_id,
+        answers=[answer for answer in graded if answer.user_answer.strip()],
     )
     
     return QuizAttemptPublic(
@@ -330,3 +434,39 @@ async def list_quiz_attempts(
         for a in attempts
     ]
 
+
+@router.get("/analytics/weak-topics")
+async def list_weak_topics(
+    document_id: Optional[str] = None,
+    min_attempts: int = 3,
+    limit: int = 10,
+    current_user: UserPublic = Depends(get_current_user),
+):
+    """Các section có tỉ lệ trả lời đúng thấp nhất của user"""
+    db = get_database()
+    
+    return await get_weak_topics(
+        db,
+        user_id=current_user.id,
+        document_id=document_id,
+        min_attempts=max(min_attempts, 1),
+        limit=min(max(limit, 1), 50),
+    )
+
+
+@router.get("/{quiz_id}/analytics")
+async def get_quiz_analytics(
+    quiz_id: str,
+    current_user: UserPublic = Depends(get_current_user),
+):
+    """Tỉ lệ đúng và thời gian trung bình của từng câu trong quiz"""
+    db = get_database()
+    
+    quiz = await get_quiz_by_id(db, quiz_id)
+    if not quiz or quiz.user_id != current_user.id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Quiz not found"
+        )
+    
+    return await get_quiz_question_stats(db, quiz_id)
@@ -1,41 +1,116 @@
 from __future__ import annotations
 
-from datetime import datetime, timedelta
-from typing import Any, Dict, List
+import asyncio
+from typing import Any, Dict, List, Tuple
 
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
+from ..core.logger import get_logger
+from ..models.stats import get_daily_stats, get_system_totals, reconcile_system_stats
+
+logger = get_logger("admin")
+
+
+# Cột cho phép sort trên trang admin (giá trị = field trong pipeline)
+USER_OVERVIEW_SORT_FIELDS = {
+    "email": "email",
+    "full_name": "full_name",
+    "is_admin": "is_admin",
+    "documents_count": "documents_count",
+    "histories_count": "histories_count",
+    "last_activity": "last_activity",
+}
+# Các cột có sẵn trên users → sort + phân trang trước $lookup (chỉ join cho 1 trang)
+_USER_FIELDS = {"email", "full_name", "is_admin"}
+
+
+def _user_overview_lookups() -> List[Dict[str, Any]]:
+    # documents/histories lưu user_id dạng string, users._id là ObjectId
+    return [
+        {
+            "$lookup": {
+                "from": "documents",
+                "let": {"uid": "$uid"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": ["$user_id", "$$uid"]}, "deleted_at": None}},
+                    {"$count": "n"},
+                ],
+                "as": "documents_stats",
+            }
+        },
+        {
+            "$lookup": {
+                "from": "histories",
+                "let": {"uid": "$uid"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": ["$user_id", "$$uid"]}}},
+                    {"$group": {"_id": None, "n": {"$sum": 1}, "last": {"$max": "$created_at"}}},
+                ],
+                "as": "histories_stats",
+            }
+        },
+        {
+            "$addFields": {
+                "documents_count": {"$ifNull": [{"$arrayElemAt": ["$documents_stats.n", 0]}, 0]},
+                "histories_count": {"$ifNull": [{"$arrayElemAt": ["$histories_stats.n", 0]}, 0]},
+                "last_activity": {"$arrayElemAt": ["$histories_stats.last", 0]},
+            }
+        },
+    ]
 
-async def fetch_user_overview(db: AsyncIOMotorDatabase, limit: int = 200) -> List[Dict[str, Any]]:
-    cursor = db["users"].find({}, {"email": 1, "full_name": 1, "is_admin": 1}).sort("email", 1)
-    users = await cursor.to_list(length=limit)
 
-    overview: List[Dict[str, Any]] = []
-    for user in users:
-        user_id = str(user.get("_id"))
-        documents_count = await db["documents"].count_documents({"user_id": user_id})
-        histories_count = await db["histories"].count_documents({"user_id": user_id})
-        last_history_doc = await db["histories"].find({"user_id": user_id}).sort("created_at", -1).limit(1).to_list(length=1)
-        last_history = last_history_doc[0]["created_at"] if last_history_doc else None
+async def fetch_user_overview(
+    db: AsyncIOMotorDatabase,
+    limit: int = 200,
+    skip: int = 0,
+    sort_by: str = "email",
+    descending: bool = False,
+) -> Tuple[List[Dict[str, Any]], int]:
+    """Danh sách user + số documents/histories + lần hỏi gần nhất.
+
+    1 aggregation ($facet: tổng số user + 1 trang) thay cho 3 query / user.
+    Trả về (rows, total).
+    """
+    sort_field = USER_OVERVIEW_SORT_FIELDS.get(sort_by, "email")
+    direction = -1 if descending else 1
+    # _id làm tie-breaker để phân trang ổn định khi giá trị sort trùng nhau
+    sort_stage = {"$sort": {sort_field: direction, "_id": direction}}
+    page_stages: List[Dict[str, Any]] = [{"$skip": max(skip, 0)}, {"$limit": max(limit, 1)}]
+
+    rows_pipeline: List[Dict[str, Any]] = []
+    if sort_field in _USER_FIELDS:
+        rows_pipeline += [sort_stage, *page_stages, *_user_overview_lookups()]
+    else:
+        rows_pipeline += [*_user_overview_lookups(), sort_stage, *page_stages]
 
+    pipeline = [
+        {"$project": {"email": 1, "full_name": 1, "is_admin": 1, "uid": {"$toString": "$_id"}}},
+        {"$facet": {"total": [{"$count": "n"}], "rows": rows_pipeline}},
+    ]
+    result = await db["users"].aggregate(pipeline).to_list(length=1)
+    facet = result[0] if result else {}
+    total = facet["total"][0]["n"] if facet.get("total") else 0
+
+    overview: List[Dict[str, Any]] = []
+    for user in facet.get("rows", []):
         overview.append(
             {
-                "id": user_id,
+                "id": user["uid"],
                 "email": user.get("email"),
                 "full_name": user.get("full_name"),
                 "is_admin": bool(user.get("is_admin", False)),
-                "documents_count": documents_count,
-                "histories_count": histories_count,
-                "last_activity": last_history,
+                "documents_count": user.get("documents_count", 0),
+                "histories_count": user.get("histories_count", 0),
+                "last_activity": user.get("last_activity"),
             }
         )
 
-    return overview
+    return overview, total
 
 
 async def fetch_document_overview(db: AsyncIOMotorDatabase, limit: int = 200) -> List[Dict[str, Any]]:
-    cursor = db["documents"].find().sort("upload_date", -1)
+    cursor = db["documents"].find({"deleted_at": None}).sort("upload_date", -1)
     documents = await cursor.to_list(length=limit)
 
     user_cache: Dict[str, Dict[str, Any]] = {}
@@ -80,31 +155,53 @@ async def fetch_document_overview(db: AsyncIOMotorDatabase, limit: int = 200) ->
 
 
 async def fetch_system_stats(db: AsyncIOMotorDatabase) -> Dict[str, Any]:
-    total_users = await db["users"].count_documents({})
-    total_documents = await db["documents"].count_documents({})
-    total_histories = await db["histories"].count_documents({})
-
-    total_storage = 0
-    async for doc in db["documents"].find({}, {"file_size": 1}):
-        total_storage += doc.get("file_size", 0)
-
-    seven_days_ago = datetime.utcnow() - timedelta(days=7)
-    recent_questions = await db["histories"].count_documents({"created_at": {"$gte": seven_days_ago}})
-
-    pipeline = [
-        {"$match": {"created_at": {"$gte": seven_days_ago}}},
-        {"$group": {"_id": "$user_id"}},
-        {"$count": "active_users"},
-    ]
-    agg_result = await db["histories"].aggregate(pipeline).to_list(length=1)
-    active_users = agg_result[0]["active_users"] if agg_result else 0
+    """Đọc bộ đếm materialized (models/stats.py) - không quét collection."""
+    totals = await get_system_totals(db)
+    # 7 bucket ngày UTC (hôm nay + 6 ngày trước), không phải 7×24h tính tới thời điểm hiện tại
+    last_week = await get_daily_stats(db, days=7)
+    active_users = set()
+    for bucket in last_week:
+        active_users.update(bucket["active_users"])
 
     return {
-        "total_users": total_users,
-        "total_documents": total_documents,
-        "total_histories": total_histories,
-        "recent_questions": recent_questions,
-        "active_users_7d": active_users,
-        "total_storage_bytes": total_storage,
+        "total_users": totals["total_users"],
+        "total_documents": totals["total_documents"],
+        "total_histories": totals["total_histories"],
+        "recent_questions": sum(bucket["questions"] for bucket in last_week),
+        "active_users_7d": len(active_users),
+        "total_storage_bytes": totals["total_storage_bytes"],
     }
 
+
+async def fetch_daily_stats(db: AsyncIOMotorDatabase, days: int = 30) -> List[Dict[str, Any]]:
+    """Chuỗi theo ngày cho biểu đồ: câu hỏi, upload, dung lượng lưu trữ cuối ngày."""
+    buckets = await get_daily_stats(db, days=days)
+    totals = await get_system_totals(db)
+    # Dung lượng cuối ngày: đi ngược từ tổng hiện tại, trừ lượng thay đổi của từng ngày
+    stored = totals["total_storage_bytes"]
+    series: List[Dict[str, Any]] = []
+    for bucket in reversed(buckets):
+        series.append(
+            {
+                "date": bucket["date"],
+                "questions": bucket["questions"],
+                "uploads": bucket["uploads"],
+                "active_users": len(bucket["active_users"]),
+                "bytes_uploaded": bucket["bytes_uploaded"],
+                "bytes_deleted": bucket["bytes_deleted"],
+                "bytes_stored": max(stored, 0),
+            }
+        )
+        stored -= bucket["bytes_uploaded"] - bucket["bytes_deleted"]
+    series.reverse()
+    return series
+
+
+async def run_stats_reconciler(db: AsyncIOMotorDatabase, interval_seconds: int) -> None:
+    """Định kỳ đếm lại tổng để sửa sai lệch của bộ đếm (chạy như background task)."""
+    while True:
+        try:
+            await reconcile_system_stats(db)
+        except Exception as exc:
+            logger.warning("⚠️ Stats reconciliation failed: %s", exc)
+        await asyncio.sleep(interval_seconds)
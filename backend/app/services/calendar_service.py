@@ -1,23 +1,39 @@
 from __future__ import annotations
 
+import asyncio
 import base64
+import copy
 import hashlib
 import json
 import secrets
-from datetime import datetime
-from typing import Any, Optional
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from typing import Any, Callable, Optional
 
+import httplib2
 from cryptography.fernet import Fernet
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
 
 from ..core.config import settings
+from ..core.logger import get_logger
 from ..models.calendar_event import (
+    CalendarEventInDB,
+    apply_google_event_changes,
+    clear_calendar_sync_state,
     delete_calendar_event,
+    delete_stale_calendar_events,
+    get_calendar_sync_state,
     list_calendar_events,
+    save_calendar_sync_state,
     upsert_calendar_event,
 )
 from ..models.user import (
@@ -27,6 +43,58 @@ from ..models.user import (
 )
 
 SCOPES = ["https://www.googleapis.com/auth/calendar.events"]
+# Google giới hạn 50 request / batch cho Calendar API
+BATCH_SIZE = 50
+
+logger = get_logger("calendar")
+
+# googleapiclient chạy HTTP đồng bộ → mọi lời gọi API chạy trên pool này
+_calendar_executor = ThreadPoolExecutor(
+    max_workers=settings.calendar_api_workers, thread_name_prefix="calendar-api"
+)
+_discovery_document: Optional[dict[str, Any]] = None
+_discovery_lock = threading.Lock()
+# user_id → (credentials, service); CalendarService tạo mới mỗi request nên cache ở module
+_client_cache: "OrderedDict[str, tuple[Credentials, Any]]" = OrderedDict()
+_CLIENT_CACHE_SIZE = 256
+# 1 lần sync / user tại một thời điểm (2 request list cùng lúc không sync 2 lần)
+# Weak refs: lock tự bị thu hồi khi không còn sync nào của user đó đang chạy / chờ
+_sync_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _get_discovery_document() -> Optional[dict[str, Any]]:
+    """Discovery document của Calendar v3, parse 1 lần / process.
+
+    GOOGLE_CALENDAR_API_ROOT (vd. http://localhost:8085/) trỏ client sang
+    một stub Calendar API local khi test.
+    """
+    global _discovery_document
+    if _discovery_document is None:
+        with _discovery_lock:
+            if _discovery_document is None:
+                raw = get_static_doc("calendar", "v3")
+                if raw is None:
+                    return None
+                document = json.loads(raw)
+                if settings.google_calendar_api_root:
+                    document = copy.deepcopy(document)
+                    document["rootUrl"] = settings.google_calendar_api_root
+                _discovery_document = document
+    return _discovery_document
+
+
+def _authorized_http(credentials: Credentials) -> AuthorizedHttp:
+    # httplib2.Http không thread-safe → mỗi lời gọi dùng 1 instance riêng
+    return AuthorizedHttp(credentials, http=httplib2.Http(timeout=settings.calendar_api_timeout))
+
+
+def forget_cached_client(user_id: str) -> None:
+    _client_cache.pop(user_id, None)
+
+
+async def _run_blocking(func: Callable[..., Any], *args: Any) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_calendar_executor, func, *args)
 
 
 class CalendarServiceError(Exception):
@@ -112,7 +180,7 @@ class CalendarService:
     async def handle_oauth_callback(self, code: str, state: str) -> str:
         user_id = self._parse_state_token(state)
         flow = self._build_flow(state)
-        flow.fetch_token(code=code)
+        await _run_blocking(lambda: flow.fetch_token(code=code))
         credentials = flow.credentials
         if not credentials or not credentials.refresh_token:
             raise CalendarServiceError("Failed to obtain Google Calendar credentials.")
@@ -120,10 +188,13 @@ class CalendarService:
         token_payload = json.loads(credentials.to_json())
         encrypted = self._encrypt(token_payload)
         await set_user_calendar_credentials(self.db, user_id, encrypted)
+        forget_cached_client(user_id)
         return user_id
 
     async def disconnect_calendar(self, user_id: str) -> None:
+        forget_cached_client(user_id)
         await clear_user_calendar_credentials(self.db, user_id)
+        await clear_calendar_sync_state(self.db, user_id)
 
     async def _load_credentials(self, user_id: str) -> Credentials:
         token = await get_user_calendar_token(self.db, user_id)
@@ -131,21 +202,48 @@ class CalendarService:
             raise CalendarServiceError("Google Calendar is not connected for this user.")
         payload = self._decrypt(token)
         credentials = Credentials.from_authorized_user_info(payload, SCOPES)
+        await self._refresh_if_needed(user_id, credentials)
+        return credentials
+
+    async def _refresh_if_needed(self, user_id: str, credentials: Credentials) -> None:
         if credentials.expired and credentials.refresh_token:
-            credentials.refresh(Request())
+            await _run_blocking(credentials.refresh, Request())
             await self._persist_credentials(user_id, credentials)
         if not credentials.valid:
+            forget_cached_client(user_id)
             raise CalendarServiceError("Google Calendar credentials are invalid.")
-        return credentials
 
     async def _persist_credentials(self, user_id: str, credentials: Credentials) -> None:
         token_payload = json.loads(credentials.to_json())
         encrypted = self._encrypt(token_payload)
         await set_user_calendar_credentials(self.db, user_id, encrypted)
 
-    async def get_calendar_service(self, user_id: str):
+    async def _get_client(self, user_id: str) -> tuple[Credentials, Any]:
+        """(credentials, service) đã xác thực của user, cache giữa các request."""
+        cached = _client_cache.get(user_id)
+        if cached is not None:
+            credentials, service = cached
+            await self._refresh_if_needed(user_id, credentials)
+            _client_cache.move_to_end(user_id)
+            return credentials, service
+
         credentials = await self._load_credentials(user_id)
-        return build("calendar", "v3", credentials=credentials, cache_discovery=False)
+        document = _get_discovery_document()
+        if document is not None:
+            service = build_from_document(document, credentials=credentials)
+        else:
+            service = build("calendar", "v3", credentials=credentials, cache_discovery=False)
+        _client_cache[user_id] = (credentials, service)
+        while len(_client_cache) > _CLIENT_CACHE_SIZE:
+            _client_cache.popitem(last=False)
+        return credentials, service
+
+    async def get_calendar_service(self, user_id: str):
+        _, service = await self._get_client(user_id)
+        return service
+
+    async def _execute(self, credentials: Credentials, request) -> Any:
+        return await _run_blocking(lambda: request.execute(http=_authorized_http(credentials)))
 
     async def create_event(
         self,
@@ -160,25 +258,13 @@ class CalendarService:
         question_id: Optional[str] = None,
         document_ids: Optional[list[str]] = None,
     ) -> dict[str, Any]:
-        service = await self.get_calendar_service(user_id)
-        body: dict[str, Any] = {
-            "summary": summary,
-            "start": {
-                "dateTime": start_dt.isoformat(),
-                "timeZone": timezone,
-            },
-            "end": {
-                "dateTime": end_dt.isoformat(),
-                "timeZone": timezone,
-            },
-        }
-        if description:
-            body["description"] = description
-        if reminders is not None:
-            body["reminders"] = {"useDefault": False, "overrides": reminders}
+        credentials, service = await self._get_client(user_id)
+        body = self._event_body(summary, start_dt, end_dt, timezone, description, reminders)
 
         try:
-            event = service.events().insert(calendarId="primary", body=body).execute()
+            event = await self._execute(
+                credentials, service.events().insert(calendarId="primary", body=body)
+            )
         except HttpError as exc:
             raise CalendarServiceError(f"Failed to create calendar event: {exc}") from exc
 
@@ -197,10 +283,104 @@ class CalendarService:
         )
         return event
 
+    @staticmethod
+    def _event_body(
+        summary: str,
+        start_dt: datetime,
+        end_dt: datetime,
+        timezone: str,
+        description: Optional[str] = None,
+        reminders: Optional[list[dict[str, Any]]] = None,
+    ) -> dict[str, Any]:
+        body: dict[str, Any] = {
+            "summary": summary,
+            "start": {
+                "dateTime": start_dt.isoformat(),
+                "timeZone": timezone,
+            },
+            "end": {
+                "dateTime": end_dt.isoformat(),
+                "timeZone": timezone,
+            },
+        }
+        if description:
+            body["description"] = description
+        if reminders is not None:
+            body["reminders"] = {"useDefault": False, "overrides": reminders}
+        return body
+
+    async def create_events_batch(
+        self,
+        user_id: str,
+        events: list[dict[str, Any]],
+    ) -> dict[str, Any]:
+        """Tạo nhiều event (lịch ôn tập) qua batch endpoint, 50 event / HTTP request.
+
+        Mỗi phần tử ``events`` có cùng các key với tham số của create_event.
+        Trả về {"created": [...event...], "failed": [{"index", "error"}]}.
+        """
+        credentials, service = await self._get_client(user_id)
+        created: list[tuple[int, dict[str, Any]]] = []
+        failed: list[dict[str, Any]] = []
+
+        for offset in range(0, len(events), BATCH_SIZE):
+            chunk = events[offset:offset + BATCH_SIZE]
+
+            def on_response(request_id: str, response: Any, exception: Optional[Exception]) -> None:
+                index = int(request_id)
+                if exception is not None:
+                    failed.append({"index": index, "error": str(exception)})
+                else:
+                    created.append((index, response))
+
+            batch = service.new_batch_http_request(callback=on_response)
+            for position, item in enumerate(chunk):
+                body = self._event_body(
+                    item["summary"],
+                    item["start_dt"],
+                    item["end_dt"],
+                    item["timezone"],
+                    item.get("description"),
+                    item.get("reminders"),
+                )
+                batch.add(
+                    service.events().insert(calendarId="primary", body=body),
+                    request_id=str(offset + position),
+                )
+            try:
+                await self._execute(credentials, batch)
+            except HttpError as exc:
+                raise CalendarServiceError(f"Failed to create calendar events: {exc}") from exc
+
+        created.sort(key=lambda pair: pair[0])
+        for index, event in created:
+            item = events[index]
+            await upsert_calendar_event(
+                self.db,
+                user_id=user_id,
+                google_event_id=event["id"],
+                summary=item["summary"],
+                start=item["start_dt"],
+                end=item["end_dt"],
+                timezone=item["timezone"],
+                description=item.get("description"),
+                event_type=item.get("event_type"),
+                question_id=item.get("question_id"),
+                document_ids=item.get("document_ids"),
+            )
+        if failed:
+            logger.warning("Calendar batch: %s/%s events failed for user %s", len(failed), len(events), user_id)
+        return {
+            "created": [event for _, event in created],
+            "failed": sorted(failed, key=lambda f: f["index"]),
+        }
+
     async def delete_event(self, user_id: str, event_id: str) -> None:
-        service = await self.get_calendar_service(user_id)
+        credentials, service = await self._get_client(user_id)
         try:
-            service.events().delete(calendarId="primary", eventId=event_id).execute()
+            await self._execute(
+                credentials, service.events().delete(calendarId="primary", eventId=event_id)
+            )
         except HttpError as exc:
             if exc.resp.status == 404:
                 # Event already deleted; ignore
@@ -209,30 +389,122 @@ class CalendarService:
                 raise CalendarServiceError(f"Failed to delete calendar event: {exc}") from exc
         await delete_calendar_event(self.db, user_id, event_id)
 
+    async def _fetch_changes(
+        self,
+        credentials: Credentials,
+        service,
+        sync_token: Optional[str],
+    ) -> tuple[list[dict[str, Any]], Optional[str]]:
+        """Đọc hết các trang events.list; có sync_token → chỉ các thay đổi từ lần trước."""
+        items: list[dict[str, Any]] = []
+        page_token: Optional[str] = None
+        while True:
+            # syncToken không dùng chung được với timeMin/orderBy → full sync không lọc thời gian
+            params: dict[str, Any] = {
+                "calendarId": "primary",
+                "singleEvents": True,
+                "maxResults": 250,
+            }
+            if sync_token:
+                params["syncToken"] = sync_token
+                params["showDeleted"] = True
+            if page_token:
+                params["pageToken"] = page_token
+            result = await self._execute(credentials, service.events().list(**params))
+            items.extend(result.get("items", []))
+            page_token = result.get("nextPageToken")
+            if not page_token:
+                return items, result.get("nextSyncToken")
+
+    async def sync_events(self, user_id: str) -> dict[str, Any]:
+        """Đồng bộ calendar_events với Google bằng syncToken (chỉ lấy phần thay đổi).
+
+        Lần đầu hoặc khi token hết hạn (410 Gone) → full sync rồi xóa các event
+        local không còn trên Google.
+        """
+        lock = _sync_locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            _sync_locks[user_id] = lock
+        async with lock:
+            credentials, service = await self._get_client(user_id)
+            state = await get_calendar_sync_state(self.db, user_id) or {}
+            sync_token = state.get("sync_token")
+            # Mongo client dùng tz_aware=True → lưu / so sánh bằng datetime aware (UTC)
+            started = datetime.now(dt_timezone.utc)
+            try:
+                try:
+                    items, next_token = await self._fetch_changes(credentials, service, sync_token)
+                except HttpError as exc:
+                    if sync_token and exc.resp.status == 410:
+                        logger.info("Calendar sync token expired for user %s, running full sync", user_id)
+                        sync_token = None
+                        items, next_token = await self._fetch_changes(credentials, service, None)
+                    else:
+                        raise
+            except HttpError as exc:
+                raise CalendarServiceError(f"Failed to sync calendar events: {exc}") from exc
+
+            upserted, deleted = await apply_google_event_changes(self.db, user_id, items, started)
+            full_sync = sync_token is None
+            if full_sync:
+                deleted += await delete_stale_calendar_events(self.db, user_id, started)
+            await save_calendar_sync_state(self.db, user_id, next_token, started)
+            logger.debug(
+                "Calendar sync user=%s full=%s upserted=%s deleted=%s", user_id, full_sync, upserted, deleted
+            )
+            return {"full_sync": full_sync, "upserted": upserted, "deleted": deleted, "synced_at": started}
+
+    async def _ensure_fresh(self, user_id: str, force: bool = False) -> Optional[datetime]:
+        """Sync nếu bản local cũ hơn CALENDAR_SYNC_MAX_AGE_SECONDS. Trả về thời điểm sync."""
+        state = await get_calendar_sync_state(self.db, user_id)
+        last_synced = state.get("last_synced_at") if state else None
+        max_age = settings.calendar_sync_max_age_seconds
+        if last_synced is not None and last_synced.tzinfo is None:
+            last_synced = last_synced.replace(tzinfo=dt_timezone.utc)
+        age = (datetime.now(dt_timezone.utc) - last_synced).total_seconds() if last_synced else None
+        if force or age is None or age > max_age:
+            result = await self.sync_events(user_id)
+            return result["synced_at"]
+        return last_synced
+
+    @staticmethod
+    def _as_google_event(event: CalendarEventInDB) -> dict[str, Any]:
+        """Bản local → dạng giống events.list của Google (giữ tương thích response cũ)."""
+        time_key = "date" if event.all_day else "dateTime"
+
+        def fmt(value: datetime) -> str:
+            return value.date().isoformat() if event.all_day else value.isoformat()
+
+        data: dict[str, Any] = {
+            "id": event.google_event_id,
+            "status": "confirmed",
+            "summary": event.summary,
+            "start": {time_key: fmt(event.start), "timeZone": event.timezone},
+            "end": {time_key: fmt(event.end), "timeZone": event.timezone},
+        }
+        if event.description:
+            data["description"] = event.description
+        if event.html_link:
+            data["htmlLink"] = event.html_link
+        return data
+
     async def list_events(
         self,
         user_id: str,
         max_results: int = 20,
         time_min: Optional[datetime] = None,
+        refresh: bool = False,
     ) -> dict[str, Any]:
-        service = await self.get_calendar_service(user_id)
-        params: dict[str, Any] = {
-            "calendarId": "primary",
-            "maxResults": max_results,
-            "singleEvents": True,
-            "orderBy": "startTime",
-        }
-        if time_min:
-            params["timeMin"] = time_min.isoformat() + "Z"
-
-        try:
-            events_result = service.events().list(**params).execute()
-        except HttpError as exc:
-            raise CalendarServiceError(f"Failed to list calendar events: {exc}") from exc
-
-        stored = await list_calendar_events(self.db, user_id, limit=max_results)
+        """Đọc từ bản local (calendar_events), chỉ gọi Google khi bản local quá cũ."""
+        synced_at = await self._ensure_fresh(user_id, force=refresh)
+        events = await list_calendar_events(self.db, user_id, limit=max_results, time_min=time_min)
+        # stored_events giữ nghĩa cũ: chỉ event do app tạo (không gồm event nhập từ Google)
+        stored = await list_calendar_events(
+            self.db, user_id, limit=max_results, time_min=time_min, app_only=True
+        )
         return {
-            "google_events": events_result.get("items", []),
+            "google_events": [self._as_google_event(event) for event in events],
             "stored_events": [event.dict() for event in stored],
+            "synced_at": synced_at,
         }
-
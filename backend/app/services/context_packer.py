@@ -0,0 +1,169 @@
+"""Đóng gói context cho LLM theo ngân sách token (thay cho giới hạn ký tự).
+
+- Đếm token bằng tokenizer local: tiktoken nếu có cài, nếu không thì ước lượng
+  bằng regex (đủ nhanh, sai số nhỏ với tiếng Việt).
+- Bỏ phần text trùng giữa 2 chunk liền kề (split_text dùng overlap 100 ký tự).
+- Gộp các chunk liền kề cùng section thành 1 block (header in 1 lần, giữ
+  marker [Chunk N] cho từng chunk để LLM vẫn trích dẫn đúng).
+- Chọn chunk tham lam theo điểm cho tới khi hết ngân sách.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+from ..core.logger import get_logger
+
+logger = get_logger("context_packer")
+
+
+_BLOCK_SEPARATOR = "\n\n---\n\n"
+_token_counter: Optional[Callable[[str], int]] = None
+
+
+def _regex_token_count(text: str) -> int:
+    # ~1 token / từ ngắn, từ dài (code, URL) ~4 ký tự / token, mỗi dấu câu 1 token
+    count = 0
+    for match in re.finditer(r"\w+|[^\w\s]", text):
+        word = match.group(0)
+        count += 1 if len(word) <= 4 else (len(word) + 3) // 4
+    return count
+
+
+def count_tokens(text: str) -> int:
+    global _token_counter
+    if not text:
+        return 0
+    if _token_counter is None:
+        try:
+            import tiktoken  # type: ignore
+
+            encoding = tiktoken.get_encoding("cl100k_base")
+            _token_counter = lambda t: len(encoding.encode(t, disallowed_special=()))
+            logger.debug("Using tiktoken (cl100k_base) for token counting")
+        except Exception:
+            _token_counter = _regex_token_count
+            logger.debug("tiktoken not installed, using regex token estimate")
+    return _token_counter(text)
+
+
+def strip_overlap(previous: str, current: str, max_overlap: int = 400, min_overlap: int = 20) -> str:
+    """Bỏ phần đầu của ``current`` trùng với phần cuối của ``previous``."""
+    if not previous or not current:
+        return current
+    tail = previous[-max_overlap:]
+    probe = current[:min_overlap]
+    if len(probe) < min_overlap:
+        return current
+    pos = tail.find(probe)
+    while pos != -1:
+        overlap = tail[pos:]
+        if current.startswith(overlap):
+            return current[len(overlap):].lstrip()
+        pos = tail.find(probe, pos + 1)
+    return current
+
+
+def _marker(meta: dict, with_header: bool) -> str:
+    parts = [f"[Chunk {meta['chunk_index']}]"]
+    if with_header and meta.get("document_filename"):
+        parts.append(f"[{meta['document_filename']}]")
+    if meta.get("page_number"):
+        parts.append(f"[Page {meta['page_number']}]")
+    if with_header and meta.get("section"):
+        parts.append(f"[{meta['section']}]")
+    parts.append(f"[Sim:{meta.get('similarity', 0.5):.2f}]")
+    return " ".join(parts)
+
+
+def _doc_key(meta: dict):
+    return meta.get("document_id") or meta.get("document_filename")
+
+
+def pack_context(
+    chunk_metadata_list: List[dict],
+    max_tokens: int,
+    by_score: bool = True,
+) -> Tuple[str, List[dict], Dict[str, int]]:
+    """Chọn + render chunks trong ``max_tokens``.
+
+    Trả về (context_text, chunks đã đưa vào context, stats). ``by_score=False``
+    giữ nguyên thứ tự ưu tiên của stage select (dùng cho DOCUMENT_OVERVIEW,
+    nơi độ phủ các phần quan trọng hơn similarity).
+    """
+    # Bỏ chunk trùng (cùng tài liệu + chunk_index)
+    unique: List[dict] = []
+    seen = set()
+    for meta in chunk_metadata_list:
+        key = (_doc_key(meta), meta.get("chunk_index"))
+        if key in seen:
+            continue
+        seen.add(key)
+        unique.append(meta)
+
+    by_position = {(_doc_key(m), m.get("chunk_index")): m for m in unique}
+    order = sorted(unique, key=lambda m: m.get("similarity", 0.5), reverse=True) if by_score else unique
+
+    chosen = set()
+    used_tokens = 0
+    skipped = 0
+    for meta in order:
+        doc_key, idx = _doc_key(meta), meta.get("chunk_index")
+        content = meta.get("content") or ""
+        previous = by_position.get((doc_key, idx - 1)) if isinstance(idx, int) else None
+        if previous is not None and (doc_key, idx - 1) in chosen:
+            content = strip_overlap(previous.get("content") or "", content)
+        cost = count_tokens(content) + count_tokens(_marker(meta, with_header=True)) + 4
+        if used_tokens + cost > max_tokens:
+            skipped += 1
+            continue
+        chosen.add((doc_key, idx))
+        used_tokens += cost
+
+    # Render theo vị trí trong tài liệu: chunk liền kề cùng section → 1 block
+    packed = [m for m in unique if (_doc_key(m), m.get("chunk_index")) in chosen]
+    doc_order = {}
+    for m in unique:
+        doc_order.setdefault(_doc_key(m), len(doc_order))
+    packed.sort(key=lambda m: (doc_order[_doc_key(m)], m.get("chunk_index") if isinstance(m.get("chunk_index"), int) else 0))
+
+    blocks: List[str] = []
+    current: List[str] = []
+    prev_meta: Optional[dict] = None
+    merged = 0
+    deduped_chars = 0
+    for meta in packed:
+        content = meta.get("content") or ""
+        adjacent = (
+            prev_meta is not None
+            and _doc_key(prev_meta) == _doc_key(meta)
+            and isinstance(meta.get("chunk_index"), int)
+            and prev_meta.get("chunk_index") == meta["chunk_index"] - 1
+        )
+        if adjacent:
+            stripped = strip_overlap(prev_meta.get("content") or "", content)
+            deduped_chars += len(content) - len(stripped)
+            content = stripped
+        if adjacent and (meta.get("section") or None) == (prev_meta.get("section") or None):
+            current.append(f"{_marker(meta, with_header=False)}\n{content}")
+            merged += 1
+        else:
+            if current:
+                blocks.append("\n".join(current))
+            current = [f"{_marker(meta, with_header=True)}\n{content}"]
+        prev_meta = meta
+    if current:
+        blocks.append("\n".join(current))
+
+    context_text = _BLOCK_SEPARATOR.join(blocks)
+    stats = {
+        "chunks_in": len(chunk_metadata_list),
+        "chunks_packed": len(packed),
+        "chunks_skipped": skipped,
+        "chunks_merged": merged,
+        "deduped_chars": deduped_chars,
+        "tokens": count_tokens(context_text),
+        "budget": max_tokens,
+    }
+    return context_text, packed, stats
@@ -0,0 +1,240 @@
+"""Xóa tài liệu theo 2 bước: tombstone ngay trong request, cascade chạy nền.
+
+- ``schedule_purge``: request DELETE chỉ đặt ``deleted_at`` (mọi truy vấn đọc
+  bỏ qua document) rồi giao việc xóa file, FAISS/BM25 index, chunks, embeddings,
+  ngân hàng câu hỏi, quiz, lượt làm bài, thống kê quiz và history cho task nền.
+  Các collection lớn được xóa theo lô DOCUMENT_DELETE_BATCH_SIZE.
+- ``sweep``: chạy định kỳ, purge lại các tombstone bị kẹt (lỗi / server restart)
+  và dọn dữ liệu mồ côi: chunks / embeddings / question_bank trỏ tới document
+  không còn tồn tại, file .faiss / .bm25.json không thuộc document nào, file
+  upload không còn document nào trỏ tới và file ``.part`` bị bỏ dở.
+
+File upload lưu theo nội dung (có thể dùng chung) chỉ sweeper xóa: upload khác
+cùng nội dung có thể đang parse file mà chưa có row ``documents``. File upload
+kiểu cũ (trước khi lưu theo nội dung) được purge xóa trực tiếp.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Set
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from ..core.config import settings
+from ..core.database import get_bm25_index_path, get_faiss_index_path
+from ..core.logger import get_logger
+from ..models.document import (
+    DocumentInDB,
+    delete_document,
+    is_shared_with_other_documents,
+    list_tombstoned_documents,
+)
+from ..models.history import conversation_ids_for, refresh_conversation_summaries
+from ..models.quiz_analytics import delete_quiz_analytics_for_document
+from ..models.stats import record_stats
+from .uploads import is_content_addressed, remove_stale_partials, remove_unreferenced_uploads
+
+logger = get_logger("document_cleanup")
+
+# Chỉ file index theo tài liệu mới bị sweeper xóa
+_INDEX_FILE_RE = re.compile(r"^user_.+_doc_.+\.(?:faiss|bm25\.json)$")
+# Collection có field document_id → xóa theo lô
+_DOCUMENT_COLLECTIONS = ("chunks", "embeddings", "question_bank", "quiz_attempts", "quizzes")
+_ORPHAN_COLLECTIONS = ("chunks", "embeddings", "question_bank")
+
+
+def _namespace(document: DocumentInDB) -> str:
+    return document.faiss_namespace or f"user_{document.user_id}_doc_{document.id}"
+
+
+def _remove_file(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+async def delete_in_batches(
+    db: AsyncIOMotorDatabase,
+    collection: str,
+    query: Dict[str, Any],
+    batch_size: int,
+) -> int:
+    """delete_many theo từng lô ``_id`` để không giữ lock / oplog quá lâu."""
+    total = 0
+    while True:
+        ids = [
+            row["_id"]
+            async for row in db[collection].find(query, {"_id": 1}).limit(batch_size)
+        ]
+        if not ids:
+            return total
+        result = await db[collection].delete_many({"_id": {"$in": ids}})
+        total += result.deleted_count
+        if len(ids) < batch_size:
+            return total
+        # Nhường event loop cho request khác giữa các lô
+        await asyncio.sleep(0)
+
+
+class DocumentCleanupService:
+    def __init__(self):
+        self._purging: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def schedule_purge(self, db: AsyncIOMotorDatabase, document: DocumentInDB) -> None:
+        """Chạy purge nền (không chờ). Bỏ qua nếu document đang được purge."""
+        if document.id in self._purging:
+            return
+        self._purging.add(document.id)
+        task = asyncio.create_task(self._purge_in_background(db, document))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _purge_in_background(self, db: AsyncIOMotorDatabase, document: DocumentInDB) -> None:
+        try:
+            await self.purge(db, document)
+        except Exception as exc:
+            # Document vẫn là tombstone → sweeper thử lại lần sau
+            logger.warning("⚠️ Purge of document %s failed: %s", document.id, exc)
+        finally:
+            self._purging.discard(document.id)
+
+    async def purge(self, db: AsyncIOMotorDatabase, document: DocumentInDB) -> Dict[str, int]:
+        """Xóa mọi dữ liệu của 1 document đã tombstone; row ``documents`` xóa sau cùng."""
+        started = time.perf_counter()
+        batch_size = max(settings.document_delete_batch_size, 1)
+        namespace = _namespace(document)
+        # File / index dùng chung với bản clone (upload trùng nội dung) → giữ lại.
+        # File lưu theo nội dung do sweeper xóa (upload khác có thể đang parse nó);
+        # file kiểu cũ (<upload_dir>/<user_id>/<filename>) xóa ngay ở đây.
+        paths = []
+        if (
+            document.file_path
+            and not is_content_addressed(document.file_path)
+            and not await is_shared_with_other_documents(db, document, "file_path", document.file_path)
+        ):
+            paths.append(document.file_path)
+        if not await is_shared_with_other_documents(db, document, "faiss_namespace", namespace):
+            paths += [get_faiss_index_path(namespace), get_bm25_index_path(namespace)]
+        for path in paths:
+            await asyncio.to_thread(_remove_file, path)
+
+        deleted: Dict[str, int] = {}
+        # Lượt làm bài cũ chưa có document_id → xóa theo quiz_id
+        quiz_ids = [
+            str(row["_id"])
+            async for row in db["quizzes"].find({"document_id": document.id}, {"_id": 1})
+        ]
+        if quiz_ids:
+            deleted["quiz_attempts_by_quiz"] = await delete_in_batches(
+                db, "quiz_attempts", {"quiz_id": {"$in": quiz_ids}}, batch_size
+            )
+        for collection in _DOCUMENT_COLLECTIONS:
+            deleted[collection] = await delete_in_batches(
+                db, collection, {"document_id": document.id}, batch_size
+            )
+        await delete_quiz_analytics_for_document(db, document.id)
+        history_query = {"user_id": document.user_id, "document_id": document.id}
+        conversation_ids = await conversation_ids_for(db, history_query)
+        deleted["histories"] = await delete_in_batches(db, "histories", history_query, batch_size)
+        if deleted["histories"]:
+            await record_stats(db, histories=-deleted["histories"])
+            await refresh_conversation_summaries(db, document.user_id, conversation_ids)
+        await delete_document(db, document.id)
+        logger.info(
+            "Purged document %s in %.0f ms: %s",
+            document.id, (time.perf_counter() - started) * 1000, deleted,
+        )
+        return deleted
+
+    async def sweep(self, db: AsyncIOMotorDatabase) -> Dict[str, int]:
+        """Purge tombstone bị kẹt + xóa chunks/embeddings/file index mồ côi."""
+        grace = timedelta(seconds=settings.document_sweep_grace_seconds)
+        batch_size = max(settings.document_delete_batch_size, 1)
+        summary = {"tombstones": 0, "orphan_rows": 0, "orphan_files": 0}
+
+        for document in await list_tombstoned_documents(db, datetime.now(timezone.utc) - grace):
+            if document.id in self._purging:
+                continue
+            self._purging.add(document.id)
+            try:
+                await self.purge(db, document)
+                summary["tombstones"] += 1
+            except Exception as exc:
+                logger.warning("⚠️ Sweeper could not purge document %s: %s", document.id, exc)
+            finally:
+                self._purging.discard(document.id)
+
+        # Kể cả tombstone: dữ liệu của chúng do purge xóa, không phải mồ côi
+        rows = await db["documents"].find(
+            {}, {"user_id": 1, "faiss_namespace": 1, "file_path": 1}
+        ).to_list(length=None)
+        live_ids = {str(row["_id"]) for row in rows}
+        for collection in _ORPHAN_COLLECTIONS:
+            orphan_ids: List[str] = [
+                doc_id for doc_id in await db[collection].distinct("document_id")
+                if doc_id and doc_id not in live_ids
+            ]
+            for doc_id in orphan_ids:
+                summary["orphan_rows"] += await delete_in_batches(
+                    db, collection, {"document_id": doc_id}, batch_size
+                )
+
+        live_files: Set[str] = set()
+        for row in rows:
+            namespace = row.get("faiss_namespace") or f"user_{row.get('user_id')}_doc_{row['_id']}"
+            live_files.add(os.path.basename(get_faiss_index_path(namespace)))
+            live_files.add(os.path.basename(get_bm25_index_path(namespace)))
+        summary["orphan_files"] = await asyncio.to_thread(
+            self._remove_orphan_files, live_files, grace.total_seconds()
+        )
+        summary["orphan_files"] += await asyncio.to_thread(
+            remove_unreferenced_uploads, {row.get("file_path") for row in rows}, grace.total_seconds()
+        )
+        summary["orphan_files"] += await asyncio.to_thread(remove_stale_partials, grace.total_seconds())
+        if any(summary.values()):
+            logger.info("Document sweep: %s", summary)
+        return summary
+
+    @staticmethod
+    def _remove_orphan_files(live_files: Set[str], grace_seconds: float) -> int:
+        directory = settings.faiss_index_dir
+        if not os.path.isdir(directory):
+            return 0
+        removed = 0
+        cutoff = time.time() - grace_seconds
+        for name in os.listdir(directory):
+            if name in live_files or not _INDEX_FILE_RE.match(name):
+                continue
+            path = os.path.join(directory, name)
+            # File mới ghi có thể thuộc upload đang chạy (document chưa kịp insert)
+            if os.path.getmtime(path) > cutoff:
+                continue
+            if _remove_file(path):
+                removed += 1
+        return removed
+
+    async def drain(self) -> None:
+        """Chờ các purge đang chạy (khi shutdown); phần dở dang sweeper làm tiếp."""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=10)
+
+
+document_cleanup_service = DocumentCleanupService()
+
+
+async def run_document_sweeper(db: AsyncIOMotorDatabase, interval_seconds: int) -> None:
+    """Định kỳ chạy ``sweep`` (background task lúc startup)."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await document_cleanup_service.sweep(db)
+        except Exception as exc:
+            logger.warning("⚠️ Document sweep failed: %s", exc)
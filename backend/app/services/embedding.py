@@ -1,14 +1,17 @@
 import asyncio
 from datetime import datetime
-from typing import Iterable, List, Sequence
+from typing import Iterable, List, Sequence, Tuple
 
 import numpy as np
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
 from ..core.config import settings
 from ..core.database import create_or_load_faiss_index, save_faiss_index
+from ..core.logger import get_logger
 from ..models.document import mark_document_embedded, mark_chunks_embedded
 
+logger = get_logger("embedding")
+
 
 class EmbeddingService:
     """Service to generate embeddings via OpenAI or local SentenceTransformers."""
@@ -27,10 +30,10 @@ class EmbeddingService:
                 from openai import OpenAI
                 self._openai_client = OpenAI(api_key=settings.openai_api_key)
                 self.model = model or settings.embedding_model
-                print(f"[Embedding] OpenAI client initialized successfully")
+                logger.debug("OpenAI client initialized successfully")
             except Exception as e:
-                print(f"[Embedding] Failed to initialize OpenAI client: {e}")
-                print(f"[Embedding] Falling back to local embedding model")
+                logger.error("Failed to initialize OpenAI client: %s", e)
+                logger.warning("Falling back to local embedding model")
                 self._openai_client = None
                 self.provider = "local"
                 self.model = settings.embedding_local_model
@@ -38,7 +41,7 @@ class EmbeddingService:
             # Use local embedding model (sentence-transformers)
             self.provider = "local"
             self.model = settings.embedding_local_model
-            print(f"[Embedding] Using local embedding model: {self.model}")
+            logger.debug("Using local embedding model: %s", self.model)
 
     async def embed_texts(self, texts: Sequence[str]) -> List[List[float]]:
         cleaned = [t.strip() for t in texts if t and t.strip()]
@@ -50,7 +53,7 @@ class EmbeddingService:
                 return await self._embed_openai(cleaned)
             except Exception as e:
                 # If OpenAI fails, automatically fallback to local
-                print(f"[Embedding] Error in OpenAI embedding, falling back to local: {e}")
+                logger.error("Error in OpenAI embedding, falling back to local: %s", e)
                 self.provider = "local"
                 self.model = settings.embedding_local_model
                 return await self._embed_local(cleaned)
@@ -75,8 +78,8 @@ class EmbeddingService:
             # Handle OpenAI API errors (quota, rate limit, etc.) by falling back to local
             error_msg = str(e)
             if "quota" in error_msg.lower() or "rate" in error_msg.lower() or "429" in error_msg:
-                print(f"[Embedding] OpenAI API error (quota/rate limit): {e}")
-                print("[Embedding] Falling back to local embedding model")
+                logger.error("OpenAI API error (quota/rate limit): %s", e)
+                logger.warning("Falling back to local embedding model")
                 # Switch to local provider for future calls
                 self.provider = "local"
                 self.model = settings.embedding_local_model
@@ -84,8 +87,8 @@ class EmbeddingService:
                 return await self._embed_local(texts)
             else:
                 # For other errors, still fallback to local but log the error
-                print(f"[Embedding] OpenAI API error: {e}")
-                print("[Embedding] Falling back to local embedding model")
+                logger.error("OpenAI API error: %s", e)
+                logger.warning("Falling back to local embedding model")
                 self.provider = "local"
                 self.model = settings.embedding_local_model
                 return await self._embed_local(texts)
@@ -118,54 +121,79 @@ class EmbeddingService:
         chunks: Sequence[dict],
     ) -> None:
         """Generate embeddings for provided chunks and store in FAISS and MongoDB."""
+        await self.embed_documents_chunks(db, [(user_id, document, chunks)])
 
-        texts = [chunk.get("content", "").strip() for chunk in chunks]
-        embeddings = await self.embed_texts(texts)
+    async def embed_documents_chunks(
+        self,
+        db: AsyncIOMotorDatabase,
+        items: Sequence[Tuple[str, object, Sequence[dict]]],
+    ) -> None:
+        """Embed chunks của nhiều tài liệu cùng lúc: (user_id, document, chunks) mỗi phần tử.
+
+        Toàn bộ chunks đi qua 1 lần ``embed_texts`` (các batch đều đầy, trừ batch
+        cuối), mỗi tài liệu vẫn có FAISS index riêng; bản ghi embeddings / cập nhật
+        chunks ghi bằng 1 insert_many / 1 bulk_write cho cả lô.
+        """
+        # Bỏ chunk rỗng trước khi embed (embed_texts bỏ text rỗng → lệch vector/chunk)
+        prepared = []
+        texts: List[str] = []
+        for user_id, document, chunks in items:
+            usable = [chunk for chunk in chunks if chunk.get("content", "").strip()]
+            prepared.append((user_id, document, usable))
+            texts.extend(chunk["content"].strip() for chunk in usable)
 
+        embeddings = await self.embed_texts(texts)
         if not embeddings:
             # Nothing to embed, but still mark document as embedded with zero vectors
-            await mark_document_embedded(db, document.id, self.model, 0)
+            for _, document, _ in prepared:
+                await mark_document_embedded(db, document.id, self.model, 0)
             return
 
-        vectors = np.array(embeddings, dtype="float32")
-        dimension = vectors.shape[1]
-
-        namespace = getattr(document, "faiss_namespace", None) or f"user_{user_id}_doc_{getattr(document, 'id', '')}"
-        index = create_or_load_faiss_index(dimension=dimension, namespace=namespace)
-
-        # Use existing total as base offset, ids sequential from ntotal
-        start_position = int(index.ntotal)
-        ids = np.arange(start_position, start_position + len(vectors), dtype="int64")
-
-        # Add vectors to FAISS index (supports IDs)
-        index.add_with_ids(vectors, ids)
-        save_faiss_index(index, namespace=namespace)
-
+        all_vectors = np.array(embeddings, dtype="float32")
+        dimension = all_vectors.shape[1]
         now = datetime.utcnow()
         embedding_records = []
         chunk_updates = []
-
-        for chunk, vector_id in zip(chunks, ids.tolist()):
-            chunk_id = chunk.get("_id")
-            embedding_records.append(
-                {
-                    "user_id": user_id,
-                    "document_id": document.id,
-                    "chunk_id": chunk_id,
-                    "chunk_index": chunk.get("chunk_index"),
-                    "vector_index": vector_id,
-                    "embedding_model": self.model,
-                    "provider": self.provider,
-                    "created_at": now,
-                }
-            )
-            chunk_updates.append(
-                {
-                    "chunk_id": chunk_id,
-                    "embedding_index": vector_id,
-                    "embedding_model": self.model,
-                }
-            )
+        offset = 0
+
+        for user_id, document, chunks in prepared:
+            vectors = all_vectors[offset : offset + len(chunks)]
+            offset += len(chunks)
+            if not len(vectors):
+                continue
+
+            namespace = getattr(document, "faiss_namespace", None) or f"user_{user_id}_doc_{getattr(document, 'id', '')}"
+            index = await asyncio.to_thread(create_or_load_faiss_index, dimension, namespace)
+
+            # Use existing total as base offset, ids sequential from ntotal
+            start_position = int(index.ntotal)
+            ids = np.arange(start_position, start_position + len(vectors), dtype="int64")
+
+            # Add vectors to FAISS index (supports IDs)
+            index.add_with_ids(vectors, ids)
+            await asyncio.to_thread(save_faiss_index, index, namespace)
+
+            for chunk, vector_id in zip(chunks, ids.tolist()):
+                chunk_id = chunk.get("_id")
+                embedding_records.append(
+                    {
+                        "user_id": user_id,
+                        "document_id": document.id,
+                        "chunk_id": chunk_id,
+                        "chunk_index": chunk.get("chunk_index"),
+                        "vector_index": vector_id,
+                        "embedding_model": self.model,
+                        "provider": self.provider,
+                        "created_at": now,
+                    }
+                )
+                chunk_updates.append(
+                    {
+                        "chunk_id": chunk_id,
+                        "embedding_index": vector_id,
+                        "embedding_model": self.model,
+                    }
+                )
 
         if embedding_records:
             await db["embeddings"].insert_many(embedding_records)
@@ -173,5 +201,5 @@ class EmbeddingService:
         if chunk_updates:
             await mark_chunks_embedded(db, chunk_updates)
 
-        await mark_document_embedded(db, document.id, self.model, dimension)
-
+        for _, document, chunks in prepared:
+            await mark_document_embedded(db, document.id, self.model, dimension if chunks else 0)
@@ -0,0 +1,211 @@
+"""BM25 lexical index cho từng tài liệu (chạy song song với FAISS).
+
+FAISS bỏ sót các truy vấn dạng "khớp chính xác" (tên hàm, số mục như "4.2"),
+nên mỗi tài liệu có thêm một inverted index BM25 dựng lúc upload và lưu cạnh
+file .faiss. Kết quả hai bên được gộp bằng reciprocal-rank fusion (RRF).
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from ..core.logger import get_logger
+
+logger = get_logger("lexical")
+
+
+# Hư từ tiếng Việt + tiếng Anh phổ biến - không mang nghĩa khi so khớp
+STOP_WORDS = {
+    "của", "và", "với", "trong", "về", "có", "là", "được", "này", "cho", "từ",
+    "các", "những", "một", "thì", "mà", "khi", "đã", "sẽ", "đang", "như", "để",
+    "theo", "hay", "hoặc", "gì", "nào", "sao", "thế", "bị", "ra", "vào", "lại",
+    "the", "a", "an", "of", "and", "or", "to", "in", "on", "is", "are", "for", "with",
+}
+
+# Token: chữ/số (Unicode, giữ dấu tiếng Việt) nối bởi "." hoặc "_"
+# → giữ nguyên "4.2", "os.path", "snake_case" thành 1 token
+_TOKEN_RE = re.compile(r"\w+(?:[._]\w+)*", re.UNICODE)
+
+
+def fold_diacritics(text: str) -> str:
+    """Bỏ dấu tiếng Việt: "cơ sở dữ liệu" -> "co so du lieu"."""
+    text = text.replace("đ", "d").replace("Đ", "D")
+    decomposed = unicodedata.normalize("NFD", text)
+    return "".join(ch for ch in decomposed if unicodedata.category(ch) != "Mn")
+
+
+def tokenize(text: str) -> List[str]:
+    """Tokenizer cho tiếng Việt.
+
+    Tiếng Việt viết theo âm tiết ("cơ sở dữ liệu") nên ngoài unigram còn sinh
+    bigram âm tiết liền kề ("cơ_sở", "sở_dữ", ...) để giữ được từ ghép.
+    Token có dấu chấm/gạch dưới (identifier, số mục) được giữ nguyên và thêm
+    các phần con để "os.path" vẫn khớp với "path".
+    """
+    if not text:
+        return []
+    normalized = unicodedata.normalize("NFC", text).lower()
+    tokens: List[str] = []
+    previous: Optional[str] = None
+    for raw in _TOKEN_RE.findall(normalized):
+        if raw in STOP_WORDS:
+            previous = None
+            continue
+        tokens.append(raw)
+        if "." in raw or "_" in raw:
+            parts = [p for p in re.split(r"[._]", raw) if len(p) > 1 and not p.isdigit()]
+            tokens.extend(parts)
+            previous = None
+            continue
+        if previous is not None and raw.isalpha() and previous.isalpha():
+            tokens.append(f"{previous}_{raw}")
+        previous = raw
+    return tokens
+
+
+class BM25Index:
+    """Inverted index BM25 (Okapi) với key là chunk_index."""
+
+    def __init__(
+        self,
+        postings: Optional[Dict[str, List[List[int]]]] = None,
+        doc_lengths: Optional[Dict[int, int]] = None,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ):
+        self.postings: Dict[str, List[List[int]]] = postings or {}
+        self.doc_lengths: Dict[int, int] = doc_lengths or {}
+        self.k1 = k1
+        self.b = b
+        self.num_docs = len(self.doc_lengths)
+        self.avg_doc_length = (
+            sum(self.doc_lengths.values()) / self.num_docs if self.num_docs else 0.0
+        )
+        self._folded_terms: Optional[Dict[str, List[str]]] = None
+
+    @classmethod
+    def build(cls, chunks: Iterable[dict]) -> "BM25Index":
+        """Dựng index từ chunks đã lưu (cần chunk_index + content)."""
+        postings: Dict[str, List[List[int]]] = {}
+        doc_lengths: Dict[int, int] = {}
+        for position, chunk in enumerate(chunks):
+            chunk_index = chunk.get("chunk_index")
+            if chunk_index is None:
+                chunk_index = (chunk.get("metadata") or {}).get("chunk_index", position)
+            content = chunk.get("content") or ""
+            metadata = chunk.get("metadata") or {}
+            # Heading được tính vào nội dung để truy vấn "mục 4.2" khớp chunk thuộc mục đó
+            heading = metadata.get("heading") or ""
+            tokens = tokenize(f"{heading}\n{content}" if heading and heading not in content else content)
+            if not tokens:
+                continue
+            doc_lengths[int(chunk_index)] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append([int(chunk_index), tf])
+        return cls(postings=postings, doc_lengths=doc_lengths)
+
+    def to_dict(self) -> dict:
+        return {
+            "k1": self.k1,
+            "b": self.b,
+            "doc_lengths": {str(k): v for k, v in self.doc_lengths.items()},
+            "postings": self.postings,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BM25Index":
+        return cls(
+            postings=data.get("postings") or {},
+            doc_lengths={int(k): v for k, v in (data.get("doc_lengths") or {}).items()},
+            k1=data.get("k1", 1.5),
+            b=data.get("b", 0.75),
+        )
+
+    def _expand_term(self, term: str) -> List[str]:
+        """Truy vấn gõ không dấu ("co so du lieu") → khớp các term có dấu tương ứng."""
+        if term in self.postings:
+            return [term]
+        if not term.isascii():
+            return []
+        if self._folded_terms is None:
+            folded: Dict[str, List[str]] = {}
+            for indexed_term in self.postings:
+                key = fold_diacritics(indexed_term)
+                if key != indexed_term:
+                    folded.setdefault(key, []).append(indexed_term)
+            self._folded_terms = folded
+        return self._folded_terms.get(term, [])
+
+    def search(self, query: str, top_k: int = 30) -> List[Tuple[int, float]]:
+        """Trả về [(chunk_index, bm25_score)] giảm dần theo điểm."""
+        if not self.num_docs:
+            return []
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            for indexed_term in self._expand_term(term):
+                postings = self.postings[indexed_term]
+                df = len(postings)
+                idf = math.log(1.0 + (self.num_docs - df + 0.5) / (df + 0.5))
+                for chunk_index, tf in postings:
+                    length_norm = 1.0 - self.b + self.b * self.doc_lengths.get(chunk_index, 0) / (self.avg_doc_length or 1.0)
+                    scores[chunk_index] = scores.get(chunk_index, 0.0) + idf * tf * (self.k1 + 1.0) / (tf + self.k1 * length_norm)
+        ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+        return ranked[:top_k]
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence], k: int = 60) -> Dict:
+    """RRF: score(d) = Σ 1 / (k + rank_i(d)), rank bắt đầu từ 1.
+
+    Mỗi ranking là list key đã sắp xếp (tốt nhất trước). Không cần chuẩn hoá
+    điểm giữa khoảng cách L2 của FAISS và điểm BM25.
+    """
+    fused: Dict = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            fused[key] = fused.get(key, 0.0) + 1.0 / (k + rank)
+    return fused
+
+
+# Cache index đã load theo (path, mtime) - tránh parse lại JSON mỗi câu hỏi
+_index_cache: Dict[str, Tuple[float, BM25Index]] = {}
+
+
+def save_bm25_index(index: BM25Index, path: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index.to_dict(), f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    _index_cache.pop(path, None)
+
+
+def load_bm25_index(path: str) -> Optional[BM25Index]:
+    if not os.path.exists(path):
+        return None
+    mtime = os.path.getmtime(path)
+    cached = _index_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            index = BM25Index.from_dict(json.load(f))
+    except Exception as exc:
+        logger.error("⚠️ Failed to load BM25 index %s: %s", path, exc)
+        return None
+    _index_cache[path] = (mtime, index)
+    return index
+
+
+def delete_bm25_index(path: str) -> None:
+    _index_cache.pop(path, None)
+    if os.path.exists(path):
+        try:
+            os.remove(path)
+        except Exception:
+            pass
@@ -3,6 +3,10 @@ import re
 from typing import Optional, List, Dict
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+from ..core.logger import get_logger, debug_sampled
+
+logger = get_logger("parser")
+
 
 def parse_pdf(file_path: str) -> List[Dict]:
     """Đọc PDF và trả về list chunks với page number VÀ section metadata."""
@@ -46,7 +50,7 @@ def parse_pdf(file_path: str) -> List[Dict]:
                     # Reset subsection khi gặp main section mới
                     current_subsection = None
                     
-                    print(f"[Parser] 📍 Main section: {current_section} (page {page_num})")
+                    debug_sampled(logger, "pdf_main_section", "📍 Main section: %s (page %s)", current_section, page_num)
                     
                     chunks.append({
                         "content": line_stripped,
@@ -75,7 +79,7 @@ def parse_pdf(file_path: str) -> List[Dict]:
                     if subsection_title:
                         current_subsection += f" {subsection_title}"
                     
-                    print(f"[Parser]   📌 Subsection: {current_subsection} (page {page_num})")
+                    debug_sampled(logger, "pdf_subsection", "📌 Subsection: %s (page %s)", current_subsection, page_num)
                     
                     chunks.append({
                         "content": line_stripped,
@@ -112,7 +116,7 @@ def parse_pdf(file_path: str) -> List[Dict]:
                         concept_name = line_stripped.strip('*').strip()
                 
                 if is_concept_heading and concept_name:
-                    print(f"[Parser]     💡 Concept: {concept_name} (page {page_num})")
+                    debug_sampled(logger, "pdf_concept", "💡 Concept: %s (page %s)", concept_name, page_num)
                     
                     chunks.append({
                         "content": line_stripped,
@@ -145,7 +149,7 @@ def parse_pdf(file_path: str) -> List[Dict]:
                 })
         
         doc.close()
-        print(f"[Parser] ✅ Total chunks: {len(chunks)}")
+        logger.debug("✅ Total chunks: %s", len(chunks))
         return chunks
     except Exception as e:
         raise ValueError(f"Error parsing PDF: {str(e)}")
@@ -269,7 +273,7 @@ def parse_docx(file_path: str) -> List[Dict]:
                         }
                     })
         
-        print(f"[Parser] ✅ Total chunks: {len(chunks)}")
+        logger.debug("✅ Total chunks: %s", len(chunks))
         return chunks
     except Exception as e:
         raise ValueError(f"Error parsing DOCX: {str(e)}")
@@ -349,7 +353,7 @@ def parse_markdown(file_path: str) -> List[Dict]:
                     }
                 })
         
-        print(f"[Parser] ✅ Total chunks: {len(chunks)}")
+        logger.debug("✅ Total chunks: %s", len(chunks))
         return chunks
     except Exception as e:
         raise ValueError(f"Error parsing Markdown: {str(e)}")
@@ -433,7 +437,7 @@ def parse_txt(file_path: str) -> List[Dict]:
                 }
             })
         
-        print(f"[Parser] ✅ Total chunks: {len(chunks)}")
+        logger.debug("✅ Total chunks: %s", len(chunks))
         return chunks
     except Exception as e:
         raise ValueError(f"Error parsing TXT: {str(e)}")
@@ -537,10 +541,118 @@ def split_text(
             })
             chunk_index += 1
     
-    print(f"[Parser] ✅ Split into {len(result)} final chunks")
+    logger.debug("✅ Split into %s final chunks", len(result))
     return result
 
 
+def _extract_section_number(heading: str) -> Optional[str]:
+    """Lấy số của section từ heading: "PHẦN 8: ..." -> "8", "8.1 Arrow" -> "8.1"."""
+    if not heading:
+        return None
+    match = re.match(
+        r'^(?:PHẦN|Chương|CHƯƠNG|Phần|PART|Part)\s+(\d+)',
+        heading.strip(),
+        re.IGNORECASE
+    )
+    if match:
+        return match.group(1)
+    match = re.match(r'^(\d+(?:\.\d+)*)', heading.strip())
+    if match:
+        return match.group(1)
+    return None
+
+
+def build_section_index(chunks: List[Dict]) -> List[Dict]:
+    """
+    Dựng cây section/TOC của tài liệu từ chunks đã split (chạy 1 lần lúc upload).
+
+    Mỗi node: heading, level (1 = PHẦN/Chương, 2 = subsection), number,
+    chunk_start, chunk_end, page_start, page_end, children.
+    Subsection xuất hiện trước main section đầu tiên sẽ nằm ở root.
+    """
+    roots: List[Dict] = []
+    current_main: Optional[Dict] = None
+    current_sub: Optional[Dict] = None
+
+    for position, chunk in enumerate(chunks):
+        metadata = chunk.get("metadata", {}) or {}
+        chunk_index = metadata.get("chunk_index", chunk.get("chunk_index", position))
+        page_number = metadata.get("page_number")
+
+        if metadata.get("is_main_section") or metadata.get("is_section_heading"):
+            level = 1
+        elif metadata.get("is_subsection_heading"):
+            level = 2
+        else:
+            level = None
+
+        if level is not None:
+            heading = (
+                metadata.get("heading")
+                or (metadata.get("subsection") if level == 2 else metadata.get("section"))
+                or (chunk.get("content") or "").strip()
+            )
+            node = {
+                "heading": heading,
+                "level": level,
+                "number": _extract_section_number(heading),
+                "chunk_start": chunk_index,
+                "chunk_end": chunk_index,
+                "page_start": page_number,
+                "page_end": page_number,
+                "children": [],
+            }
+            if level == 1:
+                current_main = node
+                current_sub = None
+                roots.append(node)
+            else:
+                current_sub = node
+                (current_main["children"] if current_main else roots).append(node)
+
+        # Mở rộng range của section (và subsection) đang mở
+        for node in (current_main, current_sub):
+            if node is None:
+                continue
+            node["chunk_end"] = chunk_index
+            if page_number is not None:
+                if node["page_start"] is None:
+                    node["page_start"] = page_number
+                node["page_end"] = page_number
+
+    logger.debug("✅ Built section index: %s top-level sections", len(roots))
+    return roots
+
+
+def find_section_for_chunk(section_index: List[Dict], chunk_index: Optional[int]) -> Optional[Dict]:
+    """Tìm node sâu nhất trong section index chứa chunk_index."""
+    if chunk_index is None:
+        return None
+    found = None
+    nodes = section_index or []
+    while nodes:
+        match = next(
+            (n for n in nodes if n["chunk_start"] <= chunk_index <= n["chunk_end"]),
+            None,
+        )
+        if match is None:
+            break
+        found = match
+        nodes = match.get("children") or []
+    return found
+
+
+def find_section_by_number(section_index: List[Dict], number: str) -> Optional[Dict]:
+    """Tìm section theo số ("8", "8.1") trong section index."""
+    stack = list(section_index or [])
+    while stack:
+        node = stack.pop(0)
+        if node.get("number") == number:
+            return node
+        stack.extend(node.get("children") or [])
+    return None
+
+
 def get_file_type_from_filename(filename: str) -> str:
     """Lấy loại file từ extension."""
     ext = os.path.splitext(filename)[1].lower().lstrip(".")
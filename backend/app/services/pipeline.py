@@ -0,0 +1,127 @@
+"""Các stage của RAG pipeline + đo thời gian từng stage.
+
+RAGService.ask chạy tuần tự các stage (load → small_talk → embed → retrieve →
+rerank → select → generate → references → history). Mỗi stage ghi wall-time
+và số phần tử đầu ra vào PipelineTrace; trace được cộng dồn vào
+``pipeline_metrics`` (xem /admin/metrics/rag) và trả trong response metadata
+khi bật debug.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+
+@dataclass
+class ContextSelection:
+    """Output của stage select: chunks đưa vào prompt."""
+
+    selected_results: List[dict]
+    chunk_metadata_for_context: List[dict]
+    context_length: int = 0
+    context_limit: int = 0
+
+
+@dataclass
+class GeneratedAnswer:
+    """Output của stage generate (kết quả _generate_answer_with_tracking)."""
+
+    answer: str
+    chunks_used: List[dict]
+    answer_type: str
+    confidence: float
+    sentence_mapping: List[dict] = field(default_factory=list)
+
+
+@dataclass
+class StageTiming:
+    name: str
+    duration_ms: float = 0.0
+    count: Optional[int] = None
+
+
+class PipelineTrace:
+    """Thời gian + số lượng của từng stage trong 1 lần gọi ask()."""
+
+    def __init__(self):
+        self.stages: List[StageTiming] = []
+        self._started = time.perf_counter()
+        self._finished: Optional[float] = None
+
+    def finish(self) -> None:
+        self._finished = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        timing = StageTiming(name=name)
+        started = time.perf_counter()
+        try:
+            yield timing
+        finally:
+            timing.duration_ms = (time.perf_counter() - started) * 1000
+            self.stages.append(timing)
+
+    @property
+    def total_ms(self) -> float:
+        return ((self._finished or time.perf_counter()) - self._started) * 1000
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "total_ms": round(self.total_ms, 2),
+            "stages": [
+                {"name": s.name, "duration_ms": round(s.duration_ms, 2), "count": s.count}
+                for s in self.stages
+            ],
+        }
+
+    def summary(self) -> str:
+        parts = [f"{s.name}={s.duration_ms:.0f}ms" for s in self.stages]
+        return f"total={self.total_ms:.0f}ms " + " ".join(parts)
+
+    # Cho phép logger.info("... %s", trace): chỉ format khi record thực sự được ghi
+    __str__ = summary
+
+
+class PipelineMetrics:
+    """Cộng dồn số lần chạy / tổng thời gian / max theo stage (trong process)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Dict[str, float]] = {}
+        self.requests = 0
+
+    def record(self, trace: PipelineTrace) -> None:
+        with self._lock:
+            self.requests += 1
+            for timing in trace.stages:
+                stats = self._stages.setdefault(
+                    timing.name, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "items": 0}
+                )
+                stats["calls"] += 1
+                stats["total_ms"] += timing.duration_ms
+                stats["max_ms"] = max(stats["max_ms"], timing.duration_ms)
+                if timing.count is not None:
+                    stats["items"] += timing.count
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "stages": {
+                    name: {
+                        "calls": int(stats["calls"]),
+                        "avg_ms": round(stats["total_ms"] / stats["calls"], 2) if stats["calls"] else 0.0,
+                        "max_ms": round(stats["max_ms"], 2),
+                        "total_ms": round(stats["total_ms"], 2),
+                        "items": int(stats["items"]),
+                    }
+                    for name, stats in self._stages.items()
+                },
+            }
+
+
+pipeline_metrics = PipelineMetrics()
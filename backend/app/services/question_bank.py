@@ -0,0 +1,159 @@
+"""Ngân hàng câu hỏi: sinh sẵn câu hỏi nền sau khi upload, /quiz/generate chỉ đọc DB.
+
+- ``schedule_fill``: chạy nền, sinh câu hỏi bằng quiz_generator_service đến khi
+  đủ QUIZ_BANK_TARGET_SIZE câu chưa dùng (mỗi tài liệu + độ khó chỉ 1 task).
+- ``draw``: lấy đề từ ngân hàng; số câu chưa dùng còn lại < QUIZ_BANK_LOW_WATERMARK
+  → tự sinh bổ sung nền. Ngân hàng không đủ → None (router sinh trực tiếp).
+"""
+
+from __future__ import annotations
+
+import asyncio
+from typing import Dict, List, Optional, Set, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from ..core.config import settings
+from ..core.logger import get_logger
+from ..models.question_bank import (
+    add_bank_questions,
+    count_fresh_bank_questions,
+    draw_bank_questions,
+)
+from ..models.document import get_document_by_id
+from ..models.quiz import QuizQuestion
+from .quiz_generator import interleave_question_types, quiz_generator_service, split_question_types
+from .quiz_parser import is_valid_question
+
+logger = get_logger("question_bank")
+
+ALL_QUESTION_TYPES = ["multiple_choice", "true_false"]
+
+
+class QuestionBankService:
+    def __init__(self):
+        self._filling: Set[Tuple[str, str]] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def fill(
+        self,
+        db: AsyncIOMotorDatabase,
+        user_id: str,
+        document_id: str,
+        difficulty: str,
+    ) -> int:
+        """Sinh câu hỏi đến khi đủ target câu chưa dùng. Trả về số câu đã thêm."""
+        target = settings.quiz_bank_target_size
+        fresh = await count_fresh_bank_questions(db, user_id, document_id, difficulty)
+        missing = target - sum(fresh.values())
+        if missing <= 0:
+            return 0
+        added = 0
+        # Mỗi vòng tối đa 20 câu (giới hạn của generate_quiz); dừng nếu 1 vòng không thêm được câu nào
+        while missing > 0:
+            batch = min(max(missing, 5), 20)
+            questions = await quiz_generator_service.generate_quiz(
+                db=db,
+                user_id=user_id,
+                document_id=document_id,
+                num_questions=batch,
+                difficulty=difficulty,
+                question_types=ALL_QUESTION_TYPES,
+            )
+            valid = [q for q in questions if is_valid_question(q)]
+            for question in valid:
+                question.difficulty = difficulty
+            inserted = await add_bank_questions(db, user_id, document_id, difficulty, valid)
+            logger.debug(
+                "Question bank %s/%s: +%s (generated %s, valid %s)",
+                document_id, difficulty, inserted, len(questions), len(valid),
+            )
+            if inserted == 0:
+                break
+            added += inserted
+            missing -= inserted
+        return added
+
+    def schedule_fill(
+        self,
+        db: AsyncIOMotorDatabase,
+        user_id: str,
+        document_id: str,
+        difficulties: Optional[List[str]] = None,
+    ) -> None:
+        """Chạy fill nền (không chờ). Bỏ qua nếu tài liệu + độ khó đang được fill."""
+        if not settings.quiz_bank_enabled:
+            return
+        for difficulty in difficulties or settings.quiz_bank_prefill_difficulties:
+            key = (document_id, difficulty)
+            if key in self._filling:
+                continue
+            self._filling.add(key)
+            task = asyncio.create_task(self._fill_in_background(db, user_id, document_id, difficulty))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _fill_in_background(
+        self,
+        db: AsyncIOMotorDatabase,
+        user_id: str,
+        document_id: str,
+        difficulty: str,
+    ) -> None:
+        try:
+            await self.fill(db, user_id, document_id, difficulty)
+        except Exception as exc:
+            logger.warning("⚠️ Question bank fill failed for %s/%s: %s", document_id, difficulty, exc)
+        finally:
+            self._filling.discard((document_id, difficulty))
+
+    async def draw(
+        self,
+        db: AsyncIOMotorDatabase,
+        user_id: str,
+        document_id: str,
+        num_questions: int,
+        difficulty: str,
+        question_types: List[str],
+    ) -> Optional[List[QuizQuestion]]:
+        """Lấy đề từ ngân hàng; None nếu chưa đủ câu (đồng thời lên lịch sinh thêm)."""
+        if not settings.quiz_bank_enabled:
+            return None
+        num_mc, num_tf = split_question_types(num_questions, question_types)
+        counts: Dict[str, int] = {"multiple_choice": num_mc, "true_false": num_tf}
+        drawn = await draw_bank_questions(db, user_id, document_id, difficulty, counts)
+        if drawn is None:
+            await self._schedule_fill_if_owner(db, user_id, document_id, difficulty)
+            return None
+        if sum(drawn["fresh_remaining"].values()) < settings.quiz_bank_low_watermark:
+            await self._schedule_fill_if_owner(db, user_id, document_id, difficulty)
+        questions: List[QuizQuestion] = drawn["questions"]
+        # Xen kẽ MC/TF như đề sinh trực tiếp thay vì MC hết rồi mới TF
+        mc = [q for q in questions if q.question_type == "multiple_choice"]
+        tf = [q for q in questions if q.question_type == "true_false"]
+        types = interleave_question_types(len(mc), len(tf))
+        return [mc.pop(0) if t == "mc" else tf.pop(0) for t in types]
+
+    async def _schedule_fill_if_owner(
+        self,
+        db: AsyncIOMotorDatabase,
+        user_id: str,
+        document_id: str,
+        difficulty: str,
+    ) -> None:
+        """Chỉ sinh thêm câu (tốn lời gọi LLM) cho tài liệu còn tồn tại và thuộc ``user_id``."""
+        doc = await get_document_by_id(db, document_id)
+        if doc is None or doc.user_id != user_id:
+            logger.warning("Skipped question bank fill: document %s not owned by user %s", document_id, user_id)
+            return
+        self.schedule_fill(db, user_id, document_id, [difficulty])
+
+    async def drain(self) -> None:
+        """Hủy các task fill đang chạy (khi shutdown)."""
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+question_bank_service = QuestionBankService()
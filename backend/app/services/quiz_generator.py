@@ -1,13 +1,73 @@
 import asyncio
 import json
-import re
-from typing import List, Optional
+import logging
+import threading
+from typing import AsyncIterator, Dict, List, Optional
 import httpx
+import numpy as np
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
 from ..core.config import settings
+from ..core.logger import get_logger
 from ..models.document import get_document_by_id
+from ..models.question_bank import normalize_question_text
 from ..models.quiz import QuizQuestion
+from .embedding import EmbeddingService
+from .quiz_parser import (
+    IncrementalQuizParser,
+    is_valid_question,
+    parse_quiz_json,
+    parse_quiz_text,
+    quiz_parse_metrics,
+)
+
+logger = get_logger("quiz")
+
+QUIZ_TEXT_FORMAT = """[MC]
+Question: [Câu hỏi]
+A) [Đáp án A]
+B) [Đáp án B]
+Correct: A
+Explanation: [Giải thích ngắn]
+---
+
+[TF]
+Question: [Câu hỏi]
+Correct: Đúng
+Explanation: [Giải thích ngắn]
+---"""
+
+QUIZ_JSON_FORMAT = """Chỉ trả về JSON:
+{"questions": [
+  {"type": "MC", "question": "[Câu hỏi]", "options": ["[Đáp án A]", "[Đáp án B]"], "correct": "A", "explanation": "[Giải thích ngắn]"},
+  {"type": "TF", "question": "[Câu hỏi]", "correct": "Đúng", "explanation": "[Giải thích ngắn]"}
+]}"""
+
+
+def split_question_types(num_questions: int, question_types: List[str]) -> tuple:
+    """Số câu (trắc nghiệm, đúng/sai) cho 1 quiz."""
+    if "multiple_choice" in question_types and "true_false" in question_types:
+        # Mix: 70% multiple choice, 30% true/false
+        num_mc = int(num_questions * 0.7)
+        return num_mc, num_questions - num_mc
+    if "true_false" in question_types and "multiple_choice" not in question_types:
+        return 0, num_questions
+    return num_questions, 0
+
+
+def interleave_question_types(num_mc: int, num_tf: int) -> List[str]:
+    """["mc", "mc", "tf", ...] rải đều 2 loại (chia shard / sắp thứ tự câu trong đề)."""
+    total = num_mc + num_tf
+    types: List[str] = []
+    placed_tf = 0
+    for i in range(total):
+        # Đặt TF khi tỉ lệ TF đã đặt thấp hơn tỉ lệ mong muốn
+        if placed_tf < num_tf and (placed_tf + 1) * total <= (i + 1) * num_tf + total // 2:
+            types.append("tf")
+            placed_tf += 1
+        else:
+            types.append("mc")
+    return types
 
 
 class QuizGeneratorService:
@@ -27,22 +87,22 @@ class QuizGeneratorService:
             try:
                 from openai import OpenAI
                 self._openai_client = OpenAI(api_key=settings.openai_api_key)
-                print(f"[QuizGen] OpenAI client initialized")
+                logger.debug("OpenAI client initialized")
             except Exception as e:
-                print(f"[QuizGen] Failed to initialize OpenAI: {e}")
+                logger.error("Failed to initialize OpenAI: %s", e)
                 self._openai_client = None
         
         # Initialize Gemini if needed
         if self.provider == "gemini":
             self._gemini_api_key = settings.gemini_api_key
             if self._gemini_api_key:
-                print(f"[QuizGen] Gemini API initialized")
+                logger.debug("Gemini API initialized")
             else:
-                print("[QuizGen] Gemini API key not found")
+                logger.warning("Gemini API key not found")
                 self.provider = "local"
         
         if self.provider == "openai" and self._openai_client is None:
-            print("[QuizGen] Falling back to Gemini or error")
+            logger.error("Falling back to Gemini or error")
             self.provider = "gemini"
     
     async def generate_quiz(
@@ -56,97 +116,373 @@ class QuizGeneratorService:
     ) -> List[QuizQuestion]:
         """Generate quiz questions from a document using LLM"""
         
-        print(f"[QuizGen] Generating {num_questions} questions for document {document_id}")
-        print(f"[QuizGen] Difficulty: {difficulty}, Types: {question_types}")
+        logger.debug("Generating %s questions for document %s", num_questions, document_id)
+        logger.debug("Difficulty: %s, Types: %s", difficulty, question_types)
+        
+        doc, assignments = await self._plan_quiz(db, user_id, document_id, num_questions, question_types)
+        
+        semaphore = asyncio.Semaphore(max(settings.quiz_max_concurrent_calls, 1))
+        
+        async def run_shard(
+            assignment: dict,
+            num_mc: int,
+            num_tf: int,
+            avoid: Optional[List[str]] = None,
+        ) -> List[QuizQuestion]:
+            wanted = num_mc + num_tf
+            prompt = self._shard_prompt(assignment, doc.filename, num_mc, num_tf, difficulty, avoid)
+            async with semaphore:
+                try:
+                    generated = await self._generate_with_llm(prompt, wanted)
+                except Exception as e:
+                    logger.warning("⚠️ Quiz shard '%s' failed: %s", assignment["section"], e)
+                    return []
+            for question in generated:
+                if not question.section and assignment["section"]:
+                    question.section = assignment["section"]
+            return generated
+        
+        results = await asyncio.gather(*[
+            run_shard(a, a["num_mc"], a["num_tf"]) for a in assignments
+        ])
+        
+        # Hậu xử lý: bỏ câu gần trùng (embedding) + giữ quota mỗi shard/section,
+        # rồi chỉ xin câu thay thế cho đúng các slot bị thiếu/bị loại
+        quotas = [a["num_mc"] + a["num_tf"] for a in assignments]
+        vector_cache: Dict[str, np.ndarray] = {}
+        # Mỗi lần tạo quiz 1 service riêng: EmbeddingService tự chuyển sang local khi lỗi,
+        # không để trạng thái đó lan sang request khác
+        embedding_service = EmbeddingService()
+        kept = await self._select_questions(list(results), quotas, vector_cache, embedding_service)
+        for round_index in range(max(settings.quiz_replacement_rounds, 0)):
+            jobs = []
+            job_shards = []
+            for i, assignment in enumerate(assignments):
+                have_mc = sum(1 for q in kept[i] if q.question_type == "multiple_choice")
+                have_tf = len(kept[i]) - have_mc
+                missing_mc = max(assignment["num_mc"] - have_mc, 0)
+                missing_tf = max(assignment["num_tf"] - have_tf, 0)
+                if missing_mc + missing_tf == 0:
+                    continue
+                avoid = [q.question_text for q in kept[i]]
+                jobs.append(run_shard(assignment, missing_mc, missing_tf, avoid))
+                job_shards.append(i)
+            if not jobs:
+                break
+            logger.info(
+                "Quiz replacements round %s: %s/%s kept, re-asking %s shard(s)",
+                round_index + 1, sum(len(k) for k in kept), num_questions, len(jobs),
+            )
+            candidates = [list(k) for k in kept]
+            for i, extra in zip(job_shards, await asyncio.gather(*jobs)):
+                candidates[i].extend(extra)
+            kept = await self._select_questions(candidates, quotas, vector_cache, embedding_service)
+        
+        questions = self._merge_questions(kept, num_questions)
+        if not questions:
+            raise Exception(
+                "Không thể tạo quiz. Hệ thống AI đang gặp lỗi hoặc chưa được cấu hình đúng."
+            )
+        
+        logger.debug("Final result: Generated %s/%s questions", len(questions), num_questions)
+        return questions
+    
+    async def stream_quiz(
+        self,
+        db: AsyncIOMotorDatabase,
+        user_id: str,
+        document_id: str,
+        num_questions: int = 5,
+        difficulty: str = "medium",
+        question_types: List[str] = ["multiple_choice", "true_false"],
+    ) -> AsyncIterator[QuizQuestion]:
+        """Như generate_quiz nhưng trả từng câu ngay khi LLM viết xong block của câu đó.
+        
+        Các shard stream song song; câu hợp lệ, chưa trùng (theo text) và còn quota
+        của shard được yield theo thứ tự về trước. Không có vòng thay thế/dedup bằng
+        embedding (sẽ làm trễ câu đầu tiên) → có thể trả ít hơn ``num_questions`` câu.
+        """
+        doc, assignments = await self._plan_quiz(db, user_id, document_id, num_questions, question_types)
+        
+        semaphore = asyncio.Semaphore(max(settings.quiz_max_concurrent_calls, 1))
+        queue: asyncio.Queue = asyncio.Queue()
         
+        async def stream_shard(index: int, assignment: dict) -> None:
+            wanted = assignment["num_mc"] + assignment["num_tf"]
+            # Parser stream chỉ đọc định dạng text → luôn yêu cầu text, kể cả khi QUIZ_JSON_MODE bật
+            prompt = self._shard_prompt(
+                assignment, doc.filename, assignment["num_mc"], assignment["num_tf"], difficulty,
+                json_mode=False,
+            )
+            parser = IncrementalQuizParser()
+            try:
+                async with semaphore:
+                    async for text in self._stream_llm(prompt, wanted):
+                        for question in parser.feed(text):
+                            await queue.put((index, question))
+                    for question in parser.close():
+                        await queue.put((index, question))
+            except Exception as e:
+                logger.warning("⚠️ Quiz stream shard '%s' failed: %s", assignment["section"], e)
+            finally:
+                quiz_parse_metrics.record(parser.result, "stream")
+                for issue in parser.result.errors:
+                    logger.warning("⚠️ Skipped malformed quiz block (stream): %s", issue)
+                await queue.put((index, None))
+        
+        tasks = [asyncio.create_task(stream_shard(i, a)) for i, a in enumerate(assignments)]
+        kept = [0] * len(assignments)
+        seen = set()
+        emitted = 0
+        running = len(tasks)
+        try:
+            while running and emitted < num_questions:
+                index, question = await queue.get()
+                if question is None:
+                    running -= 1
+                    continue
+                assignment = assignments[index]
+                key = normalize_question_text(question.question_text)
+                if (
+                    kept[index] >= assignment["num_mc"] + assignment["num_tf"]
+                    or key in seen
+                    or not is_valid_question(question)
+                ):
+                    continue
+                if not question.section and assignment["section"]:
+                    question.section = assignment["section"]
+                seen.add(key)
+                kept[index] += 1
+                emitted += 1
+                yield question
+        finally:
+            # Đủ câu hoặc client ngắt kết nối → hủy các stream còn chạy
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def _shard_prompt(
+        self,
+        assignment: dict,
+        filename: str,
+        num_mc: int,
+        num_tf: int,
+        difficulty: str,
+        avoid: Optional[List[str]] = None,
+        json_mode: Optional[bool] = None,
+    ) -> str:
+        # Ngân sách context theo số câu của shard (giống công thức cũ, tính cho mỗi shard)
+        max_context_length = min(2000 + ((num_mc + num_tf) * 350), 10000)
+        context_text = self._shard_context(assignment["chunks"], max_context_length)
+        return self._build_quiz_prompt(
+            context_text, filename, num_mc, num_tf, difficulty, avoid_questions=avoid, json_mode=json_mode
+        )
+    
+    async def _plan_quiz(
+        self,
+        db: AsyncIOMotorDatabase,
+        user_id: str,
+        document_id: str,
+        num_questions: int,
+        question_types: List[str],
+    ) -> tuple:
+        """(document, assignments): mỗi assignment là 1 shard chunks + số câu MC/TF của shard."""
         # Get document
         doc = await get_document_by_id(db, document_id)
         if not doc or doc.user_id != user_id:
             raise ValueError("Document not found or not accessible")
         
-        # Get chunks from the document - OPTIMIZED: only get first 20 chunks
+        # Lấy toàn bộ chunks (chỉ các field cần) → các shard phủ cả tài liệu, không chỉ 20 chunk đầu
         chunks = await db["chunks"].find(
-            {"document_id": document_id}
-        ).sort("chunk_index", 1).to_list(length=20)
+            {"document_id": document_id},
+            {"content": 1, "chunk_index": 1, "metadata.section": 1},
+        ).sort("chunk_index", 1).to_list(length=None)
         
         if not chunks:
             raise ValueError("No content found in document to generate quiz")
         
-        # Build context from chunks - Điều chỉnh context dựa trên số câu hỏi (5-20)
-        context_parts = []
-        current_length = 0
-        # Tăng context dựa trên số câu hỏi: 5 câu = 3000, 10 câu = 5000, 15 câu = 7000, 20 câu = 9000
-        max_context_length = min(2000 + (num_questions * 350), 10000)
-        
-        # Tăng số chunks: 5 câu = 15 chunks, 10 câu = 20 chunks, 15-20 câu = 20 chunks
-        max_chunks = min(10 + num_questions, 20)
-        for chunk in chunks[:max_chunks]:
-            content = chunk.get("content", "")
-            if content:
-                # Check if adding this chunk would exceed limit
-                if current_length + len(content) > max_context_length:
-                    break
-                context_parts.append(content)
-                current_length += len(content)
-        
-        context_text = "\n\n".join(context_parts)
-        
-        # Final safety limit
-        if len(context_text) > max_context_length:
-            context_text = context_text[:max_context_length] + "..."
-        
-        print(f"[QuizGen] OPTIMIZED Context: {len(context_text)} chars from {len(context_parts)} chunks (limit: {max_context_length})")
-        
-        # Calculate how many of each type
-        if "multiple_choice" in question_types and "true_false" in question_types:
-            # Mix: 70% multiple choice, 30% true/false
-            num_mc = int(num_questions * 0.7)
-            num_tf = num_questions - num_mc
-        elif "multiple_choice" in question_types:
-            num_mc = num_questions
-            num_tf = 0
-        elif "true_false" in question_types:
-            num_mc = 0
-            num_tf = num_questions
-        else:
-            num_mc = num_questions
-            num_tf = 0
-        
-        # Build prompt
-        prompt = self._build_quiz_prompt(
-            context_text,
-            doc.filename,
-            num_mc,
-            num_tf,
-            difficulty
+        num_mc, num_tf = split_question_types(num_questions, question_types)
+        
+        # Chia tài liệu thành N phần liên tiếp (theo section nếu có), mỗi phần 1 lời gọi LLM nhỏ
+        per_shard = max(settings.quiz_questions_per_shard, 1)
+        num_shards = max(1, min(-(-num_questions // per_shard), settings.quiz_max_shards, len(chunks)))
+        shards = self._plan_shards(chunks, num_shards)
+        
+        # Chia loại câu hỏi xen kẽ cho các shard: shard i nhận types[i::n]
+        types = interleave_question_types(num_mc, num_tf)
+        assignments = []
+        for i, shard_chunks in enumerate(shards):
+            shard_types = types[i::len(shards)]
+            if not shard_types:
+                continue
+            assignments.append({
+                "chunks": shard_chunks,
+                "section": self._shard_section(shard_chunks),
+                "num_mc": shard_types.count("mc"),
+                "num_tf": shard_types.count("tf"),
+            })
+        
+        logger.debug(
+            "Quiz sharding: %s chunks → %s shards (%s)",
+            len(chunks), len(assignments), [a["num_mc"] + a["num_tf"] for a in assignments],
         )
+        return doc, assignments
+    
+    async def _embed_questions(
+        self, embedding_service: EmbeddingService, texts: List[str]
+    ) -> Optional[np.ndarray]:
+        """Embedding đã chuẩn hoá (L2) của các câu hỏi; lỗi → None (chỉ dedup theo text)."""
+        try:
+            vectors = await embedding_service.embed_texts(texts)
+        except Exception as e:
+            logger.warning("⚠️ Question embedding failed, falling back to text dedup: %s", e)
+            return None
+        if len(vectors) != len(texts):
+            return None
+        matrix = np.asarray(vectors, dtype="float32")
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+    
+    async def _select_questions(
+        self,
+        per_shard: List[List[QuizQuestion]],
+        quotas: List[int],
+        vector_cache: Dict[str, np.ndarray],
+        embedding_service: EmbeddingService,
+    ) -> List[List[QuizQuestion]]:
+        """Chọn câu cho từng shard: tối đa ``quotas[i]`` câu, bỏ câu trùng/gần trùng.
         
-        # Generate quiz using LLM - retry if not enough questions
-        max_attempts = 3
-        questions = []
+        Duyệt xen kẽ giữa các shard (câu 1 của mọi shard, rồi câu 2, ...) để câu
+        trùng giữa 2 shard không luôn bị loại ở cùng 1 shard. ``vector_cache``
+        (text chuẩn hoá → vector) giữ qua các vòng thay thế: chỉ embed câu mới.
+        """
+        new_texts = {}
+        for shard in per_shard:
+            for question in shard:
+                key = normalize_question_text(question.question_text)
+                if key not in vector_cache and key not in new_texts:
+                    new_texts[key] = question.question_text
+        if new_texts:
+            matrix = await self._embed_questions(embedding_service, list(new_texts.values()))
+            if matrix is not None:
+                for key, vector in zip(new_texts.keys(), matrix):
+                    vector_cache[key] = vector
         
-        for attempt in range(max_attempts):
-            try:
-                generated = await self._generate_with_llm(prompt, num_questions)
-                questions = generated
-                
-                # Nếu đã tạo đủ hoặc gần đủ số câu hỏi (>= 80%), chấp nhận
-                if len(questions) >= num_questions * 0.8:
-                    print(f"[QuizGen] ✅ Generated {len(questions)}/{num_questions} questions (attempt {attempt + 1})")
-                    break
-                else:
-                    print(f"[QuizGen] ⚠️ Only generated {len(questions)}/{num_questions} questions, retrying... (attempt {attempt + 1}/{max_attempts})")
-                    if attempt < max_attempts - 1:
-                        await asyncio.sleep(2)  # Wait 2 seconds before retry
-            except Exception as e:
-                print(f"[QuizGen] ❌ Attempt {attempt + 1} failed: {e}")
-                if attempt < max_attempts - 1:
-                    await asyncio.sleep(2)
-                else:
-                    raise
+        threshold = settings.quiz_dedup_threshold
+        kept: List[List[QuizQuestion]] = [[] for _ in per_shard]
+        kept_vectors: List[np.ndarray] = []
+        seen = set()
+        dropped_duplicates = dropped_quota = 0
+        longest = max((len(shard) for shard in per_shard), default=0)
+        for position in range(longest):
+            for i, shard in enumerate(per_shard):
+                if position >= len(shard):
+                    continue
+                question = shard[position]
+                if len(kept[i]) >= quotas[i]:
+                    dropped_quota += 1
+                    continue
+                key = normalize_question_text(question.question_text)
+                if key in seen:
+                    dropped_duplicates += 1
+                    continue
+                vector = vector_cache.get(key)
+                # Provider đổi giữa các vòng (fallback local) → vector khác số chiều: chỉ so cùng chiều
+                comparable = [v for v in kept_vectors if vector is not None and v.shape == vector.shape]
+                if comparable and float(np.max(np.stack(comparable) @ vector)) >= threshold:
+                    dropped_duplicates += 1
+                    continue
+                seen.add(key)
+                if vector is not None:
+                    kept_vectors.append(vector)
+                kept[i].append(question)
+        if dropped_duplicates or dropped_quota:
+            logger.debug(
+                "Question selection: dropped %s near-duplicate(s), %s over quota",
+                dropped_duplicates, dropped_quota,
+            )
+        return kept
+    
+    @staticmethod
+    def _chunk_section(chunk: dict) -> Optional[str]:
+        return (chunk.get("metadata") or {}).get("section")
+    
+    def _plan_shards(self, chunks: List[dict], num_shards: int) -> List[List[dict]]:
+        """Chia chunks thành ``num_shards`` đoạn liên tiếp có độ dài (ký tự) gần bằng nhau.
         
-        print(f"[QuizGen] Final result: Generated {len(questions)}/{num_questions} questions")
-        return questions
+        Nếu tài liệu có đủ section thì chỉ cắt ở ranh giới section.
+        """
+        # Gom các chunk liên tiếp cùng section
+        groups: List[List[dict]] = []
+        for chunk in chunks:
+            if groups and self._chunk_section(groups[-1][-1]) == self._chunk_section(chunk):
+                groups[-1].append(chunk)
+            else:
+                groups.append([chunk])
+        if len(groups) < num_shards:
+            groups = [[chunk] for chunk in chunks]
+        
+        sizes = [sum(len(c.get("content") or "") for c in group) for group in groups]
+        target = sum(sizes) / num_shards if num_shards else 0
+        shards: List[List[dict]] = [[]]
+        accumulated = 0.0
+        for index, (group, size) in enumerate(zip(groups, sizes)):
+            remaining_groups = len(groups) - index
+            remaining_shards = num_shards - len(shards)
+            # Sang shard mới khi group này nằm quá nửa sau mốc tải của shard hiện tại,
+            # hoặc khi số group còn lại chỉ vừa đủ cho các shard còn lại
+            if shards[-1] and remaining_shards > 0 and (
+                accumulated + size / 2 > target * len(shards) or remaining_groups <= remaining_shards
+            ):
+                shards.append([])
+            shards[-1].extend(group)
+            accumulated += size
+        return [shard for shard in shards if shard]
+    
+    @staticmethod
+    def _shard_context(shard_chunks: List[dict], max_chars: int) -> str:
+        """Context cho 1 shard; shard dài hơn ngân sách → lấy chunk rải đều cả shard."""
+        contents = [c.get("content") or "" for c in shard_chunks if c.get("content")]
+        total = sum(len(c) for c in contents)
+        if total > max_chars and len(contents) > 1:
+            stride = -(-total // max_chars)
+            contents = contents[::stride]
+        parts: List[str] = []
+        length = 0
+        for content in contents:
+            if length + len(content) > max_chars:
+                if not parts:
+                    parts.append(content[:max_chars] + "...")
+                break
+            parts.append(content)
+            length += len(content) + 2
+        return "\n\n".join(parts)
+    
+    def _shard_section(self, shard_chunks: List[dict]) -> Optional[str]:
+        sections = [self._chunk_section(c) for c in shard_chunks if self._chunk_section(c)]
+        if not sections:
+            return None
+        return max(set(sections), key=sections.count)
+    
+    def _merge_questions(self, results: List[List[QuizQuestion]], limit: int) -> List[QuizQuestion]:
+        """Gộp kết quả các shard xen kẽ (shard 1 câu 1, shard 2 câu 1, ...), bỏ câu trùng."""
+        merged: List[QuizQuestion] = []
+        seen = set()
+        longest = max((len(r) for r in results), default=0)
+        for position in range(longest):
+            for result in results:
+                if position >= len(result):
+                    continue
+                question = result[position]
+                key = normalize_question_text(question.question_text)
+                if key in seen:
+                    continue
+                seen.add(key)
+                merged.append(question)
+                if len(merged) >= limit:
+                    return merged
+        return merged
     
     def _build_quiz_prompt(
         self,
@@ -155,8 +491,10 @@ class QuizGeneratorService:
         num_mc: int,
         num_tf: int,
         difficulty: str,
+        avoid_questions: Optional[List[str]] = None,
+        json_mode: Optional[bool] = None,
     ) -> str:
-        """Build prompt for LLM to generate quiz"""
+        """Build prompt for LLM to generate quiz (``json_mode=None`` → theo QUIZ_JSON_MODE)"""
         
         difficulty_guide = {
             "easy": """Câu hỏi DỄ (nhớ & hiểu):
@@ -183,6 +521,16 @@ class QuizGeneratorService:
             "hard": "KHÓ: nguyên lý, phân tích sâu"
         }
         
+        # Vòng thay thế: liệt kê câu đã có để LLM không sinh lại câu tương tự
+        avoid_block = ""
+        if avoid_questions:
+            listed = "\n".join(f"- {text}" for text in avoid_questions)
+            avoid_block = f"- KHÔNG lặp lại hoặc hỏi lại ý của các câu đã có:\n{listed}\n"
+        
+        if json_mode is None:
+            json_mode = settings.quiz_json_mode
+        output_format = QUIZ_JSON_FORMAT if json_mode else QUIZ_TEXT_FORMAT
+        
         prompt = f"""Tạo {num_mc + num_tf} câu hỏi từ tài liệu.
 
 NỘI DUNG:
@@ -192,21 +540,9 @@ YÊU CẦU:
 - {num_mc} câu TRẮC NGHIỆM (2 đáp án A, B)
 - {num_tf} câu ĐÚNG/SAI
 - Độ khó: {difficulty_short.get(difficulty, difficulty_short["medium"])}
-
+{avoid_block}
 ĐỊNH DẠNG:
-[MC]
-Question: [Câu hỏi]
-A) [Đáp án A]
-B) [Đáp án B]
-Correct: A
-Explanation: [Giải thích ngắn]
----
-
-[TF]
-Question: [Câu hỏi]
-Correct: Đúng
-Explanation: [Giải thích ngắn]
----
+{output_format}
 
 Tạo {num_mc + num_tf} câu hỏi:"""
         
@@ -237,39 +573,43 @@ Tạo {num_mc + num_tf} câu hỏi:"""
                             "topP": 0.95,
                         }
                     }
+                    if settings.quiz_json_mode:
+                        payload["generationConfig"]["responseMimeType"] = "application/json"
                     
-                    print(f"[QuizGen] Calling Gemini API (attempt {attempt + 1}/{max_retries}) to generate {num_questions} questions")
-                    print(f"[QuizGen] Prompt length: {len(prompt)} chars")
+                    logger.debug("Calling Gemini API (attempt %s/%s) to generate %s questions", attempt + 1, max_retries, num_questions)
+                    logger.debug("Prompt length: %s chars", len(prompt))
                     
                     async with httpx.AsyncClient(timeout=120.0) as client:
                         response = await client.post(url, params=params, json=payload)
                         response.raise_for_status()
                         data = response.json()
                         
-                        print(f"[QuizGen] Gemini response keys: {data.keys()}")
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug("Gemini response keys: %s", data.keys())
                         
                         if "candidates" in data and len(data["candidates"]) > 0:
                             candidate = data["candidates"][0]
-                            print(f"[QuizGen] Candidate keys: {candidate.keys()}")
+                            if logger.isEnabledFor(logging.DEBUG):
+                                logger.debug("Candidate keys: %s", candidate.keys())
                             
                             # Check finishReason
                             finish_reason = None
                             if "finishReason" in candidate:
                                 finish_reason = candidate["finishReason"]
-                                print(f"[QuizGen] Finish reason: {finish_reason}")
+                                logger.debug("Finish reason: %s", finish_reason)
                                 if finish_reason in ["SAFETY", "RECITATION", "OTHER"]:
-                                    print(f"[QuizGen] ⚠️ Request blocked by Gemini: {finish_reason}")
+                                    logger.warning("⚠️ Request blocked by Gemini: %s", finish_reason)
                                     raise Exception(f"Gemini blocked request: {finish_reason}")
                                 # MAX_TOKENS is OK - we can still try to parse partial response
                                 if finish_reason == "MAX_TOKENS":
-                                    print(f"[QuizGen] ⚠️ Response truncated (MAX_TOKENS), but will try to parse partial response")
+                                    logger.warning("⚠️ Response truncated (MAX_TOKENS), but will try to parse partial response")
                             
                             # Handle different response formats - improved parsing
                             full_response = None
                             
                             # Debug: print full candidate structure (truncated for readability)
                             candidate_str = json.dumps(candidate, indent=2, ensure_ascii=False)
-                            print(f"[QuizGen] Full candidate: {candidate_str[:1000]}")
+                            logger.debug("Full candidate: %s", candidate_str[:1000])
                             
                             # Try to extract text from various locations in the response
                             def extract_text_recursive(obj, depth=0, max_depth=5):
@@ -304,7 +644,8 @@ Tạo {num_mc + num_tf} câu hỏi:"""
                             # Try standard parsing first
                             if "content" in candidate:
                                 content = candidate["content"]
-                                print(f"[QuizGen] Content type: {type(content)}, keys: {content.keys() if isinstance(content, dict) else 'N/A'}")
+                                if logger.isEnabledFor(logging.DEBUG):
+                                    logger.debug("Content type: %s, keys: %s", type(content), content.keys() if isinstance(content, dict) else 'N/A')
                                 
                                 # Case 1: Standard format - content.parts[0].text
                                 if isinstance(content, dict) and "parts" in content:
@@ -317,7 +658,7 @@ Tạo {num_mc + num_tf} câu hỏi:"""
                                 
                                 # Case 2: content chỉ có role, không có parts - thử recursive search
                                 elif isinstance(content, dict) and "role" in content and "parts" not in content:
-                                    print(f"[QuizGen] ⚠️ Content only has 'role', trying recursive search...")
+                                    logger.warning("⚠️ Content only has 'role', trying recursive search...")
                                     full_response = extract_text_recursive(candidate)
                                 
                                 # Case 3: content is a dict with "text" directly
@@ -338,7 +679,7 @@ Tạo {num_mc + num_tf} câu hỏi:"""
                             
                             # Fallback: recursive search in entire candidate
                             if not full_response:
-                                print(f"[QuizGen] Trying recursive search in candidate...")
+                                logger.debug("Trying recursive search in candidate...")
                                 full_response = extract_text_recursive(candidate)
                             
                             # Final fallback: check candidate directly
@@ -349,41 +690,45 @@ Tạo {num_mc + num_tf} câu hỏi:"""
                                     full_response = candidate
                             
                             if not full_response:
-                                print(f"[QuizGen] ❌ Could not extract text from candidate")
-                                print(f"[QuizGen] Full candidate structure: {json.dumps(candidate, indent=2, ensure_ascii=False)}")
+                                logger.error("❌ Could not extract text from candidate")
+                                if logger.isEnabledFor(logging.DEBUG):
+                                    logger.debug("Full candidate structure: %s", json.dumps(candidate, indent=2, ensure_ascii=False))
                                 raise Exception("Could not extract text from Gemini response")
                             
-                            print(f"[QuizGen] ✅ Extracted response: {len(full_response)} chars")
+                            logger.debug("✅ Extracted response: %s chars", len(full_response))
                             
                             questions = self._parse_quiz_response(full_response)
-                            print(f"[QuizGen] ✅ Gemini generated {len(questions)} questions successfully")
+                            logger.debug("✅ Gemini generated %s questions successfully", len(questions))
                             
                             if len(questions) == 0:
-                                print(f"[QuizGen] ⚠️ No questions parsed from response")
-                                print(f"[QuizGen] Response preview: {full_response[:500]}")
+                                logger.warning("⚠️ No questions parsed from response")
+                                logger.debug("Response preview: %s", full_response[:500])
+                                if attempt < max_retries - 1:
+                                    quiz_parse_metrics.record_retry()
+                                    continue
                                 raise Exception("Failed to parse questions from Gemini response")
                             
                             return questions
                         else:
-                            print(f"[QuizGen] Gemini API returned unexpected format: {data}")
+                            logger.debug("Gemini API returned unexpected format: %s", data)
                             raise Exception("Unexpected response format from Gemini")
                     
                 except httpx.HTTPStatusError as e:
                     # Check if it's a 503 (Service Unavailable) or 429 (Rate Limit)
                     if e.response.status_code in [503, 429] and attempt < max_retries - 1:
                         wait_time = (attempt + 1) * 2  # Exponential backoff: 2s, 4s, 6s
-                        print(f"[QuizGen] Gemini {e.response.status_code} error, retrying in {wait_time}s...")
+                        logger.error("Gemini %s error, retrying in %ss...", e.response.status_code, wait_time)
                         await asyncio.sleep(wait_time)
                         continue
                     else:
-                        print(f"[QuizGen] Gemini API call failed after {attempt + 1} attempts: {e}")
+                        logger.error("Gemini API call failed after %s attempts: %s", attempt + 1, e)
                         import traceback
-                        print(f"[QuizGen] Traceback: {traceback.format_exc()}")
+                        logger.error("Traceback: %s", traceback.format_exc())
                         break
                 except Exception as e:
-                    print(f"[QuizGen] Gemini API call failed: {e}")
+                    logger.error("Gemini API call failed: %s", e)
                     import traceback
-                    print(f"[QuizGen] Traceback: {traceback.format_exc()}")
+                    logger.error("Traceback: %s", traceback.format_exc())
                     break
         
         # Try OpenAI
@@ -400,258 +745,136 @@ Tạo {num_mc + num_tf} câu hỏi:"""
                     },
                 ]
                 
-                print(f"[QuizGen] Calling OpenAI API to generate questions")
-                response = await asyncio.to_thread(
-                    self._openai_client.chat.completions.create,
-                    model=self.model,
-                    messages=messages,
-                    max_tokens=self.max_tokens,
-                    temperature=0.7,
-                )
-                
-                full_response = response.choices[0].message.content
-                questions = self._parse_quiz_response(full_response)
-                print(f"[QuizGen] OpenAI generated {len(questions)} questions")
+                extra = {"response_format": {"type": "json_object"}} if settings.quiz_json_mode else {}
+                questions: List[QuizQuestion] = []
+                # Parse không ra câu nào → gọi lại 1 lần
+                for attempt in range(2):
+                    logger.debug("Calling OpenAI API to generate questions")
+                    response = await asyncio.to_thread(
+                        self._openai_client.chat.completions.create,
+                        model=self.model,
+                        messages=messages,
+                        max_tokens=self.max_tokens,
+                        temperature=0.7,
+                        **extra,
+                    )
+                    
+                    full_response = response.choices[0].message.content or ""
+                    questions = self._parse_quiz_response(full_response)
+                    if questions or attempt == 1:
+                        break
+                    quiz_parse_metrics.record_retry()
+                logger.debug("OpenAI generated %s questions", len(questions))
                 return questions
                 
             except Exception as e:
-                print(f"[QuizGen] OpenAI API call failed: {e}")
+                logger.error("OpenAI API call failed: %s", e)
         
         # Fallback error
         raise Exception(
             "Không thể tạo quiz. Hệ thống AI đang gặp lỗi hoặc chưa được cấu hình đúng."
         )
     
-    def _parse_quiz_response(self, response: str) -> List[QuizQuestion]:
-        """Parse LLM response to extract quiz questions"""
-        
-        questions = []
-        
-        # Try multiple delimiters
-        delimiters = ["---", "\n---\n", "---\n"]
-        parts = []
-        for delimiter in delimiters:
-            if delimiter in response:
-                parts = response.split(delimiter)
-                print(f"[QuizGen] Split by '{delimiter}': {len(parts)} parts")
-                break
+    async def _stream_llm(self, prompt: str, num_questions: int) -> AsyncIterator[str]:
+        """Các mảnh text LLM trả về theo thời gian thực (Gemini SSE / OpenAI stream)."""
+        if self.provider == "gemini" and self._gemini_api_key:
+            url = f"{self._gemini_base_url}/{self.model}:streamGenerateContent"
+            params = {"key": self._gemini_api_key, "alt": "sse"}
+            payload = {
+                "contents": [{"parts": [{"text": prompt}]}],
+                "generationConfig": {
+                    "temperature": 0.7,
+                    "maxOutputTokens": min(2000 + (num_questions * 300), 8000),
+                    "topK": 40,
+                    "topP": 0.95,
+                },
+            }
+            async with httpx.AsyncClient(timeout=httpx.Timeout(120.0, connect=10.0)) as client:
+                async with client.stream("POST", url, params=params, json=payload) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = json.loads(line[5:])
+                        for candidate in data.get("candidates", [])[:1]:
+                            if candidate.get("finishReason") in ["SAFETY", "RECITATION", "OTHER"]:
+                                raise Exception(f"Gemini blocked request: {candidate['finishReason']}")
+                            for part in candidate.get("content", {}).get("parts", []):
+                                if part.get("text"):
+                                    yield part["text"]
+            return
         
-        # If no delimiter, try to find [MC] and [TF] markers
-        if not parts or len(parts) == 1:
-            print(f"[QuizGen] No delimiter found, searching for [MC] and [TF] markers")
-            mc_positions = [m.start() for m in re.finditer(r'\[MC\]', response)]
-            tf_positions = [m.start() for m in re.finditer(r'\[TF\]', response)]
-            all_positions = sorted([(pos, 'MC') for pos in mc_positions] + [(pos, 'TF') for pos in tf_positions])
-            
-            if all_positions:
-                parts = []
-                for i, (pos, qtype) in enumerate(all_positions):
-                    start = pos
-                    end = all_positions[i + 1][0] if i + 1 < len(all_positions) else len(response)
-                    parts.append(response[start:end])
-                print(f"[QuizGen] Found {len(parts)} questions by markers")
-        
-        for i, part in enumerate(parts):
-            part = part.strip()
-            if not part or len(part) < 20:  # Skip very short parts
-                continue
-            
-            print(f"[QuizGen] Parsing part {i+1}/{len(parts)} (length: {len(part)} chars)")
-            
-            # Detect question type (more flexible)
-            if "[MC]" in part or ("Question:" in part and ("A)" in part or "B)" in part)):
-                question = self._parse_multiple_choice(part)
-                if question:
-                    questions.append(question)
-                    print(f"[QuizGen] ✅ Parsed MC question {len(questions)}")
-                else:
-                    print(f"[QuizGen] ❌ Failed to parse MC question from part {i+1}")
-            elif "[TF]" in part or "Đúng" in part or "Sai" in part:
-                question = self._parse_true_false(part)
-                if question:
-                    questions.append(question)
-                    print(f"[QuizGen] ✅ Parsed TF question {len(questions)}")
-                else:
-                    print(f"[QuizGen] ❌ Failed to parse TF question from part {i+1}")
-        
-        print(f"[QuizGen] Total parsed: {len(questions)} questions")
-        return questions
-    
-    def _parse_multiple_choice(self, text: str) -> Optional[QuizQuestion]:
-        """Parse multiple choice question (2 đáp án A, B)"""
-        try:
-            # Extract question - more flexible patterns
-            question_patterns = [
-                r'Question:\s*(.+?)(?=\n[A-B][\)\.])',
-                r'Q:\s*(.+?)(?=\n[A-B][\)\.])',
-                r'(.+?)(?=\nA\)|A\.)',
-            ]
-            
-            question_text = None
-            for pattern in question_patterns:
-                question_match = re.search(pattern, text, re.DOTALL | re.IGNORECASE)
-                if question_match:
-                    question_text = question_match.group(1).strip()
-                    # Clean up [MC] prefix
-                    question_text = re.sub(r'^\[MC\]\s*', '', question_text, flags=re.IGNORECASE)
-                    break
+        if self.provider == "openai" and self._openai_client:
+            # SDK OpenAI đồng bộ: đọc stream trong thread, chuyển từng mảnh về event loop qua queue
+            loop = asyncio.get_running_loop()
+            queue: asyncio.Queue = asyncio.Queue()
+            done = object()
+            stop = threading.Event()
             
-            if not question_text:
-                print(f"[QuizGen] Could not extract question from: {text[:200]}")
-                return None
+            def read_stream():
+                try:
+                    stream = self._openai_client.chat.completions.create(
+                        model=self.model,
+                        messages=[
+                            {
+                                "role": "system",
+                                "content": "Bạn là giáo viên chuyên nghiệp tạo câu hỏi trắc nghiệm từ tài liệu học tập."
+                            },
+                            {"role": "user", "content": prompt},
+                        ],
+                        max_tokens=self.max_tokens,
+                        temperature=0.7,
+                        stream=True,
+                    )
+                    for event in stream:
+                        if stop.is_set():
+                            # Consumer đã dừng (đủ câu / client ngắt) → đóng kết nối
+                            stream.close()
+                            break
+                        delta = event.choices[0].delta.content if event.choices else None
+                        if delta:
+                            loop.call_soon_threadsafe(queue.put_nowait, delta)
+                except Exception as e:
+                    loop.call_soon_threadsafe(queue.put_nowait, e)
+                finally:
+                    loop.call_soon_threadsafe(queue.put_nowait, done)
             
-            # Extract options - chỉ tìm A và B
-            options = []
-            for letter in ['A', 'B']:
-                option_patterns = [
-                    rf'{letter}[\)\.]\s*(.+?)(?=\n[A-B][\)\.]|Correct:|Explanation:|$)',
-                    rf'{letter}\)\s*(.+?)(?=\n[A-B]\)|Correct:|$)',
-                ]
-                
-                option_text = None
-                for pattern in option_patterns:
-                    option_match = re.search(pattern, text, re.DOTALL | re.IGNORECASE)
-                    if option_match:
-                        option_text = option_match.group(1).strip()
+            loop.run_in_executor(None, read_stream)
+            try:
+                while True:
+                    item = await queue.get()
+                    if item is done:
                         break
-                
-                if option_text:
-                    options.append(option_text)
-            
-            if len(options) < 2:
-                print(f"[QuizGen] Only found {len(options)} options, need 2")
-                return None
-            
-            # Extract correct answer - chỉ A hoặc B
-            correct_patterns = [
-                r'Correct:\s*([A-B])',
-                r'Answer:\s*([A-B])',
-                r'Đáp án:\s*([A-B])',
-            ]
-            
-            correct_letter = None
-            for pattern in correct_patterns:
-                correct_match = re.search(pattern, text, re.IGNORECASE)
-                if correct_match:
-                    correct_letter = correct_match.group(1).upper()
-                    break
-            
-            if not correct_letter or correct_letter not in ['A', 'B']:
-                print(f"[QuizGen] Could not find valid correct answer (A or B)")
-                return None
-            
-            correct_index = ord(correct_letter) - ord('A')
-            correct_answer = options[correct_index] if 0 <= correct_index < len(options) else options[0]
-            
-            # Extract explanation
-            explanation_patterns = [
-                r'Explanation:\s*(.+?)(?=Section:|$)',
-                r'Giải thích:\s*(.+?)(?=Section:|$)',
-            ]
-            
-            explanation = "Không có giải thích"
-            for pattern in explanation_patterns:
-                explanation_match = re.search(pattern, text, re.DOTALL | re.IGNORECASE)
-                if explanation_match:
-                    explanation = explanation_match.group(1).strip()
-                    break
-            
-            # Extract section (optional)
-            section_match = re.search(r'Section:\s*(.+?)(?=\n|$)', text, re.IGNORECASE)
-            section = section_match.group(1).strip() if section_match else None
-            
-            return QuizQuestion(
-                question_type="multiple_choice",
-                question_text=question_text,
-                options=options[:2],  # Chỉ lấy 2 đáp án
-                correct_answer=correct_answer,
-                explanation=explanation,
-                section=section,
-            )
-        except Exception as e:
-            print(f"[QuizGen] Error parsing MC question: {e}")
-            import traceback
-            print(f"[QuizGen] Traceback: {traceback.format_exc()}")
-            return None
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                stop.set()
+            return
+        
+        raise Exception(
+            "Không thể tạo quiz. Hệ thống AI đang gặp lỗi hoặc chưa được cấu hình đúng."
+        )
     
-    def _parse_true_false(self, text: str) -> Optional[QuizQuestion]:
-        """Parse true/false question"""
-        try:
-            # Extract question - more flexible
-            question_patterns = [
-                r'Question:\s*(.+?)(?=Correct:|Answer:|Đáp án:)',
-                r'Q:\s*(.+?)(?=Correct:|Answer:)',
-                r'(.+?)(?=Correct:|Answer:)',
-            ]
-            
-            question_text = None
-            for pattern in question_patterns:
-                question_match = re.search(pattern, text, re.DOTALL | re.IGNORECASE)
-                if question_match:
-                    question_text = question_match.group(1).strip()
-                    # Clean up [TF] prefix
-                    question_text = re.sub(r'^\[TF\]\s*', '', question_text, flags=re.IGNORECASE)
-                    break
-            
-            if not question_text:
-                print(f"[QuizGen] Could not extract TF question from: {text[:200]}")
-                return None
-            
-            # Extract correct answer - more flexible
-            correct_patterns = [
-                r'Correct:\s*(Đúng|Sai|True|False|T|F)',
-                r'Answer:\s*(Đúng|Sai|True|False)',
-                r'Đáp án:\s*(Đúng|Sai)',
-            ]
-            
-            correct_text = None
-            for pattern in correct_patterns:
-                correct_match = re.search(pattern, text, re.IGNORECASE)
-                if correct_match:
-                    correct_text = correct_match.group(1)
-                    break
-            
-            if not correct_text:
-                print(f"[QuizGen] Could not find TF correct answer")
-                return None
-            
-            # Normalize to Vietnamese
-            correct_text_lower = correct_text.lower().strip()
-            if correct_text_lower in ['đúng', 'true', 't']:
-                correct_answer = "Đúng"
-            else:
-                correct_answer = "Sai"
-            
-            # Extract explanation
-            explanation_patterns = [
-                r'Explanation:\s*(.+?)(?=Section:|$)',
-                r'Giải thích:\s*(.+?)(?=Section:|$)',
-            ]
-            
-            explanation = "Không có giải thích"
-            for pattern in explanation_patterns:
-                explanation_match = re.search(pattern, text, re.DOTALL | re.IGNORECASE)
-                if explanation_match:
-                    explanation = explanation_match.group(1).strip()
-                    break
-            
-            # Extract section (optional)
-            section_match = re.search(r'Section:\s*(.+?)(?=\n|$)', text, re.IGNORECASE)
-            section = section_match.group(1).strip() if section_match else None
-            
-            return QuizQuestion(
-                question_type="true_false",
-                question_text=question_text,
-                options=["Đúng", "Sai"],
-                correct_answer=correct_answer,
-                explanation=explanation,
-                section=section,
-            )
-        except Exception as e:
-            print(f"[QuizGen] Error parsing TF question: {e}")
-            import traceback
-            print(f"[QuizGen] Traceback: {traceback.format_exc()}")
-            return None
+    def _parse_quiz_response(self, response: str) -> List[QuizQuestion]:
+        """Parse LLM response to extract quiz questions"""
+        fmt = "text"
+        result = None
+        if settings.quiz_json_mode:
+            try:
+                result = parse_quiz_json(response)
+                fmt = "json"
+            except ValueError as e:
+                # LLM không trả JSON (model/endpoint không hỗ trợ) → thử định dạng [MC]/[TF]
+                quiz_parse_metrics.record_json_fallback()
+                logger.warning("⚠️ Quiz JSON response invalid (%s), falling back to text parser", e)
+        if result is None:
+            result = parse_quiz_text(response)
+        quiz_parse_metrics.record(result, fmt)
+        for issue in result.errors:
+            logger.warning("⚠️ Skipped malformed quiz block (%s): %s", fmt, issue)
+        logger.debug("Total parsed: %s questions (%s errors)", len(result.questions), len(result.errors))
+        return result.questions
 
 
 quiz_generator_service = QuizGeneratorService()
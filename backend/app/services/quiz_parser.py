@@ -0,0 +1,338 @@
+"""Parser 1 lượt cho output quiz của LLM + bộ đếm lỗi parse.
+
+Định dạng text (xem ``_build_quiz_prompt``)::
+
+    [MC]
+    Question: ...
+    A) ...
+    B) ...
+    Correct: A
+    Explanation: ...
+    ---
+
+``parse_quiz_text`` đọc từng dòng đúng 1 lần với 1 regex đã compile và 1 máy
+trạng thái (block hiện tại + field đang ghi); dòng không có nhãn được nối vào
+field trước đó. Block hỏng không làm hỏng cả response: lỗi được ghi lại kèm
+vị trí (dòng, cột) trong ``ParseResult.errors``.
+
+``parse_quiz_json`` dùng cho chế độ JSON (QUIZ_JSON_MODE): LLM trả về
+``{"questions": [{"type", "question", "options", "correct", "explanation", "section"}]}``.
+"""
+
+from __future__ import annotations
+
+import json
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from ..models.quiz import QuizQuestion
+
+# 1 dòng = [marker] + (nhãn "Key:" | "A)"/"B.") + phần còn lại
+_LINE_RE = re.compile(
+    r"""^[ \t*#>]*
+    (?:\d+[\).][ \t*]*(?=\[(?:MC|TF)\]|(?:question|q|câu\ hỏi)[ \t*]*:))?  # "1." / "2)" trước marker
+    (?:\[(?P<marker>MC|TF)\][ \t*]*)?
+    (?:
+        (?P<key>question|q|câu\ hỏi|correct|answer|đáp\ án|explanation|giải\ thích|section)[ \t*]*:[ \t*]*
+      | (?P<option>[AB])[\).][ \t]*
+    )?
+    (?P<rest>.*?)[ \t*]*$""",
+    re.IGNORECASE | re.VERBOSE,
+)
+_SEPARATOR_RE = re.compile(r"^[ \t]*-{3,}[ \t]*$")
+_MC_ANSWER_RE = re.compile(r"^[\(\[]?([AB])\b", re.IGNORECASE)
+_JSON_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+
+_KEY_FIELDS = {
+    "question": "question", "q": "question", "câu hỏi": "question",
+    "correct": "correct", "answer": "correct", "đáp án": "correct",
+    "explanation": "explanation", "giải thích": "explanation",
+    "section": "section",
+}
+_TRUE_VALUES = {"đúng", "true", "t"}
+_FALSE_VALUES = {"sai", "false", "f"}
+DEFAULT_EXPLANATION = "Không có giải thích"
+
+
+@dataclass
+class ParseIssue:
+    """Lỗi 1 block: vị trí (1-based) của dòng bắt đầu block / dòng gây lỗi."""
+
+    line: int
+    column: int
+    message: str
+
+    def __str__(self) -> str:
+        return f"line {self.line}, col {self.column}: {self.message}"
+
+
+@dataclass
+class ParseResult:
+    questions: List[QuizQuestion] = field(default_factory=list)
+    errors: List[ParseIssue] = field(default_factory=list)
+
+
+class _Block:
+    def __init__(self, line: int, column: int, marker: Optional[str] = None):
+        self.line = line
+        self.column = column
+        self.marker = marker
+        self.fields: Dict[str, List[str]] = {}
+        self.options: Dict[str, List[str]] = {}
+        self.current: Optional[List[str]] = None
+        self.positions: Dict[str, tuple] = {}
+
+    def is_empty(self) -> bool:
+        return not self.fields and not self.options
+
+    def start(self, name: str, text: str, line: int, column: int) -> None:
+        target = self.options if name in ("A", "B") else self.fields
+        target[name] = [text] if text else []
+        self.positions[name] = (line, column)
+        self.current = target[name]
+
+    def value(self, name: str) -> str:
+        parts = self.options.get(name) if name in ("A", "B") else self.fields.get(name)
+        return "\n".join(parts or []).strip()
+
+
+def _build_question(block: _Block) -> QuizQuestion:
+    """Block → QuizQuestion; ValueError(message, (line, column)) nếu thiếu/sai field."""
+    question_text = block.value("question")
+    if not question_text:
+        raise ValueError("missing question text", (block.line, block.column))
+    is_mc = block.marker == "MC" if block.marker else bool(block.options)
+    correct_raw = block.value("correct")
+    correct_at = block.positions.get("correct", (block.line, block.column))
+    if not correct_raw:
+        raise ValueError("missing 'Correct:' line", (block.line, block.column))
+    explanation = block.value("explanation") or DEFAULT_EXPLANATION
+    section = block.value("section").splitlines()[0].strip() if block.value("section") else None
+
+    if is_mc:
+        options = [block.value("A"), block.value("B")]
+        if not all(options):
+            missing = [letter for letter, text in zip("AB", options) if not text]
+            raise ValueError(f"missing option(s) {', '.join(missing)}", (block.line, block.column))
+        match = _MC_ANSWER_RE.match(correct_raw)
+        if not match:
+            raise ValueError(f"correct answer must be A or B, got {correct_raw[:20]!r}", correct_at)
+        return QuizQuestion(
+            question_type="multiple_choice",
+            question_text=question_text,
+            options=options,
+            correct_answer=options[ord(match.group(1).upper()) - ord("A")],
+            explanation=explanation,
+            section=section,
+        )
+
+    answer = correct_raw.split()[0].strip(".,:;()[]").lower()
+    if answer in _TRUE_VALUES:
+        correct_answer = "Đúng"
+    elif answer in _FALSE_VALUES:
+        correct_answer = "Sai"
+    else:
+        raise ValueError(f"correct answer must be Đúng or Sai, got {correct_raw[:20]!r}", correct_at)
+    return QuizQuestion(
+        question_type="true_false",
+        question_text=question_text,
+        options=["Đúng", "Sai"],
+        correct_answer=correct_answer,
+        explanation=explanation,
+        section=section,
+    )
+
+
+class IncrementalQuizParser:
+    """Máy trạng thái của ``parse_quiz_text`` nhận text theo từng mảnh (LLM streaming).
+
+    ``feed`` trả về các câu hỏi vừa hoàn chỉnh (block đã gặp "---" hoặc marker
+    của block sau); ``close`` xử lý block cuối. Lỗi dồn vào ``result.errors``.
+    """
+
+    def __init__(self):
+        self.result = ParseResult()
+        self._block: Optional[_Block] = None
+        self._pending = ""
+        self._line_no = 0
+
+    def feed(self, text: str) -> List[QuizQuestion]:
+        done = len(self.result.questions)
+        lines = (self._pending + text).split("\n")
+        # Dòng cuối có thể chưa hết → giữ lại chờ mảnh sau
+        self._pending = lines.pop()
+        for line in lines:
+            self._feed_line(line.rstrip("\r"))
+        return self.result.questions[done:]
+
+    def close(self) -> List[QuizQuestion]:
+        done = len(self.result.questions)
+        if self._pending:
+            self._feed_line(self._pending.rstrip("\r"))
+            self._pending = ""
+        self._close_block()
+        return self.result.questions[done:]
+
+    def _close_block(self) -> None:
+        current, self._block = self._block, None
+        if current is None or current.is_empty():
+            return
+        if current.marker is None and set(current.fields) == {"question"} and not current.options:
+            # Đoạn text thường (lời dẫn trước/sau danh sách câu hỏi), không phải block lỗi
+            return
+        try:
+            self.result.questions.append(_build_question(current))
+        except ValueError as exc:
+            message, (line, column) = exc.args
+            self.result.errors.append(ParseIssue(line=line, column=column, message=message))
+
+    def _feed_line(self, line: str) -> None:
+        self._line_no += 1
+        line_no = self._line_no
+        if _SEPARATOR_RE.match(line):
+            self._close_block()
+            return
+        match = _LINE_RE.match(line)
+        marker, key, option, rest = match.group("marker", "key", "option", "rest")
+        column = (match.start("rest") if rest else len(line) - len(line.lstrip())) + 1
+
+        if marker:
+            # Marker mới luôn mở block mới (kể cả khi LLM quên "---")
+            self._close_block()
+            self._block = _Block(line_no, match.start("marker"), marker.upper())
+        elif (
+            key
+            and _KEY_FIELDS[key.lower()] == "question"
+            and self._block is not None
+            and "question" in self._block.fields
+        ):
+            self._close_block()
+        block = self._block
+        if block is None:
+            if not (key or option or rest):
+                return
+            block = self._block = _Block(line_no, column)
+
+        if key:
+            block.start(_KEY_FIELDS[key.lower()], rest, line_no, column)
+        elif option and "correct" not in block.fields and "question" in block.fields:
+            block.start(option.upper(), rest, line_no, column)
+        elif rest:
+            if block.current is not None:
+                block.current.append(rest if not option else line.strip())
+            elif "question" not in block.fields:
+                # Câu hỏi không có nhãn "Question:"
+                block.start("question", line.strip() if option else rest, line_no, column)
+
+
+def is_valid_question(question: QuizQuestion) -> bool:
+    """Chỉ dùng câu hỏi hợp lệ: đủ nội dung, đáp án đúng nằm trong các lựa chọn."""
+    if len(question.question_text.strip()) < 10:
+        return False
+    if question.question_type == "multiple_choice":
+        options = [o.strip() for o in question.options]
+        return (
+            len(options) >= 2
+            and all(options)
+            and len(set(options)) == len(options)
+            and question.correct_answer.strip() in options
+        )
+    if question.question_type == "true_false":
+        return question.correct_answer in ("Đúng", "Sai")
+    return False
+
+
+def parse_quiz_text(text: str) -> ParseResult:
+    """Parse định dạng [MC]/[TF] trong 1 lượt qua các dòng."""
+    parser = IncrementalQuizParser()
+    parser.feed(text)
+    parser.close()
+    return parser.result
+
+
+def parse_quiz_json(text: str) -> ParseResult:
+    """Parse output của chế độ JSON; JSON hỏng → ValueError (có vị trí) để fallback sang text."""
+    cleaned = _JSON_FENCE_RE.sub("", text.strip())
+    try:
+        payload = json.loads(cleaned)
+    except json.JSONDecodeError as exc:
+        raise ValueError(f"invalid JSON at line {exc.lineno}, col {exc.colno}: {exc.msg}") from exc
+    items = payload.get("questions") if isinstance(payload, dict) else payload
+    if not isinstance(items, list):
+        raise ValueError("JSON response has no 'questions' list")
+
+    result = ParseResult()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            result.errors.append(ParseIssue(line=index + 1, column=1, message="question is not an object"))
+            continue
+        block = _Block(index + 1, 1, "TF" if str(item.get("type", "")).lower() in ("tf", "true_false") else "MC")
+        block.fields["question"] = [str(item.get("question") or "")]
+        block.fields["correct"] = [str(item.get("correct") or "")]
+        block.fields["explanation"] = [str(item.get("explanation") or "")]
+        if item.get("section"):
+            block.fields["section"] = [str(item["section"])]
+        options = item.get("options") or []
+        if block.marker == "MC":
+            for letter, option in zip("AB", options):
+                block.options[letter] = [str(option)]
+            # Cho phép "correct" là nội dung đáp án thay vì chữ cái
+            correct = block.value("correct")
+            first_two = [str(o) for o in options[:2]]
+            if correct.upper() not in ("A", "B") and correct in first_two:
+                block.fields["correct"] = ["AB"[first_two.index(correct)]]
+        try:
+            result.questions.append(_build_question(block))
+        except ValueError as exc:
+            result.errors.append(ParseIssue(line=index + 1, column=1, message=f"questions[{index}]: {exc.args[0]}"))
+    return result
+
+
+class QuizParseMetrics:
+    """Đếm response đã parse, câu/block lỗi và số lần gọi lại LLM do parse hỏng."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.responses = 0
+        self.questions = 0
+        self.block_errors = 0
+        self.empty_responses = 0
+        self.json_fallbacks = 0
+        self.retries = 0
+        self._by_format: Dict[str, int] = {}
+
+    def record(self, result: ParseResult, fmt: str) -> None:
+        with self._lock:
+            self.responses += 1
+            self.questions += len(result.questions)
+            self.block_errors += len(result.errors)
+            if not result.questions:
+                self.empty_responses += 1
+            self._by_format[fmt] = self._by_format.get(fmt, 0) + 1
+
+    def record_json_fallback(self) -> None:
+        with self._lock:
+            self.json_fallbacks += 1
+
+    def record_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            blocks = self.questions + self.block_errors
+            return {
+                "responses": self.responses,
+                "by_format": dict(self._by_format),
+                "questions": self.questions,
+                "block_errors": self.block_errors,
+                "block_error_rate": round(self.block_errors / blocks, 4) if blocks else 0.0,
+                "empty_responses": self.empty_responses,
+                "json_fallbacks": self.json_fallbacks,
+                "retries": self.retries,
+            }
+
+
+quiz_parse_metrics = QuizParseMetrics()
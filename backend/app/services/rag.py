@@ -1,6 +1,10 @@
 import asyncio
+import heapq
 import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 
 from typing import List, Optional, Dict
 
@@ -16,16 +20,28 @@ import re
 
 from ..core.config import settings
 
-from ..core.database import load_faiss_index
+from ..core.database import load_faiss_index, get_bm25_index_path
+
+from ..core.logger import get_logger, debug_sampled
 
 from ..models.document import DocumentInDB
 
 from ..models.history import HistoryReference, create_history
 
-from ..models.document import get_document_by_id, get_documents_by_user
+from ..models.document import get_document_by_id, get_documents_by_user, save_section_index
 
 from ..services.embedding import EmbeddingService
 
+from ..services.parser import build_section_index, find_section_for_chunk, find_section_by_number
+
+from ..services.lexical import BM25Index, load_bm25_index, save_bm25_index, reciprocal_rank_fusion
+
+from ..services.context_packer import pack_context
+
+from ..services.pipeline import ContextSelection, GeneratedAnswer, PipelineTrace, pipeline_metrics
+
+logger = get_logger("rag")
+
 
 def detect_query_type_fast(question: str) -> str:
     """Enhanced query type detection với SECTION_OVERVIEW ưu tiên cao nhất."""
@@ -943,6 +959,17 @@ CRITICAL:
 
 
 
+# Thread pool riêng cho FAISS/BM25 - giới hạn số luồng để nhiều request đồng thời
+# không làm bùng nổ số thread (FAISS đã tự dùng OpenMP bên trong mỗi lần search)
+_search_executor = ThreadPoolExecutor(
+    max_workers=settings.rag_search_workers,
+    thread_name_prefix="rag-search",
+)
+
+
+async def _run_in_search_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_search_executor, partial(func, *args))
 
 
 class RAGService:
@@ -983,15 +1010,15 @@ class RAGService:
 
                 self._openai_client = OpenAI(api_key=settings.openai_api_key)
 
-                print(f"[RAG] OpenAI client initialized successfully with model: {self.model}")
+                logger.debug("OpenAI client initialized successfully with model: %s", self.model)
 
             except Exception as e:
 
-                print(f"[RAG] Failed to initialize OpenAI client: {e}")
+                logger.error("Failed to initialize OpenAI client: %s", e)
 
                 import traceback
 
-                print(f"[RAG] Traceback: {traceback.format_exc()}")
+                logger.error("Traceback: %s", traceback.format_exc())
 
                 self._openai_client = None
 
@@ -1005,11 +1032,11 @@ class RAGService:
 
             if self._gemini_api_key:
 
-                print(f"[RAG] Gemini API initialized successfully with model: {self.model}")
+                logger.debug("Gemini API initialized successfully with model: %s", self.model)
 
             else:
 
-                print("[RAG] Gemini API key not found, falling back to local generation")
+                logger.warning("Gemini API key not found, falling back to local generation")
 
                 self.provider = "local"
 
@@ -1017,7 +1044,7 @@ class RAGService:
 
         if self.provider == "openai" and self._openai_client is None:
 
-            print("[RAG] Falling back to local generation mode")
+            logger.warning("Falling back to local generation mode")
 
             self.provider = "local"
     
@@ -1080,6 +1107,289 @@ class RAGService:
         base = 15  # Default
         return int(base * multiplier)
     
+    async def _ensure_section_indexes(self, db: AsyncIOMotorDatabase, documents: List[DocumentInDB]) -> None:
+        """Backfill section index cho tài liệu upload trước khi có index (chỉ chạy 1 lần/tài liệu)."""
+        for doc in documents:
+            if doc.section_index is not None:
+                continue
+            chunks = await db["chunks"].find(
+                {"document_id": doc.id},
+                {"content": 1, "metadata": 1, "chunk_index": 1},
+            ).sort("chunk_index", 1).to_list(length=None)
+            doc.section_index = build_section_index(chunks)
+            await save_section_index(db, doc.id, doc.section_index)
+            logger.debug("Backfilled section index for %s: %s sections", doc.filename, len(doc.section_index))
+
+    async def _retrieve_candidates(
+        self,
+        db: AsyncIOMotorDatabase,
+        documents: List[DocumentInDB],
+        query_vector: np.ndarray,
+        query_type: str,
+        question: str,
+    ) -> List[dict]:
+        # Search tất cả tài liệu song song: FAISS nhả GIL nên index.search chạy thật sự song song
+        # trên thread pool (giới hạn số luồng), không chặn event loop của các request khác
+        per_doc_results = await asyncio.gather(*(
+            self._search_document(db, doc, query_vector, query_type, question)
+            for doc in documents
+        ))
+        # Gộp k-way bằng heap - mỗi list đã sắp xếp giảm dần theo similarity
+        results = list(heapq.merge(*per_doc_results, key=lambda r: r["similarity"], reverse=True))
+        logger.debug("Searched %s document(s) in parallel → %s candidates", len(documents), len(results))
+        return results
+
+    async def _search_document(
+        self,
+        db: AsyncIOMotorDatabase,
+        doc: DocumentInDB,
+        query_vector: np.ndarray,
+        query_type: str,
+        question: str,
+    ) -> List[dict]:
+        """Search FAISS (+ BM25) cho 1 tài liệu. Phần I/O đĩa và index.search chạy trên search pool."""
+        namespace = doc.faiss_namespace or f"user_{doc.user_id}_doc_{doc.id}"
+
+        index = await _run_in_search_pool(load_faiss_index, namespace)
+
+        if index is None or index.ntotal == 0:
+            return []
+
+        if index.d != query_vector.shape[1]:
+            return []
+
+        # BM25 chạy song song với FAISS → bắt được chunk khớp chính xác mà vector bỏ sót
+        lexical_index = await self._ensure_lexical_index(db, doc, namespace)
+
+        try:
+
+            # ENHANCED: Tăng search_k dựa trên query type
+            if query_type == "DOCUMENT_OVERVIEW" and doc.section_index:
+                # Danh sách phần lấy trực tiếp từ section index → chỉ cần ít candidate bổ sung
+                search_k = min(30, index.ntotal)
+            elif query_type == "DOCUMENT_OVERVIEW":
+                # DOCUMENT_OVERVIEW cần NHIỀU chunks nhất để tìm TẤT CẢ các phần
+                search_k = min(150, index.ntotal)  # Tăng lên 150 để có đủ candidate chunks
+            elif query_type == "SECTION_OVERVIEW":
+                # SECTION_OVERVIEW cần chunks vừa phải
+                search_k = min(100, index.ntotal)
+            elif lexical_index is not None:
+                # Có BM25 bắt chunk khớp chính xác → câu hỏi thường không cần pool vector lớn
+                # (overview / section ở trên vẫn giữ pool rộng)
+                search_k = min(settings.rag_hybrid_search_k, index.ntotal)
+            elif query_type in ["MULTI_CONCEPT_REASONING", "COMPARE_SYNTHESIZE", "CODE_ANALYSIS"]:
+                # COMPARE_SYNTHESIZE cần nhiều chunks hơn để so sánh đầy đủ
+                if query_type == "COMPARE_SYNTHESIZE":
+                    search_k = min(75, index.ntotal)  # Tăng từ 50 lên 75 cho so sánh
+                else:
+                    search_k = min(50, index.ntotal)  # Giữ nguyên cho các loại khác
+            else:
+                search_k = min(30, index.ntotal)
+
+            distances, ids = await _run_in_search_pool(index.search, query_vector, search_k)
+
+        except Exception:
+            return []
+
+        if lexical_index is not None:
+            items = await self._fuse_hybrid_results(
+                db, doc, namespace, question, lexical_index, distances[0], ids[0], search_k
+            )
+        else:
+            items = [
+                {
+                    "document": doc,
+                    "namespace": namespace,
+                    "vector_id": int(vector_id),
+                    "similarity": float(1.0 / (1.0 + dist)),
+                }
+                for dist, vector_id in zip(distances[0], ids[0])
+                if vector_id != -1
+            ]
+            items.sort(key=lambda r: r["similarity"], reverse=True)
+        return items
+
+    async def _ensure_lexical_index(self, db: AsyncIOMotorDatabase, doc: DocumentInDB, namespace: str) -> Optional[BM25Index]:
+        """Load BM25 index của tài liệu; tài liệu cũ chưa có thì dựng từ chunks và lưu lại."""
+        path = get_bm25_index_path(namespace)
+        index = await _run_in_search_pool(load_bm25_index, path)
+        if index is not None:
+            return index
+        chunks = await db["chunks"].find(
+            {"document_id": doc.id},
+            {"content": 1, "metadata": 1, "chunk_index": 1},
+        ).to_list(length=None)
+        if not chunks:
+            return None
+        index = await _run_in_search_pool(BM25Index.build, chunks)
+        try:
+            await _run_in_search_pool(save_bm25_index, index, path)
+            logger.debug("Backfilled BM25 index for %s: %s terms", doc.filename, len(index.postings))
+        except Exception as exc:
+            logger.warning("⚠️ Could not save BM25 index for %s: %s", doc.filename, exc)
+        return index
+
+    async def _fuse_hybrid_results(
+        self,
+        db: AsyncIOMotorDatabase,
+        doc: DocumentInDB,
+        namespace: str,
+        question: str,
+        lexical_index: BM25Index,
+        distances,
+        vector_ids,
+        search_k: int,
+    ) -> List[dict]:
+        """Gộp kết quả FAISS + BM25 bằng reciprocal-rank fusion, giữ top search_k.
+
+        Mọi chunk nhận similarity của vị trí tương ứng trong ranking vector: danh
+        sách vẫn giảm dần theo similarity nên các bước sort / heapq.merge / ngưỡng
+        similarity phía sau giữ nguyên thứ tự RRF. Similarity gốc của vector nằm ở
+        ``vector_similarity``.
+        """
+        vector_hits = [
+            (int(vector_id), float(1.0 / (1.0 + dist)))
+            for dist, vector_id in zip(distances, vector_ids)
+            if vector_id != -1
+        ]
+        vector_sim = dict(vector_hits)
+
+        lexical_hits = await _run_in_search_pool(lexical_index.search, question, settings.rag_hybrid_search_k)
+        chunk_to_vector: Dict[int, int] = {}
+        if lexical_hits:
+            records = await db["embeddings"].find(
+                {"document_id": doc.id, "chunk_index": {"$in": [ci for ci, _ in lexical_hits]}},
+                {"chunk_index": 1, "vector_index": 1},
+            ).to_list(length=None)
+            chunk_to_vector = {r["chunk_index"]: r["vector_index"] for r in records if r.get("vector_index") is not None}
+        bm25_scores = {chunk_to_vector[ci]: score for ci, score in lexical_hits if ci in chunk_to_vector}
+
+        fused = reciprocal_rank_fusion(
+            [[vid for vid, _ in vector_hits], [chunk_to_vector[ci] for ci, _ in lexical_hits if ci in chunk_to_vector]],
+            k=settings.rag_rrf_k,
+        )
+        ranked = sorted(fused.items(), key=lambda kv: kv[1], reverse=True)[:search_k]
+        vector_scale = [sim for _, sim in vector_hits] or [0.0]
+
+        items = []
+        lexical_only = 0
+        for position, (vector_id, rrf_score) in enumerate(ranked):
+            if vector_id not in vector_sim:
+                lexical_only += 1
+            items.append({
+                "document": doc,
+                "namespace": namespace,
+                "vector_id": int(vector_id),
+                "similarity": vector_scale[min(position, len(vector_scale) - 1)],
+                "vector_similarity": vector_sim.get(vector_id),
+                "rrf_score": rrf_score,
+                "bm25_score": bm25_scores.get(vector_id),
+                "from_bm25": vector_id not in vector_sim,
+            })
+        logger.debug("Hybrid %s: %s vector + %s BM25 → %s fused (%s BM25-only)", doc.filename, len(vector_hits), len(lexical_hits), len(items), lexical_only)
+        return items
+
+    async def _section_index_items(
+        self,
+        db: AsyncIOMotorDatabase,
+        doc: DocumentInDB,
+        chunk_indices: List[int],
+        existing_items: List[dict],
+    ) -> List[dict]:
+        """Build result items cho các chunk_index lấy từ section index.
+
+        Dùng lại item đã hydrate từ FAISS nếu có, phần còn lại lấy bằng 1 query.
+        """
+        existing = {
+            item.get("_record", {}).get("chunk_index"): item
+            for item in existing_items
+            if item["document"].id == doc.id and item.get("_record")
+        }
+        missing = [idx for idx in chunk_indices if idx not in existing]
+        fetched = {}
+        if missing:
+            async for chunk_doc in db["chunks"].find(
+                {"document_id": doc.id, "chunk_index": {"$in": missing}}
+            ):
+                fetched[chunk_doc.get("chunk_index")] = chunk_doc
+
+        items = []
+        for idx in chunk_indices:
+            if idx in existing:
+                items.append(existing[idx])
+                continue
+            chunk_doc = fetched.get(idx)
+            if not chunk_doc:
+                continue
+            items.append({
+                "document": doc,
+                "namespace": doc.faiss_namespace or f"user_{doc.user_id}_doc_{doc.id}",
+                "vector_id": chunk_doc.get("embedding_index"),
+                # Không có điểm FAISS → dùng điểm mặc định như context builder (0.5)
+                "similarity": 0.5,
+                "original_similarity": 0.5,
+                "_record": {
+                    "document_id": doc.id,
+                    "chunk_id": str(chunk_doc.get("_id")),
+                    "chunk_index": idx,
+                },
+                "_content": chunk_doc.get("content") or "",
+                "_chunk_doc": chunk_doc,
+                "from_section_index": True,
+            })
+        return items
+
+    def _build_context_metadata(self, item: dict) -> dict:
+        """Lấy metadata (page/section/heading) của 1 item để đưa vào context LLM."""
+        record = item.get("_record")
+        chunk_doc = item.get("_chunk_doc")
+        doc = item["document"]
+        content = item.get("_content", "")
+
+        # Lấy metadata từ chunk_doc (chunks collection)
+        chunk_metadata = {}
+        if chunk_doc:
+            chunk_metadata = (chunk_doc.get("metadata") or {})
+        elif record:
+            # Nếu không có chunk_doc, thử từ record
+            chunk_metadata = (record.get("metadata") or {})
+
+        # Đảm bảo chunk_metadata là dict
+        if not isinstance(chunk_metadata, dict):
+            chunk_metadata = {}
+
+        chunk_idx = record.get("chunk_index") if record else None
+
+        # Lấy heading hoặc section title cho DOCX
+        heading = chunk_metadata.get("heading") or chunk_metadata.get("title") or chunk_metadata.get("section_title")
+        section = chunk_metadata.get("section")
+
+        # Nếu metadata không có section → tra section index của tài liệu
+        if not section and not heading:
+            node = find_section_for_chunk(doc.section_index or [], chunk_idx)
+            if node:
+                section = node["heading"]
+
+        # Nếu vẫn không có section/heading, thử extract từ content
+        if not section and not heading and content and doc.file_type in ["docx", "doc", "md", "txt"]:
+            extracted = self._extract_section_from_content(content, doc.file_type)
+            if extracted:
+                section = extracted
+                # Nếu content ngắn và có vẻ là heading, thì đó là heading
+                if len(content.strip()) < 100:
+                    heading = extracted
+
+        return {
+            "chunk_index": chunk_idx,
+            "document_id": record.get("document_id") if record else None,
+            "page_number": chunk_metadata.get("page_number"),
+            "section": section,
+            "heading": heading,
+            "document_type": doc.file_type,
+            "document_filename": doc.filename,
+            "content": content,
+        }
+
     def _extract_section_from_content(self, content: str, file_type: str) -> Optional[str]:
         """Extract section/heading from content if it looks like a heading.
         
@@ -1181,7 +1491,7 @@ class RAGService:
         # Debug: Log if we found numbered items
         numbered_items = len(re.findall(r'^\d+\.\s+', fixed, re.MULTILINE))
         if numbered_items > 0:
-            print(f"[RAG] _fix_numbered_list_formatting: Found {numbered_items} numbered items, double_newlines={fixed.count(chr(10)*2)}")
+            logger.debug("_fix_numbered_list_formatting: Found %s numbered items, double_newlines=%s", numbered_items, fixed.count(chr(10)*2))
         
         return fixed
     
@@ -1287,8 +1597,8 @@ class RAGService:
         # CRITICAL FIX: If LLM returns plain text instead of JSON, try to extract
         # Check if response looks like plain text (doesn't start with {)
         if not cleaned.startswith('{'):
-            print(f"[RAG] ⚠️ LLM returned plain text, not JSON. Attempting recovery...")
-            print(f"[RAG] Raw text (first 200 chars): {cleaned[:200]}")
+            logger.warning("⚠️ LLM returned plain text, not JSON. Attempting recovery...")
+            logger.debug("Raw text (first 200 chars): %s", cleaned[:200])
             
             # ENHANCED: Try multiple JSON extraction methods
             # CRITICAL: Handle tables in JSON answer field
@@ -1309,14 +1619,14 @@ class RAGService:
                         # Try to fix common JSON issues with tables
                         json_str = self._fix_json_with_table(json_str)
                         parsed = json.loads(json_str)
-                        print(f"[RAG] ✅ Extracted JSON using method {i+1}")
+                        logger.debug("✅ Extracted JSON using method %s", i+1)
                         return parsed
                     except Exception as e:
-                        print(f"[RAG] Method {i+1} failed: {e}")
+                        logger.error("Method %s failed: %s", i+1, e)
                         continue
             
             # Method 4: Reconstruct JSON from text
-            print(f"[RAG] Attempting text-to-JSON reconstruction...")
+            logger.debug("Attempting text-to-JSON reconstruction...")
             return self._reconstruct_json_from_text(cleaned, query_type)
         
         # Remove markdown blocks
@@ -1342,7 +1652,7 @@ class RAGService:
                             # Properly unescape JSON string
                             extracted = json.loads('"' + match.group(1) + '"')
                             parsed["answer"] = extracted
-                            print(f"[RAG] ✅ Extracted nested answer from escaped JSON string")
+                            logger.debug("✅ Extracted nested answer from escaped JSON string")
                     except:
                         pass
             
@@ -1360,7 +1670,7 @@ class RAGService:
             
             # Validate answer type
             if answer_type not in VALID_ANSWER_TYPES:
-                print(f"[RAG] ⚠️ Invalid answer_type: {answer_type}, attempting auto-correction...")
+                logger.warning("⚠️ Invalid answer_type: %s, attempting auto-correction...", answer_type)
                 
                 # Auto-correct based on content
                 answer_lower = answer.lower()
@@ -1368,27 +1678,27 @@ class RAGService:
                 # Check for SECTION_OVERVIEW markers
                 if re.search(r'PHẦN\s+\d+:', answer) or any(marker in answer_lower for marker in ['phần', 'nội dung chính', 'bao gồm']):
                     answer_type = "SECTION_OVERVIEW"
-                    print(f"[RAG] Auto-corrected to SECTION_OVERVIEW")
+                    logger.debug("Auto-corrected to SECTION_OVERVIEW")
                 
                 # Check for comparison markers
                 elif any(marker in answer_lower for marker in ["|", "giống", "khác", "so sánh", "tương tự", "khác biệt"]):
                     answer_type = "COMPARE_SYNTHESIZE"
-                    print(f"[RAG] Auto-corrected to COMPARE_SYNTHESIZE")
+                    logger.debug("Auto-corrected to COMPARE_SYNTHESIZE")
                 
                 # Check for code analysis markers
                 elif "phân tích" in answer_lower or "code" in answer_lower or "function" in answer_lower:
                     answer_type = "CODE_ANALYSIS"
-                    print(f"[RAG] Auto-corrected to CODE_ANALYSIS")
+                    logger.debug("Auto-corrected to CODE_ANALYSIS")
                 
                 # Default to DIRECT if has chunks, otherwise FALLBACK
                 else:
                     chunks_used = parsed.get("chunks_used", [])
                     if chunks_used:
                         answer_type = "DIRECT"
-                        print(f"[RAG] Auto-corrected to DIRECT (has chunks)")
+                        logger.debug("Auto-corrected to DIRECT (has chunks)")
                     else:
                         answer_type = "FALLBACK"
-                        print(f"[RAG] Auto-corrected to FALLBACK (no chunks)")
+                        logger.debug("Auto-corrected to FALLBACK (no chunks)")
                 
                 # Apply penalty for invalid type
                 confidence = max(0.5, confidence * 0.8)
@@ -1402,14 +1712,14 @@ class RAGService:
                 topic_count = len(re.findall(r'\d+\.\s+\*\*', answer))
                 
                 if not has_title or not has_list_intro or topic_count < 3:
-                    print(f"[RAG] ⚠️ SECTION_OVERVIEW format invalid:")
-                    print(f"  - Has title: {has_title}")
-                    print(f"  - Has list intro: {has_list_intro}")
-                    print(f"  - Topic count: {topic_count}")
+                    logger.warning("⚠️ SECTION_OVERVIEW format invalid:")
+                    logger.debug("  - Has title: %s", has_title)
+                    logger.debug("  - Has list intro: %s", has_list_intro)
+                    logger.debug("  - Topic count: %s", topic_count)
                     # Don't fail, but log warning
             return parsed
         except json.JSONDecodeError as e:
-            print(f"[RAG] JSON decode error: {e}")
+            logger.error("JSON decode error: %s", e)
             pass
         
         # Try to extract JSON object
@@ -1438,11 +1748,11 @@ class RAGService:
                     parsed["confidence"] = max(0.5, parsed.get("confidence", 0.0) * 0.8)
                 return parsed
             except Exception as e:
-                print(f"[RAG] Extracted JSON parse failed: {e}")
+                logger.error("Extracted JSON parse failed: %s", e)
                 pass
         
         # Final fallback: reconstruct from text
-        print(f"[RAG] All parsing attempts failed. Attempting reconstruction...")
+        logger.error("All parsing attempts failed. Attempting reconstruction...")
         return self._reconstruct_json_from_text(cleaned, query_type)
     
     def _extract_json_with_multiline_string(self, text: str):
@@ -1520,7 +1830,7 @@ class RAGService:
         if query_type == "COMPARE_SYNTHESIZE" and has_table:
             # Auto-extract chunks from selected_results if available
             if hasattr(self, 'selected_results') and self.selected_results:
-                print(f"[RAG] COMPARE_SYNTHESIZE with table but no chunks found, will use selected chunks")
+                logger.debug("COMPARE_SYNTHESIZE with table but no chunks found, will use selected chunks")
                 for item in self.selected_results[:min(15, len(self.selected_results))]:
                     record = item.get("_record")
                     if record:
@@ -1531,7 +1841,7 @@ class RAGService:
                                 "chunk_index": chunk_idx,
                                 "document_id": doc_id
                             })
-                print(f"[RAG] ✅ Auto-extracted {len(chunks_found)} chunks from selected_results for COMPARE_SYNTHESIZE")
+                logger.debug("✅ Auto-extracted %s chunks from selected_results for COMPARE_SYNTHESIZE", len(chunks_found))
         
         # Extract chunks mentioned in text (fallback if not found above)
         # Note: chunks_found might be list of dicts (from selected_results) or list of ints (from text)
@@ -1569,7 +1879,7 @@ class RAGService:
                 answer_type = "DOCUMENT_OVERVIEW"
                 # Extract chunks from selected_results if available
                 if hasattr(self, 'selected_results') and self.selected_results:
-                    print(f"[RAG] DOCUMENT_OVERVIEW JSON parse failed, recovering chunks from selected_results")
+                    logger.error("DOCUMENT_OVERVIEW JSON parse failed, recovering chunks from selected_results")
                     chunks_found = []
                     for item in self.selected_results[:min(50, len(self.selected_results))]:
                         record = item.get("_record")
@@ -1581,13 +1891,13 @@ class RAGService:
                                     "chunk_index": chunk_idx,
                                     "document_id": doc_id
                                 })
-                    print(f"[RAG] ✅ Recovered {len(chunks_found)} chunks for DOCUMENT_OVERVIEW")
+                    logger.debug("✅ Recovered %s chunks for DOCUMENT_OVERVIEW", len(chunks_found))
                 
                 # Count sections found
                 section_numbers = re.findall(r'PHẦN\s+(\d+)', text, re.IGNORECASE)
                 section_count = len(set(section_numbers))
                 confidence = min(0.90, 0.7 + (section_count * 0.02))  # Boost based on section count
-                print(f"[RAG] DOCUMENT_OVERVIEW recovery: {section_count} sections found, confidence={confidence:.2f}")
+                logger.debug("DOCUMENT_OVERVIEW recovery: %s sections found, confidence=%.2f", section_count, confidence)
         
         elif query_type == "SECTION_OVERVIEW" or any(marker in text_lower for marker in ['phần', 'nội dung chính', 'bao gồm']):
             answer_type = "SECTION_OVERVIEW"
@@ -1599,7 +1909,7 @@ class RAGService:
             # CRITICAL: COMPARE_SYNTHESIZE should always have references if table exists
             if "|" in text and not chunks_found:
                 # Try to extract chunks from selected_results if available
-                print(f"[RAG] COMPARE_SYNTHESIZE with table but no chunks found, will use selected chunks")
+                logger.debug("COMPARE_SYNTHESIZE with table but no chunks found, will use selected chunks")
         elif query_type == "CODE_ANALYSIS" and "phân tích" in text_lower:
             answer_type = "CODE_ANALYSIS"
             confidence = 0.7
@@ -1623,9 +1933,9 @@ class RAGService:
         ]
         has_table = "|" in text and any(re.search(pattern, text, re.MULTILINE) for pattern in table_patterns)
         
-        print(f"[RAG] Reconstruction: text_length={len(text)}, has_table={has_table}, query_type={query_type}")
+        logger.debug("Reconstruction: text_length=%s, has_table=%s, query_type=%s", len(text), has_table, query_type)
         if has_table:
-            print(f"[RAG] Table detected! Keeping full text (first 300 chars: {text[:300]})")
+            logger.debug("Table detected! Keeping full text (first 300 chars: %s)", text[:300])
             # For tables, keep the ENTIRE text including table
             # Don't truncate - tables need to be complete
             # Only limit if text is extremely long (over 10000 chars)
@@ -1709,7 +2019,7 @@ class RAGService:
                 # Convert int list to dict format
                 chunks_used = [{"chunk_index": idx} for idx in chunks_found[:15]]
         
-        print(f"[RAG] Reconstructed JSON: answer_type={answer_type}, confidence={confidence:.2f}, chunks={len(chunks_used)}, sentences={len(sentence_mapping)}")
+        logger.debug("Reconstructed JSON: answer_type=%s, confidence=%.2f, chunks=%s, sentences=%s", answer_type, confidence, len(chunks_used), len(sentence_mapping))
         
         return {
             "answer": answer,
@@ -1736,24 +2046,12 @@ class RAGService:
 
 
 
-    async def ask(
-
+    async def _load_documents(
         self,
-
         db: AsyncIOMotorDatabase,
-
         user_id: str,
-
-        question: str,
-
-        document_ids: Optional[List[str]] = None,  # ← THAY ĐỔI: List[str] thay vì str
-
-        top_k: Optional[int] = None,
-
-        conversation_id: Optional[str] = None,
-
-    ) -> dict:
-
+        document_ids: Optional[List[str]],
+    ) -> List[DocumentInDB]:
         documents: List[DocumentInDB] = []
 
         if document_ids:  # ← THAY ĐỔI: Kiểm tra list
@@ -1763,237 +2061,122 @@ class RAGService:
                 if doc and doc.user_id == user_id:
                     documents.append(doc)
                 else:
-                    print(f"[RAG] ⚠️ Document {doc_id} not found or not accessible")
+                    logger.warning("⚠️ Document %s not found or not accessible", doc_id)
             
             if not documents:
                 raise ValueError("Không tìm thấy tài liệu nào trong danh sách đã chọn")
             
-            print(f"[RAG] 🎯 Selected {len(documents)} document(s):")
+            logger.debug("🎯 Selected %s document(s):", len(documents))
             for doc in documents:
-                print(f"  ✓ {doc.filename} (ID: {doc.id})")
+                logger.debug("  ✓ %s (ID: %s)", doc.filename, doc.id)
         else:
             # Không chọn gì = lấy TẤT CẢ
             documents = await get_documents_by_user(db, user_id)
-            print(f"[RAG] 📚 Using ALL documents: {len(documents)} file(s)")
-        
-        # GIÁM SÁT: Log documents IDs để debug
-        document_ids_used = [doc.id for doc in documents]
-        print(f"[RAG] Document IDs being searched: {document_ids_used}")
-
-        # Handle các câu chào / small-talk không liên quan đến tài liệu
-        normalized_question = question.strip().lower()
-        small_talk_phrases = [
-            "hi",
-            "hello",
-            "xin chào",
-            "chào",
-            "chao",
-            "chào bạn",
-            "chào ad",
-            "chào admin",
-            "good morning",
-            "good afternoon",
-            "good evening",
-            "bye",
-            "tạm biệt",
-            "cảm ơn",
-            "thank you",
-        ]
-
-        # Nếu câu hỏi rất ngắn và chỉ là lời chào / cảm ơn thì không gọi RAG
-        if len(normalized_question) <= 40 and any(
-            normalized_question == p or normalized_question.startswith(p + " ")
-            for p in small_talk_phrases
-        ):
-            # Trả lời thân thiện, không trích dẫn tài liệu
-            if any(
-                kw in normalized_question
-                for kw in ["cảm ơn", "cam on", "thank", "tks", "thanks"]
-            ):
-                answer = (
-                    "Cảm ơn bạn! Nếu cần mình hỗ trợ giải bài hoặc tóm tắt nội dung trong tài liệu, "
-                    "hãy gửi câu hỏi nhé."
-                )
-            elif any(
-                kw in normalized_question
-                for kw in ["bye", "tạm biệt", "tam biet", "good night"]
-            ):
-                answer = (
-                    "Tạm biệt bạn, hẹn gặp lại! Khi nào cần hỏi bài hoặc tra cứu tài liệu, cứ quay lại nhé."
-                )
-            else:
-                answer = (
-                    "Xin chào! Mình là trợ lý StudyQnA, mình sẽ giúp bạn trả lời các câu hỏi dựa trên tài liệu "
-                    "bạn đã tải lên. Bạn cứ gửi câu hỏi về nội dung cần học nhé."
-                )
-
-            # Lưu lịch sử nhưng không có references
-            # Use first document_id for backward compatibility
-            doc_id_for_history = document_ids[0] if document_ids and len(document_ids) > 0 else None
-            history_record = await create_history(
-                db, user_id, question, answer, [], doc_id_for_history, conversation_id
-            )
-
-            final_conversation_id = conversation_id
-
-            # Giữ logic conversation_id tương tự nhánh bình thường
-            if not final_conversation_id:
-                final_conversation_id = history_record.id
-                try:
-                    from bson import ObjectId
+            logger.debug("📚 Using ALL documents: %s file(s)", len(documents))
+        return documents
 
-                    await db["histories"].update_one(
-                        {"_id": ObjectId(history_record.id)},
-                        {"$set": {"conversation_id": history_record.id}},
-                    )
-                    history_record.conversation_id = history_record.id
-                except Exception as e:
-                    print(
-                        f"[RAG] Warning: Failed to update conversation_id for small-talk history {history_record.id}: {e}"
-                    )
+    async def search(
+        self,
+        db: AsyncIOMotorDatabase,
+        user_id: str,
+        question: str,
+        document_ids: Optional[List[str]] = None,
+        offset: int = 0,
+        limit: int = 10,
+    ) -> dict:
+        """Retrieval-only: search + re-rank giống ask() nhưng dừng trước bước gọi LLM.
 
-            return {
-                "answer": answer,
-                "references": [],
-                "documents": [],
-                "conversation_id": final_conversation_id,
-                "history_id": history_record.id,
-            }
+        Không gọi Gemini, không ghi history. Trả về chunks đã chấm điểm (có phân trang).
+        """
+        documents = await self._load_documents(db, user_id, document_ids)
+        query_type = detect_query_type_fast(question)
+        empty = {"results": [], "total": 0, "offset": offset, "limit": limit, "query_type": query_type}
+        if not documents:
+            return empty
 
         question_embeddings = await self.embedding_service.embed_texts([question])
-
         if not question_embeddings:
-            # ENHANCED: Detect query type even for error cases
-            query_type = detect_query_type_fast(question)
-            return {
-                "answer": "Không thể tạo embedding cho câu hỏi.",
-                "references": [],
-                "documents": [],
-                "metadata": {
-                    "answer_type": "FALLBACK",
-                    "confidence": 0.0,
-                    "query_type": query_type,
-                    "chunks_selected": 0,
-                    "chunks_used": 0,
-                }
-            }
-
-        # ENHANCED: Detect query type FIRST để điều chỉnh search
-        query_type = detect_query_type_fast(question)
-        print(f"[RAG] Detected query type: {query_type}")
+            return empty
 
+        await self._ensure_section_indexes(db, documents)
         query_vector = np.array(question_embeddings, dtype="float32")
 
-        results = []
-
-        # ENHANCED: Dynamic max_chunks
-        max_chunks_for_query = self._determine_max_chunks_for_query(
-            question, 
-            query_type,
-            num_docs=len(documents)  # ✅ THÊM THAM SỐ
-        )
-        print(f"[RAG] Max chunks for this query: {max_chunks_for_query} (for {len(documents)} document(s))")
-
-        # Search with larger initial top_k for more candidates
-        for doc in documents:
-
-            namespace = doc.faiss_namespace or f"user_{doc.user_id}_doc_{doc.id}"
-
-            index = load_faiss_index(namespace)
-
-            if index is None or index.ntotal == 0:
-
-                continue
+        results = await self._retrieve_candidates(db, documents, query_vector, query_type, question)
+        if not results:
+            return empty
 
-            if index.d != query_vector.shape[1]:
+        sorted_results, _ = await self._rerank_candidates(db, results, question, query_type)
 
+        ranked = []
+        seen = set()
+        for item in sorted_results:
+            if not item.get("_record"):
                 continue
-
-            try:
-
-                # ENHANCED: Tăng search_k dựa trên query type
-                if query_type == "DOCUMENT_OVERVIEW":
-                    # DOCUMENT_OVERVIEW cần NHIỀU chunks nhất để tìm TẤT CẢ các phần
-                    search_k = min(150, index.ntotal)  # Tăng lên 150 để có đủ candidate chunks
-                elif query_type == "SECTION_OVERVIEW":
-                    # SECTION_OVERVIEW cần chunks vừa phải
-                    search_k = min(100, index.ntotal)
-                elif query_type in ["MULTI_CONCEPT_REASONING", "COMPARE_SYNTHESIZE", "CODE_ANALYSIS"]:
-                    # COMPARE_SYNTHESIZE cần nhiều chunks hơn để so sánh đầy đủ
-                    if query_type == "COMPARE_SYNTHESIZE":
-                        search_k = min(75, index.ntotal)  # Tăng từ 50 lên 75 cho so sánh
-                    else:
-                        search_k = min(50, index.ntotal)  # Giữ nguyên cho các loại khác
-                else:
-                    search_k = min(30, index.ntotal)
-
-                distances, ids = index.search(query_vector, search_k)
-
-            except Exception:
-
+            key = (item["document"].id, item["_record"].get("chunk_index"))
+            if key in seen:
                 continue
+            seen.add(key)
+            ranked.append(item)
+
+        page = []
+        for item in ranked[offset:offset + limit]:
+            entry = self._build_context_metadata(item)
+            entry["score"] = item.get("similarity", 0.0)
+            entry["vector_similarity"] = item.get("vector_similarity") or item.get(
+                "original_similarity", item.get("similarity", 0.0)
+            )
+            entry["bm25_score"] = item.get("bm25_score")
+            page.append(entry)
 
-            for dist, vector_id in zip(distances[0], ids[0]):
-
-                if vector_id == -1:
-
-                    continue
-
-                similarity = float(1.0 / (1.0 + dist))
-
-                results.append(
-
-                    {
-
-                        "document": doc,
-
-                        "namespace": namespace,
-
-                        "vector_id": int(vector_id),
-
-                        "similarity": similarity,
-
-                    }
-
-                )
+        return {
+            "results": page,
+            "total": len(ranked),
+            "offset": offset,
+            "limit": limit,
+            "query_type": query_type,
+        }
 
+    async def _prefetch_candidate_records(self, db: AsyncIOMotorDatabase, results: List[dict]) -> tuple:
+        """Load embedding records + chunks cho toàn bộ candidates bằng vài query $in."""
+        from bson import ObjectId
 
+        vector_ids_by_doc: Dict[str, List[int]] = {}
+        for item in results:
+            vector_ids_by_doc.setdefault(item["document"].id, []).append(item["vector_id"])
 
-        if not results:
-            # ENHANCED: Detect query type even for error cases
-            query_type = detect_query_type_fast(question)
-            
-            # ENHANCED: Thông báo rõ ràng cho user
-            if document_ids:
-                selected_filenames = [doc.filename for doc in documents]
-                answer = (
-                    f"Không tìm thấy thông tin liên quan trong {len(documents)} tài liệu đã chọn:\n"
-                    f"• {', '.join(selected_filenames)}\n\n"
-                    f"Có thể thử:\n"
-                    f"1. Chọn thêm tài liệu khác\n"
-                    f"2. Đặt câu hỏi theo cách khác\n"
-                    f"3. Kiểm tra nội dung tài liệu có liên quan không"
-                )
-            else:
-                answer = "Không tìm thấy đoạn văn phù hợp trong tài liệu của bạn."
+        records_by_key: Dict[tuple, dict] = {}
+        for doc_id, vector_ids in vector_ids_by_doc.items():
+            async for record in db["embeddings"].find(
+                {"document_id": doc_id, "vector_index": {"$in": vector_ids}}
+            ):
+                records_by_key[(doc_id, record.get("vector_index"))] = record
 
-            return {
-                "answer": answer,
-                "references": [],
-                "documents": document_ids_used,
-                "documents_searched": document_ids_used,  # ← THÊM: list IDs đã search
-                "metadata": {
-                    "answer_type": "FALLBACK",
-                    "confidence": 0.0,
-                    "query_type": query_type,
-                    "chunks_selected": 0,
-                    "chunks_used": 0,
-                    "documents_searched": len(documents),  # ← THÊM: số docs đã search
-                }
-            }
+        chunk_ids = []
+        for record in records_by_key.values():
+            chunk_id = record.get("chunk_id")
+            if chunk_id:
+                try:
+                    chunk_ids.append(ObjectId(chunk_id))
+                except Exception:
+                    chunk_ids.append(chunk_id)
 
+        chunks_by_id: Dict[str, dict] = {}
+        if chunk_ids:
+            async for chunk_doc in db["chunks"].find({"_id": {"$in": chunk_ids}}):
+                chunks_by_id[str(chunk_doc["_id"])] = chunk_doc
+        return records_by_key, chunks_by_id
 
+    async def _rerank_candidates(
+        self,
+        db: AsyncIOMotorDatabase,
+        results: List[dict],
+        question: str,
+        query_type: str,
+    ) -> tuple:
+        """Hydrate nội dung candidates và boost theo keyword/section/TOC.
 
+        Trả về (sorted_results, question_keywords) - TOC chunks đứng đầu.
+        """
         # Boost chunks that contain keywords from the question
 
         # CRITICAL FIX: Clean keywords - remove quotes, punctuation
@@ -2013,21 +2196,20 @@ class RAGService:
         for item in results:
             item["original_similarity"] = item["similarity"]
 
-        print(f"[RAG] Found {len(results)} candidate chunks, boosting by question keywords (cleaned): {question_keywords[:10]}")
+        logger.debug("Found %s candidate chunks, boosting by question keywords (cleaned): %s", len(results), question_keywords[:10])
 
 
 
         # Cache content for boosting and later use
 
+        # Batch: 1 query embeddings/tài liệu + 1 query chunks (thay vì 2 find_one mỗi candidate)
+        records_by_key, chunks_by_id = await self._prefetch_candidate_records(db, results)
+
         for item in results:
 
             doc = item["document"]
 
-            record = await db["embeddings"].find_one(
-
-                {"document_id": doc.id, "vector_index": item["vector_id"]}
-
-            )
+            record = records_by_key.get((doc.id, item["vector_id"]))
 
             if not record:
 
@@ -2039,28 +2221,16 @@ class RAGService:
 
             chunk_id = record.get("chunk_id")
 
-            chunk_doc = None
-
-            if chunk_id:
-
-                try:
-
-                    from bson import ObjectId
-
-                    chunk_doc = await db["chunks"].find_one({"_id": ObjectId(chunk_id)})
-
-                except Exception:
-
-                    chunk_doc = await db["chunks"].find_one({"_id": chunk_id})
+            chunk_doc = chunks_by_id.get(str(chunk_id)) if chunk_id else None
             
             # Debug: kiểm tra chunk_doc và metadata cho một vài chunks
             chunk_idx = record.get("chunk_index") if record else None
             if chunk_idx in [1, 3, 8, 10, 11] and doc.file_type in ["docx", "doc"]:
                 if chunk_doc:
                     metadata = chunk_doc.get("metadata", {})
-                    print(f"[RAG] Query chunk {chunk_idx}: chunk_id={chunk_id}, found={chunk_doc is not None}, metadata={metadata}")
+                    debug_sampled(logger, "rerank_chunk_lookup", "Query chunk %s: chunk_id=%s, found=%s, metadata=%s", chunk_idx, chunk_id, chunk_doc is not None, metadata)
                 else:
-                    print(f"[RAG] Query chunk {chunk_idx}: chunk_id={chunk_id}, chunk_doc NOT FOUND")
+                    logger.warning("Query chunk %s: chunk_id=%s, chunk_doc NOT FOUND", chunk_idx, chunk_id)
 
             content = (chunk_doc or {}).get("content") or record.get("content") or ""
 
@@ -2093,7 +2263,7 @@ class RAGService:
                     if re.match(pattern, section_lower):
                         is_main_section = True
                         section_boost = 0.5  # Strong boost for main sections
-                        print(f"[RAG] Main section detected: {section} (chunk {record.get('chunk_index')})")
+                        debug_sampled(logger, "rerank_main_section", "Main section detected: %s (chunk %s)", section, record.get('chunk_index'))
                         break
             
             # CRITICAL FIX: Also check for quoted terms
@@ -2112,7 +2282,7 @@ class RAGService:
                 term_clean = term.lower().strip()
                 if term_clean in content_lower:
                     keyword_matches += 3  # Triple weight for quoted terms!
-                    print(f"[RAG] Found quoted term '{term_clean}' in chunk {record.get('chunk_index')}")
+                    debug_sampled(logger, "rerank_quoted_term", "Found quoted term '%s' in chunk %s", term_clean, record.get('chunk_index'))
 
 
 
@@ -2148,7 +2318,7 @@ class RAGService:
 
                         keyword_matches += 8
 
-                        print(f"[RAG] Found exact subsection match: {subsec} in chunk {record.get('chunk_index', '?')}")
+                        debug_sampled(logger, "rerank_subsection_match", "Found exact subsection match: %s in chunk %s", subsec, record.get('chunk_index', '?'))
 
 
 
@@ -2170,7 +2340,7 @@ class RAGService:
                 
                 if keyword_count >= 2:  # Contains at least 2 comparison terms
                     comparison_boost = min(0.4, keyword_count * 0.15)
-                    print(f"[RAG] Comparison boost +{comparison_boost:.3f} for chunk {record.get('chunk_index')} (keywords: {keyword_count})")
+                    debug_sampled(logger, "rerank_comparison_boost", "Comparison boost +%.3f for chunk %s (keywords: %s)", comparison_boost, record.get('chunk_index'), keyword_count)
             
             # Apply boosts (combine keyword boost + section boost + comparison boost)
             total_boost = 0.0
@@ -2181,7 +2351,7 @@ class RAGService:
                 total_boost += boost
                 item["keyword_matches"] = keyword_matches
                 boost_details.append(f"keywords({keyword_matches})")
-                print(f"[RAG] Boosted chunk {record.get('chunk_index')} by {boost:.3f} (keywords: {keyword_matches})")
+                debug_sampled(logger, "rerank_keyword_boost", "Boosted chunk %s by %.3f (keywords: %s)", record.get('chunk_index'), boost, keyword_matches)
             
             # CRITICAL FIX: Add section boost for main sections
             if is_main_section:
@@ -2198,7 +2368,7 @@ class RAGService:
             if "mục lục" in content_lower or "table of contents" in content_lower:
                 toc_priority_boost = 2.0  # Tăng từ 0.8 lên 2.0 (siêu mạnh)
                 item["is_toc"] = True
-                print(f"[RAG] 🎯 TABLE OF CONTENTS detected in chunk {record.get('chunk_index')} → priority boost +2.0")
+                debug_sampled(logger, "rerank_toc_boost", "🎯 TABLE OF CONTENTS detected in chunk %s → priority boost +2.0", record.get('chunk_index'))
             
             # Pattern 2: Boost chunks chứa nhiều PHẦN X
             # Đếm số lượng "PHẦN X" trong content
@@ -2207,7 +2377,7 @@ class RAGService:
                 overview_boost = min(1.0, section_count * 0.2)  # Tăng từ 0.15 lên 0.2
                 total_boost += overview_boost
                 boost_details.append(f"overview({section_count}_sections)")
-                print(f"[RAG] Boosted chunk {record.get('chunk_index')} - contains {section_count} section headings")
+                debug_sampled(logger, "rerank_heading_count_boost", "Boosted chunk %s - contains %s section headings", record.get('chunk_index'), section_count)
             
             # Apply TOC boost (highest priority)
             if toc_priority_boost > 0:
@@ -2216,7 +2386,8 @@ class RAGService:
             
             if total_boost > 0:
                 item["similarity"] = min(1.0, item["similarity"] + total_boost)
-                print(f"[RAG] Boosted chunk {record.get('chunk_index', '?')} by {total_boost:.3f} ({', '.join(boost_details)})")
+                if logger.isEnabledFor(logging.DEBUG):
+                    debug_sampled(logger, "rerank_total_boost", "Boosted chunk %s by %.3f (%s)", record.get('chunk_index', '?'), total_boost, ', '.join(boost_details))
 
 
 
@@ -2231,9 +2402,98 @@ class RAGService:
         # TOC chunks first, then regular chunks
         sorted_results = toc_chunks + non_toc_chunks
         if toc_chunks:
-            print(f"[RAG] Prioritized {len(toc_chunks)} TOC chunks at top")
+            logger.debug("Prioritized %s TOC chunks at top", len(toc_chunks))
+
+        return sorted_results, question_keywords
+
+    async def _small_talk_response(
+        self,
+        db: AsyncIOMotorDatabase,
+        user_id: str,
+        question: str,
+        document_ids: Optional[List[str]],
+        conversation_id: Optional[str],
+    ) -> Optional[dict]:
+        """Stage small_talk: trả lời ngay các câu chào/cảm ơn (không search, không gọi LLM)."""
+        # Handle các câu chào / small-talk không liên quan đến tài liệu
+        normalized_question = question.strip().lower()
+        small_talk_phrases = [
+            "hi",
+            "hello",
+            "xin chào",
+            "chào",
+            "chao",
+            "chào bạn",
+            "chào ad",
+            "chào admin",
+            "good morning",
+            "good afternoon",
+            "good evening",
+            "bye",
+            "tạm biệt",
+            "cảm ơn",
+            "thank you",
+        ]
+
+        # Nếu câu hỏi rất ngắn và chỉ là lời chào / cảm ơn thì không gọi RAG
+        if len(normalized_question) <= 40 and any(
+            normalized_question == p or normalized_question.startswith(p + " ")
+            for p in small_talk_phrases
+        ):
+            # Trả lời thân thiện, không trích dẫn tài liệu
+            if any(
+                kw in normalized_question
+                for kw in ["cảm ơn", "cam on", "thank", "tks", "thanks"]
+            ):
+                answer = (
+                    "Cảm ơn bạn! Nếu cần mình hỗ trợ giải bài hoặc tóm tắt nội dung trong tài liệu, "
+                    "hãy gửi câu hỏi nhé."
+                )
+            elif any(
+                kw in normalized_question
+                for kw in ["bye", "tạm biệt", "tam biet", "good night"]
+            ):
+                answer = (
+                    "Tạm biệt bạn, hẹn gặp lại! Khi nào cần hỏi bài hoặc tra cứu tài liệu, cứ quay lại nhé."
+                )
+            else:
+                answer = (
+                    "Xin chào! Mình là trợ lý StudyQnA, mình sẽ giúp bạn trả lời các câu hỏi dựa trên tài liệu "
+                    "bạn đã tải lên. Bạn cứ gửi câu hỏi về nội dung cần học nhé."
+                )
+
+            # Lưu lịch sử nhưng không có references
+            # Use first document_id for backward compatibility
+            doc_id_for_history = document_ids[0] if document_ids and len(document_ids) > 0 else None
+            history_record = await create_history(
+                db, user_id, question, answer, [], doc_id_for_history, conversation_id,
+                background=settings.history_async_writes,
+            )
+            final_conversation_id = history_record.conversation_id
+
+            return {
+                "answer": answer,
+                "references": [],
+                "documents": [],
+                "conversation_id": final_conversation_id,
+                "history_id": history_record.id,
+            }
 
+        return None
 
+    async def _select_context(
+        self,
+        db: AsyncIOMotorDatabase,
+        documents: List[DocumentInDB],
+        results: List[dict],
+        sorted_results: List[dict],
+        question: str,
+        question_keywords: List[str],
+        query_type: str,
+        max_chunks_for_query: int,
+    ) -> ContextSelection:
+        """Stage select: chọn chunks đưa vào context theo query type + giới hạn độ dài."""
+        question_lower = question.lower()
 
         # ENHANCED: Smart chunk selection based on query type
         selected_results = []
@@ -2276,7 +2536,7 @@ class RAGService:
                     for pattern in section_patterns:
                         if re.search(pattern, content_lower, re.IGNORECASE):
                             has_section_match = True
-                            print(f"[RAG] Section match found: pattern '{pattern}' in chunk {item.get('chunk_index', '?')}")
+                            debug_sampled(logger, "context_section_pattern_match", "Section match found: pattern '%s' in chunk %s", pattern, item.get('chunk_index', '?'))
                             break
                     
                     if has_section_match:
@@ -2310,7 +2570,7 @@ class RAGService:
                     for pattern in section_patterns:
                         if re.search(pattern, content_lower, re.IGNORECASE):
                             has_section_match = True
-                            print(f"[RAG] Section match found: pattern '{pattern}' in chunk {item.get('chunk_index', '?')}")
+                            debug_sampled(logger, "context_section_pattern_match", "Section match found: pattern '%s' in chunk %s", pattern, item.get('chunk_index', '?'))
                             break
                     
                     if has_section_match:
@@ -2326,6 +2586,25 @@ class RAGService:
 
         all_chunks_ordered = priority_chunks + regular_chunks
 
+        # SECTION_OVERVIEW: lấy thẳng range chunks của PHẦN X từ section index (không cần scan)
+        if query_type == "SECTION_OVERVIEW":
+            section_num_match = re.search(r'(phần|chương|part)\s+(\d+)', question_lower)
+            if section_num_match:
+                section_items = []
+                for doc in documents:
+                    node = find_section_by_number(doc.section_index or [], section_num_match.group(2))
+                    if not node:
+                        continue
+                    chunk_range = list(range(node["chunk_start"], node["chunk_end"] + 1))[:max_chunks_for_query]
+                    section_items.extend(await self._section_index_items(db, doc, chunk_range, results))
+                    debug_sampled(logger, "context_section_index_hit", "Section index hit: %s → chunks %s-%s (%s)", node['heading'], node['chunk_start'], node['chunk_end'], doc.filename)
+                if section_items:
+                    section_keys = {(item["document"].id, item["_record"]["chunk_index"]) for item in section_items}
+                    all_chunks_ordered = section_items + [
+                        item for item in all_chunks_ordered
+                        if (item["document"].id, item.get("_record", {}).get("chunk_index")) not in section_keys
+                    ]
+
 
 
         current_context_length = 0
@@ -2348,7 +2627,7 @@ class RAGService:
                 context_limit = 55000  # Tăng từ 35k → 55k
             else:
                 context_limit = 50000  # Tăng từ 22k → 50k
-            print(f"[RAG] DOCUMENT_OVERVIEW: Using extended context limit: {context_limit} chars, max_chunks: {max_selected_chunks} (for {num_docs} document(s))")
+            logger.debug("DOCUMENT_OVERVIEW: Using extended context limit: %s chars, max_chunks: %s (for %s document(s))", context_limit, max_selected_chunks, num_docs)
         else:
             context_limit = self.base_max_context_length
 
@@ -2367,7 +2646,7 @@ class RAGService:
             # For 2 files: ~40 chunks per file, for 3+ files: ~30 chunks per file
             # Tăng chunks_per_doc để đảm bảo có đủ chunks từ mỗi document
             chunks_per_doc = max(40, int(max_selected_chunks * 0.6))  # 60% của max_selected_chunks cho mỗi doc
-            print(f"[RAG] DOCUMENT_OVERVIEW multi-doc: Selecting top {chunks_per_doc} chunks from each of {len(documents)} document(s)")
+            logger.debug("DOCUMENT_OVERVIEW multi-doc: Selecting top %s chunks from each of %s document(s)", chunks_per_doc, len(documents))
             
             balanced_chunks = []
             for doc_id, doc_chunks in chunks_by_doc.items():
@@ -2375,21 +2654,38 @@ class RAGService:
                 # Đảm bảo chọn đủ chunks từ mỗi document
                 top_chunks = doc_chunks[:min(chunks_per_doc, len(doc_chunks))]
                 balanced_chunks.extend(top_chunks)
-                print(f"[RAG] Selected {len(top_chunks)} chunks from document {doc_id} (total available: {len(doc_chunks)})")
+                logger.debug("Selected %s chunks from document %s (total available: %s)", len(top_chunks), doc_id, len(doc_chunks))
             
             # Re-sort by similarity to maintain quality
             balanced_chunks = sorted(balanced_chunks, key=lambda r: r["similarity"], reverse=True)
             all_chunks_ordered = balanced_chunks
-            print(f"[RAG] DOCUMENT_OVERVIEW: Balanced selection - {len(all_chunks_ordered)} chunks from {len(documents)} document(s)")
+            logger.debug("DOCUMENT_OVERVIEW: Balanced selection - %s chunks from %s document(s)", len(all_chunks_ordered), len(documents))
 
         # CRITICAL FIX: Pre-filtering để đảm bảo section coverage cho DOCUMENT_OVERVIEW
         # Đảm bảo mỗi section có ít nhất 1 chunk representative
         if is_document_overview:
-            print(f"[RAG] DOCUMENT_OVERVIEW: Pre-filtering to ensure section coverage...")
-            
-            # Nhóm chunks theo section
+            logger.debug("DOCUMENT_OVERVIEW: Pre-filtering to ensure section coverage...")
+
+            section_representatives = []
+
+            # Tài liệu có section index: lấy heading + chunk mở đầu của mỗi phần (direct lookup)
+            indexed_docs = [doc for doc in documents if doc.section_index]
+            for doc in indexed_docs:
+                rep_indices = []
+                for node in doc.section_index:
+                    rep_indices.append(node["chunk_start"])
+                    if node["chunk_end"] > node["chunk_start"]:
+                        rep_indices.append(node["chunk_start"] + 1)
+                doc_reps = await self._section_index_items(db, doc, rep_indices, results)
+                section_representatives.extend(doc_reps)
+                logger.debug("Section index: %s sections, %s representative chunks (%s)", len(doc.section_index), len(doc_reps), doc.filename)
+
+            # Tài liệu chưa có heading trong index: scan content tìm "PHẦN X" như cũ
+            indexed_doc_ids = {doc.id for doc in indexed_docs}
             chunks_by_section = {}
             for idx, item in enumerate(all_chunks_ordered):
+                if item["document"].id in indexed_doc_ids:
+                    continue
                 content = item.get("_content", "")
                 if not content:
                     continue
@@ -2415,7 +2711,6 @@ class RAGService:
                     chunks_by_section[section_num].append((idx, item))
             
             # Lấy 1 chunk representative từ mỗi section (chunk có similarity cao nhất)
-            section_representatives = []
             for section_num in sorted(chunks_by_section.keys()):
                 chunk_list = chunks_by_section[section_num]
                 # Sort by similarity (descending) và lấy chunk đầu tiên
@@ -2424,28 +2719,35 @@ class RAGService:
                 section_representatives.append(best_item)
                 
                 chunk_index = best_item.get("_record", {}).get("chunk_index", "?")
-                print(f"[RAG] Section PHẦN {section_num}: selected chunk {chunk_index} (similarity: {best_item.get('similarity', 0):.3f})")
+                debug_sampled(logger, "context_section_representative", "Section PHẦN %s: selected chunk %s (similarity: %.3f)", section_num, chunk_index, best_item.get('similarity', 0))
             
-            # Thêm representatives vào selected_results trước
+            # Thêm representatives vào selected_results (và context) trước
             for rep_item in section_representatives:
                 rep_content = rep_item.get("_content", "")
                 rep_length = len(rep_content) if rep_content else 0
                 selected_results.append(rep_item)
+                chunk_metadata_for_context.append(self._build_context_metadata(rep_item))
                 current_context_length += rep_length
             
-            print(f"[RAG] DOCUMENT_OVERVIEW: Pre-selected {len(section_representatives)} section representatives from {len(chunks_by_section)} sections")
-            print(f"[RAG] Pre-selection context length: {current_context_length}/{context_limit} chars")
+            logger.debug("DOCUMENT_OVERVIEW: Pre-selected %s section representatives", len(section_representatives))
+            logger.debug("Pre-selection context length: %s/%s chars", current_context_length, context_limit)
+
+            # Mọi tài liệu đều có index → danh sách phần đã đủ, chỉ bổ sung ít chunk theo similarity
+            if indexed_docs and len(indexed_docs) == len(documents):
+                max_selected_chunks = len(section_representatives) + self._determine_max_chunks_for_query(
+                    question, "DIRECT", num_docs=len(documents)
+                )
             
             # Loại bỏ các chunks đã được chọn từ all_chunks_ordered để tránh duplicate
-            selected_chunk_indices = {
-                rep_item.get("_record", {}).get("chunk_index")
+            selected_keys = {
+                (rep_item["document"].id, rep_item.get("_record", {}).get("chunk_index"))
                 for rep_item in section_representatives
             }
             all_chunks_ordered = [
                 item for item in all_chunks_ordered
-                if item.get("_record", {}).get("chunk_index") not in selected_chunk_indices
+                if (item["document"].id, item.get("_record", {}).get("chunk_index")) not in selected_keys
             ]
-            print(f"[RAG] Remaining chunks after pre-selection: {len(all_chunks_ordered)}")
+            logger.debug("Remaining chunks after pre-selection: %s", len(all_chunks_ordered))
 
         for item in all_chunks_ordered:
 
@@ -2486,68 +2788,7 @@ class RAGService:
             
 
             # Store chunk metadata
-
-            record = item.get("_record")
-
-            chunk_doc = item.get("_chunk_doc")
-
-            
-            # Lấy metadata từ chunk_doc (chunks collection)
-            chunk_metadata = {}
-            if chunk_doc:
-                chunk_metadata = (chunk_doc.get("metadata") or {})
-                # Debug: log metadata cho một vài chunks để kiểm tra
-                chunk_idx = record.get("chunk_index") if record else None
-                if chunk_idx in [1, 3, 8, 10, 11] and item["document"].file_type in ["docx", "doc"]:
-                    print(f"[RAG] Building context - chunk {chunk_idx}: chunk_doc metadata = {chunk_metadata}")
-            else:
-                # Nếu không có chunk_doc, thử từ record
-                if record:
-                    chunk_metadata = (record.get("metadata") or {})
-            
-            # Đảm bảo chunk_metadata là dict
-            if not isinstance(chunk_metadata, dict):
-                chunk_metadata = {}
-
-            # Lấy heading hoặc section title cho DOCX
-
-            heading = chunk_metadata.get("heading") or chunk_metadata.get("title") or chunk_metadata.get("section_title")
-            section = chunk_metadata.get("section")
-            
-            # Nếu không có section/heading trong metadata, thử extract từ content
-            if not section and not heading and content and item["document"].file_type in ["docx", "doc", "md", "txt"]:
-                extracted = self._extract_section_from_content(content, item["document"].file_type)
-                if extracted:
-                    section = extracted
-                    # Nếu content ngắn và có vẻ là heading, thì đó là heading
-                    if len(content.strip()) < 100:
-                        heading = extracted
-
-            chunk_idx = record.get("chunk_index") if record else None
-            
-            chunk_metadata_for_context.append({
-
-                "chunk_index": chunk_idx,
-
-                "document_id": record.get("document_id") if record else None,  # THÊM document_id
-
-                "page_number": chunk_metadata.get("page_number"),
-
-                "section": section,
-
-                "heading": heading,  # THÊM heading
-
-                "document_type": item["document"].file_type,  # THÊM loại file
-
-                "document_filename": item["document"].filename,  # THÊM tên file
-
-                "content": content
-
-            })
-            
-            # Debug: log section/heading cho một vài chunks
-            if chunk_idx in [1, 3, 8, 10, 11] and item["document"].file_type in ["docx", "doc"]:
-                print(f"[RAG] Context metadata for chunk {chunk_idx}: section={section}, heading={heading}, extracted_from_content={section != chunk_metadata.get('section')}")
+            chunk_metadata_for_context.append(self._build_context_metadata(item))
 
             
 
@@ -2555,39 +2796,50 @@ class RAGService:
 
 
 
-        print(f"[RAG] Selected {len(selected_results)} chunks (context length: {current_context_length}/{context_limit} chars, max_chunks: {max_selected_chunks})")
+        logger.debug("Selected %s chunks (context length: %s/%s chars, max_chunks: %s)", len(selected_results), current_context_length, context_limit, max_selected_chunks)
 
-        print(f"[RAG] Priority chunks: {len(priority_chunks)}, Regular chunks: {len(regular_chunks)}")
+        logger.debug("Priority chunks: %s, Regular chunks: %s", len(priority_chunks), len(regular_chunks))
 
 
 
-        # Add similarity to chunk metadata
+        # Add similarity to chunk metadata - khóa theo (document_id, chunk_index):
+        # nhiều tài liệu có cùng chunk_index, pack_context dựa vào điểm này để bỏ chunk
+        similarity_by_chunk = {}
         for item in selected_results:
             record = item.get("_record")
             if record:
-                chunk_idx = record.get("chunk_index")
-                for chunk_meta in chunk_metadata_for_context:
-                    if chunk_meta.get("chunk_index") == chunk_idx:
-                        chunk_meta["similarity"] = item.get("similarity", 0.5)
-                        break
-        
-        # CRITICAL FIX: Store selected_results for recovery mechanism in COMPARE_SYNTHESIZE
-        self.selected_results = selected_results
-        
-        # ENHANCED: Generate answer with query_type passed to prompt builder
-        answer, chunks_actually_used, answer_type, confidence, sentence_mapping = \
-            await self._generate_answer_with_tracking(
-                question, 
-                chunk_metadata_for_context,
-                query_type,  # Pass query type to generation
-                selected_documents=documents,
-            )
-
-        print(f"[RAG] LLM used {len(chunks_actually_used)} chunks in answer")
-        print(f"[RAG] Chunks used: {chunks_actually_used}")
-        print(f"[RAG] Answer type: {answer_type}, Confidence: {confidence:.2f}")
+                key = (record.get("document_id"), record.get("chunk_index"))
+                similarity_by_chunk.setdefault(key, item.get("similarity", 0.5))
+        for chunk_meta in chunk_metadata_for_context:
+            key = (chunk_meta.get("document_id"), chunk_meta.get("chunk_index"))
+            if key in similarity_by_chunk:
+                chunk_meta["similarity"] = similarity_by_chunk[key]
+
+        return ContextSelection(
+            selected_results=selected_results,
+            chunk_metadata_for_context=chunk_metadata_for_context,
+            context_length=current_context_length,
+            context_limit=context_limit,
+        )
 
+    def _build_final_references(
+        self,
+        generated: GeneratedAnswer,
+        selection: ContextSelection,
+        query_type: str,
+        document_ids: Optional[List[str]],
+    ) -> List[HistoryReference]:
+        """Stage references: dựng references từ chunks LLM đã dùng.
 
+        Có thể hạ/khôi phục answer_type + confidence (ghi ngược vào ``generated``).
+        """
+        answer = generated.answer
+        chunks_actually_used = generated.chunks_used
+        answer_type = generated.answer_type
+        confidence = generated.confidence
+        sentence_mapping = generated.sentence_mapping
+        selected_results = selection.selected_results
+        chunk_metadata_for_context = selection.chunk_metadata_for_context
 
         # Build references from chunks actually used in answer
         # If LLM didn't return chunk indices, use all selected chunks (sorted by similarity)
@@ -2685,7 +2937,7 @@ class RAGService:
                         if metadata_key in metadata_map:
                             metadata_map[metadata_key]["section"] = found_section
                             metadata_map[metadata_key]["heading"] = found_heading
-                            print(f"[RAG] Filled section for chunk {chunk_idx} from previous chunk: {found_section or found_heading}")
+                            debug_sampled(logger, "references_section_from_previous", "Filled section for chunk %s from previous chunk: %s", chunk_idx, found_section or found_heading)
         
         # Count chunks per document BEFORE filtering (to determine which documents are most relevant)
         chunks_by_document = {}
@@ -2713,7 +2965,7 @@ class RAGService:
             if answer_type == "FALLBACK" and query_type == "COMPARE_SYNTHESIZE" and "|" in answer:
                 # Try to use selected chunks for comparison tables
                 if selected_results:
-                    print(f"[RAG] COMPARE_SYNTHESIZE with table but FALLBACK → trying to recover chunks from selected_results")
+                    logger.debug("COMPARE_SYNTHESIZE with table but FALLBACK → trying to recover chunks from selected_results")
                     # Use top chunks from selected_results
                     for item in selected_results[:10]:  # Use top 10 chunks
                         record = item.get("_record")
@@ -2725,10 +2977,10 @@ class RAGService:
                     if chunks_actually_used:
                         answer_type = "COMPARE_SYNTHESIZE"  # Override FALLBACK
                         confidence = 0.75  # Set reasonable confidence
-                        print(f"[RAG] ✅ Recovered {len(chunks_actually_used)} chunks for COMPARE_SYNTHESIZE")
+                        logger.debug("✅ Recovered %s chunks for COMPARE_SYNTHESIZE", len(chunks_actually_used))
             if answer_type in ["FALLBACK", "TOO_BROAD"]:  # Still fallback after recovery attempt
                 final_references = []
-                print(f"[RAG] ✓ {answer_type} detected → 0 references enforced")
+                logger.debug("✓ %s detected → 0 references enforced", answer_type)
             
         if answer_type not in ["FALLBACK", "TOO_BROAD"] and not chunks_actually_used:
             # No chunks but not fallback → suspicious
@@ -2740,7 +2992,7 @@ class RAGService:
                         if s.get("chunk") and not s.get("external", False)
                     ]
                     if chunk_indices_from_mapping:
-                        print(f"[RAG] Recovered chunks from sentence_mapping: {chunk_indices_from_mapping}")
+                        logger.debug("Recovered chunks from sentence_mapping: %s", chunk_indices_from_mapping)
                         # Rebuild chunks_used
                         for idx in set(chunk_indices_from_mapping):
                             for item in selected_results:
@@ -2754,18 +3006,18 @@ class RAGService:
                 
                 # If still no chunks, suspicious → no refs
                 if not chunks_actually_used:
-                    print(f"[RAG] ⚠ High confidence but no chunks → suspicious, no refs")
+                    logger.warning("⚠ High confidence but no chunks → suspicious, no refs")
                     final_references = []
             else:
                 final_references = []
-                print(f"[RAG] Low confidence + no chunks → no references")
+                logger.debug("Low confidence + no chunks → no references")
         
         if chunks_actually_used:
             # Build references from chunks_used
             final_references = self._build_references_from_chunks(
                 chunks_actually_used, selected_results, chunk_metadata_for_context
             )
-            print(f"[RAG] ✓ Built {len(final_references)} references from chunks")
+            logger.debug("✓ Built %s references from chunks", len(final_references))
         
         # OLD LOGIC - REMOVED: If chunks_actually_used is empty, use top selected_results chunks
         # This is now handled above with strict fallback rules
@@ -2797,7 +3049,7 @@ class RAGService:
                         if relevant_docs:
                             top_chunks = [item for item in sorted_for_refs 
                                         if item.get("_record", {}).get("document_id") in relevant_docs][:15]
-                            print(f"[RAG] Filtered to documents with 2+ chunks: {relevant_docs}")
+                            logger.debug("Filtered to documents with 2+ chunks: %s", relevant_docs)
                         else:
                             top_chunks = sorted_for_refs[:15]
                     else:
@@ -2805,7 +3057,7 @@ class RAGService:
                 else:
                     top_chunks = sorted_for_refs[:15]
             
-            print(f"[RAG] No chunks returned by LLM, using top {len(top_chunks)} chunks (out of {len(selected_results)}) as references")
+            logger.debug("No chunks returned by LLM, using top %s chunks (out of %s) as references", len(top_chunks), len(selected_results))
             # Convert selected_results to chunk_info format
             chunks_actually_used = []
             for item in top_chunks:
@@ -2927,17 +3179,14 @@ class RAGService:
                         section = chunk_metadata.get("section")
                         heading = chunk_metadata.get("heading") or chunk_metadata.get("title") or chunk_metadata.get("section_title")
                         display_section = section or heading
-                        
-                        # Debug: log nếu không tìm thấy trong cache
-                        if target_chunk_index in [1, 3, 8, 10, 11, 42, 31, 48, 66]:
-                            print(f"[RAG] Warning: chunk {target_chunk_index} not found in metadata_map, using database. metadata={chunk_metadata}")
+
                     
                     # If still no section, try to extract from content (shouldn't happen often after second pass)
                     if not display_section and content and doc.file_type:
                         extracted_section = self._extract_section_from_content(content, doc.file_type)
                         if extracted_section:
                             display_section = extracted_section
-                            print(f"[RAG] Extracted section from content for chunk {target_chunk_index}: {display_section}")
+                            debug_sampled(logger, "references_section_from_content", "Extracted section from content for chunk %s: %s", target_chunk_index, display_section)
                     
                     # If still no section, or if section is not numbered (might have better numbered section),
                     # try to find from previous chunks in database
@@ -2946,78 +3195,20 @@ class RAGService:
                     has_section = bool(display_section)
                     is_numbered = self._is_numbered_section(display_section) if display_section else False
                     
-                    # Query database if: no section, or has section but not numbered (might find better numbered section)
-                    if target_chunk_index is not None and target_chunk_index > 0 and (not has_section or not is_numbered):
-                        doc_id_for_lookup = target_document_id or record.get("document_id") if record else None
-                        if doc_id_for_lookup:
-                            try:
-                                # Query database for previous chunks in the same document
-                                # Look for chunks with chunk_index < target_chunk_index, ordered by chunk_index desc
-                                # Limit to 10 chunks to avoid too many queries
-                                previous_chunks = await db["chunks"].find({
-                                    "document_id": doc_id_for_lookup,
-                                    "chunk_index": {"$lt": target_chunk_index}
-                                }).sort("chunk_index", -1).limit(10).to_list(length=10)
-                                
-                                # Collect candidate sections from previous chunks
-                                candidate_sections = []
-                                for prev_chunk in previous_chunks:
-                                    prev_metadata = prev_chunk.get("metadata") or {}
-                                    prev_section = prev_metadata.get("section")
-                                    prev_heading = prev_metadata.get("heading")
-                                    
-                                    # Also try to extract from content if it looks like a heading
-                                    prev_content = prev_chunk.get("content", "")
-                                    if not prev_section and not prev_heading and prev_content:
-                                        extracted = self._extract_section_from_content(prev_content, doc.file_type if doc else "docx")
-                                        if extracted:
-                                            prev_section = extracted
-                                    
-                                    if prev_heading:
-                                        candidate_sections.append({
-                                            "text": prev_heading,
-                                            "is_heading": True,
-                                            "is_numbered": self._is_numbered_section(prev_heading),
-                                            "length": len(prev_heading),
-                                            "chunk_idx": prev_chunk.get("chunk_index")
-                                        })
-                                    if prev_section and prev_section != prev_heading:
-                                        candidate_sections.append({
-                                            "text": prev_section,
-                                            "is_heading": False,
-                                            "is_numbered": self._is_numbered_section(prev_section),
-                                            "length": len(prev_section),
-                                            "chunk_idx": prev_chunk.get("chunk_index")
-                                        })
-                                
-                                # Choose the best section: prefer numbered sections
-                                if candidate_sections:
-                                    def section_priority(candidate):
-                                        priority = 0
-                                        if candidate["is_numbered"]:
-                                            priority += 1000  # Highest priority
-                                        if candidate["is_heading"]:
-                                            priority += 100
-                                        if candidate["length"] < 60:
-                                            priority += 50
-                                        # Prefer sections from chunks closer to current chunk
-                                        priority += (100 - candidate["chunk_idx"] or 0) / 100
-                                        return priority
-                                    
-                                    candidate_sections.sort(key=section_priority, reverse=True)
-                                    best_candidate = candidate_sections[0]
-                                    
-                                    # Only use database section if:
-                                    # 1. We had no section, OR
-                                    # 2. Database has a numbered section (better than non-numbered)
-                                    if not has_section or (best_candidate["is_numbered"] and not is_numbered):
-                                        display_section = best_candidate["text"]
-                                        print(f"[RAG] Found section from database for chunk {target_chunk_index}: {display_section} (from chunk {best_candidate['chunk_idx']})")
-                            except Exception as e:
-                                print(f"[RAG] Error querying database for previous chunks: {e}")
+                    # Tra section index (dựng lúc upload) thay vì query ngược các chunk trước đó
+                    if target_chunk_index is not None and (not has_section or not is_numbered):
+                        node = find_section_for_chunk(doc.section_index or [], target_chunk_index)
+                        if node:
+                            node_is_numbered = self._is_numbered_section(node["heading"])
+                            # Only use index section if:
+                            # 1. We had no section, OR
+                            # 2. Index has a numbered section (better than non-numbered)
+                            if not has_section or (node_is_numbered and not is_numbered):
+                                display_section = node["heading"]
+                                debug_sampled(logger, "references_section_from_index", "Found section from section index for chunk %s: %s", target_chunk_index, display_section)
                     
                     if not display_section:
-                        print(f"[RAG] No section found for chunk {target_chunk_index} after all attempts")
+                        debug_sampled(logger, "references_section_missing", "No section found for chunk %s after all attempts", target_chunk_index)
 
                     
 
@@ -3132,11 +3323,11 @@ class RAGService:
                 ref for ref in deduplicated_refs 
                 if ref.document_id in document_ids  # ← THAY ĐỔI: check in list
             ]
-            print(f"[RAG] 🎯 Filtered to {len(document_ids)} selected document(s): {len(filtered_refs)} references")
+            logger.debug("🎯 Filtered to %s selected document(s): %s references", len(document_ids), len(filtered_refs))
         else:
             # "Tất cả tài liệu" mode - giữ mọi reference
             if len(chunks_by_document) > 1:
-                print(f"[RAG] 📚 Multiple documents used, keeping all {len(filtered_refs)} references")
+                logger.debug("📚 Multiple documents used, keeping all %s references", len(filtered_refs))
         
         # Smart filtering: If there are multiple sections, prioritize the section(s) với nhiều chunk nhất.
         # Chỉ áp dụng khi tất cả references đều thuộc 1 tài liệu; nếu nhiều tài liệu thì giữ nguyên.
@@ -3209,13 +3400,13 @@ class RAGService:
                 if top_chunk_count >= 3:
                     # Only keep top section if it has 3+ chunks
                     filtered_refs = section_refs[top_section_key]
-                    print(f"[RAG] Filtered to top section only: {top_section_key} ({top_chunk_count} chunks, {len(filtered_refs)} references)")
+                    logger.debug("Filtered to top section only: %s (%s chunks, %s references)", top_section_key, top_chunk_count, len(filtered_refs))
                 elif len(sorted_sections) > 1:
                     # Keep top 2 sections
                     second_section_key = sorted_sections[1][0]
                     second_chunk_count = section_chunk_counts.get(second_section_key, 0)
                     filtered_refs = section_refs[top_section_key] + section_refs[second_section_key]
-                    print(f"[RAG] Filtered to top 2 sections: {top_section_key} ({top_chunk_count} chunks), {second_section_key} ({second_chunk_count} chunks)")
+                    logger.debug("Filtered to top 2 sections: %s (%s chunks), %s (%s chunks)", top_section_key, top_chunk_count, second_section_key, second_chunk_count)
                 else:
                     # Only one section, keep all
                     filtered_refs = sorted_sections[0][1]
@@ -3228,95 +3419,253 @@ class RAGService:
 
 
 
-        print(f"[RAG] Final references: {len(final_references)} chunks")
+        logger.debug("Final references: %s chunks", len(final_references))
 
-        print(f"[RAG] Reference details:")
+        logger.debug("Reference details:")
 
         for ref in final_references:
 
-            print(f"  - File: {ref.document_filename}, Page: {ref.page_number}, Section: {ref.section}, Chunk: {ref.chunk_index}")
-
+            logger.debug("  - File: %s, Page: %s, Section: %s, Chunk: %s", ref.document_filename, ref.page_number, ref.section, ref.chunk_index)
 
+        generated.answer_type = answer_type
+        generated.confidence = confidence
+        return final_references
 
-        # === ENHANCED LOGGING ===
-        documents_used = list({ref.document_id for ref in final_references if getattr(ref, "document_id", None)})
-
-        log_entry = {
-            "timestamp": datetime.utcnow().isoformat(),
-            "question": question[:100],
-            "document_ids": document_ids,  # ← THAY ĐỔI
-            "documents_searched": document_ids_used,
-            "query_type": detect_query_type_fast(question),
-            "answer_type": answer_type,
-            "confidence": confidence,
-            "chunks_retrieved": len(results) if 'results' in locals() else 0,
-            "documents_used": documents_used,
-            "chunks_selected": len(selected_results) if 'selected_results' in locals() else 0,
-            "chunks_used": [c.get("chunk_index") for c in chunks_actually_used],
-            "references_count": len(final_references),
-            "answer_length": len(answer),
-            "sentence_mapping_count": len(sentence_mapping),
-            "max_similarity": max(
-                [item.get("similarity", 0) for item in selected_results]
-            ) if selected_results else 0
-        }
-        print(f"[RAG] Query Log: {json.dumps(log_entry, ensure_ascii=False)}")
-        
-        # Ensure conversation_id is set - use provided conversation_id or create new one
-        # If conversation_id is provided, use it (for continuing existing conversation)
-        # If not provided, we'll set it to history_id after creating the record
-        final_conversation_id = conversation_id
-
-        # Create history with conversation_id (may be None for new conversation)
-        print(f"[RAG] ===== Creating history record =====")
-        print(f"[RAG] Question: {question[:100]}...")
-        print(f"[RAG] Answer: {answer[:100]}...")
-        print(f"[RAG] Conversation ID: {final_conversation_id}")
-        print(f"[RAG] Document IDs: {document_ids_used}")
-        print(f"[RAG] References count: {len(final_references)}")
+    async def _save_history(
+        self,
+        db: AsyncIOMotorDatabase,
+        user_id: str,
+        question: str,
+        answer: str,
+        final_references: List[HistoryReference],
+        document_ids: Optional[List[str]],
+        document_ids_used: List[str],
+        conversation_id: Optional[str],
+    ) -> tuple:
+        """Stage history: lưu Q&A, trả về (history_id, conversation_id)."""
+        # conversation_id mới = history_id, _id sinh phía client → 1 lần insert duy nhất
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Creating history record: question=%s... conversation=%s documents=%s references=%s",
+                         question[:100], conversation_id, document_ids_used, len(final_references))
         
         # Use first document_id for backward compatibility with history model
         doc_id_for_history = document_ids[0] if document_ids and len(document_ids) > 0 else None
         history_record = await create_history(
-            db, user_id, question, answer, final_references, doc_id_for_history, final_conversation_id
+            db, user_id, question, answer, final_references, doc_id_for_history, conversation_id,
+            background=settings.history_async_writes,
         )
+        final_conversation_id = history_record.conversation_id
+        logger.debug("History record %s (conversation %s)", history_record.id, final_conversation_id)
+
+        return history_record.id, final_conversation_id
+
+    async def ask(
+
+        self,
+
+        db: AsyncIOMotorDatabase,
+
+        user_id: str,
+
+        question: str,
+
+        document_ids: Optional[List[str]] = None,  # ← THAY ĐỔI: List[str] thay vì str
+
+        top_k: Optional[int] = None,
+
+        conversation_id: Optional[str] = None,
+
+        debug: bool = False,
+
+    ) -> dict:
+        """Pipeline: load → small_talk → embed → retrieve → rerank → select → generate → references → history.
+
+        Thời gian từng stage được cộng vào ``pipeline_metrics``; khi ``debug`` (hoặc
+        RAG_DEBUG_METRICS) bật thì trả thêm trong ``metadata["pipeline"]``.
+        """
+        trace = PipelineTrace()
+        try:
+            result = await self._run_pipeline(db, user_id, question, document_ids, conversation_id, trace)
+        finally:
+            trace.finish()
+            pipeline_metrics.record(trace)
+            # Dòng INFO duy nhất mỗi request - trace được format ở listener thread
+            logger.info("ask pipeline %s", trace)
+        if debug or settings.rag_debug_metrics:
+            result.setdefault("metadata", {})["pipeline"] = trace.as_dict()
+        return result
+
+    async def _run_pipeline(
+        self,
+        db: AsyncIOMotorDatabase,
+        user_id: str,
+        question: str,
+        document_ids: Optional[List[str]],
+        conversation_id: Optional[str],
+        trace: PipelineTrace,
+    ) -> dict:
+        with trace.stage("load_documents") as stage:
+            documents = await self._load_documents(db, user_id, document_ids)
+            stage.count = len(documents)
         
-        print(f"[RAG] ✅ History record created - ID: {history_record.id}")
-        print(f"[RAG] ===================================")
-
-        # If no conversation_id was provided, use the history_id as conversation_id
-        # This ensures all Q&As in the same conversation share the same conversation_id
-        if not final_conversation_id:
-            final_conversation_id = history_record.id
-            # Update the history record to set conversation_id = history_id
-            # This ensures consistency when loading conversations
-            try:
-                from bson import ObjectId
-                update_result = await db["histories"].update_one(
-                    {"_id": ObjectId(history_record.id)},
-                    {"$set": {"conversation_id": history_record.id}}
+        # GIÁM SÁT: Log documents IDs để debug
+        document_ids_used = [doc.id for doc in documents]
+        logger.debug("Document IDs being searched: %s", document_ids_used)
+
+        with trace.stage("small_talk"):
+            small_talk = await self._small_talk_response(db, user_id, question, document_ids, conversation_id)
+        if small_talk is not None:
+            return small_talk
+
+        with trace.stage("embed"):
+            question_embeddings = await self.embedding_service.embed_texts([question])
+
+        if not question_embeddings:
+            # ENHANCED: Detect query type even for error cases
+            query_type = detect_query_type_fast(question)
+            return {
+                "answer": "Không thể tạo embedding cho câu hỏi.",
+                "references": [],
+                "documents": [],
+                "metadata": {
+                    "answer_type": "FALLBACK",
+                    "confidence": 0.0,
+                    "query_type": query_type,
+                    "chunks_selected": 0,
+                    "chunks_used": 0,
+                }
+            }
+
+        # ENHANCED: Detect query type FIRST để điều chỉnh search
+        query_type = detect_query_type_fast(question)
+        logger.debug("Detected query type: %s", query_type)
+
+        # Section/TOC index dựng lúc upload - backfill cho tài liệu cũ
+        with trace.stage("section_index"):
+            await self._ensure_section_indexes(db, documents)
+
+        query_vector = np.array(question_embeddings, dtype="float32")
+
+        # ENHANCED: Dynamic max_chunks
+        max_chunks_for_query = self._determine_max_chunks_for_query(
+            question, 
+            query_type,
+            num_docs=len(documents)  # ✅ THÊM THAM SỐ
+        )
+        logger.debug("Max chunks for this query: %s (for %s document(s))", max_chunks_for_query, len(documents))
+
+        with trace.stage("retrieve") as stage:
+            results = await self._retrieve_candidates(db, documents, query_vector, query_type, question)
+            stage.count = len(results)
+
+
+
+        if not results:
+            # ENHANCED: Detect query type even for error cases
+            query_type = detect_query_type_fast(question)
+            
+            # ENHANCED: Thông báo rõ ràng cho user
+            if document_ids:
+                selected_filenames = [doc.filename for doc in documents]
+                answer = (
+                    f"Không tìm thấy thông tin liên quan trong {len(documents)} tài liệu đã chọn:\n"
+                    f"• {', '.join(selected_filenames)}\n\n"
+                    f"Có thể thử:\n"
+                    f"1. Chọn thêm tài liệu khác\n"
+                    f"2. Đặt câu hỏi theo cách khác\n"
+                    f"3. Kiểm tra nội dung tài liệu có liên quan không"
                 )
-                if update_result.modified_count > 0:
-                    print(f"[RAG] Set conversation_id = history_id for new conversation: {history_record.id}")
-                # Also update the history_record object for return value
-                history_record.conversation_id = history_record.id
-            except Exception as e:
-                print(f"[RAG] Warning: Failed to update conversation_id for history {history_record.id}: {e}")
-        else:
-            # Conversation_id was provided, ensure it's set correctly in the record
-            # (It should already be set, but double-check for consistency)
-            try:
-                from bson import ObjectId
-                # Verify the record has the correct conversation_id
-                existing_record = await db["histories"].find_one({"_id": ObjectId(history_record.id)})
-                if existing_record and existing_record.get("conversation_id") != final_conversation_id:
-                    await db["histories"].update_one(
-                        {"_id": ObjectId(history_record.id)},
-                        {"$set": {"conversation_id": final_conversation_id}}
-                    )
-                    print(f"[RAG] Updated conversation_id to {final_conversation_id} for history {history_record.id}")
-            except Exception as e:
-                print(f"[RAG] Warning: Failed to verify conversation_id for history {history_record.id}: {e}")
+            else:
+                answer = "Không tìm thấy đoạn văn phù hợp trong tài liệu của bạn."
+
+            return {
+                "answer": answer,
+                "references": [],
+                "documents": document_ids_used,
+                "documents_searched": document_ids_used,  # ← THÊM: list IDs đã search
+                "metadata": {
+                    "answer_type": "FALLBACK",
+                    "confidence": 0.0,
+                    "query_type": query_type,
+                    "chunks_selected": 0,
+                    "chunks_used": 0,
+                    "documents_searched": len(documents),  # ← THÊM: số docs đã search
+                }
+            }
+
+
+
+        # Hydrate + re-rank (keyword/section/TOC boost) - dùng chung với /query/search
+        with trace.stage("rerank") as stage:
+            sorted_results, question_keywords = await self._rerank_candidates(db, results, question, query_type)
+            stage.count = len(sorted_results)
+
+        with trace.stage("select") as stage:
+            selection = await self._select_context(
+                db, documents, results, sorted_results, question, question_keywords, query_type, max_chunks_for_query
+            )
+            stage.count = len(selection.selected_results)
+        selected_results = selection.selected_results
+        
+        # CRITICAL FIX: Store selected_results for recovery mechanism in COMPARE_SYNTHESIZE
+        self.selected_results = selected_results
+        
+        # ENHANCED: Generate answer with query_type passed to prompt builder
+        with trace.stage("generate") as stage:
+            generated = GeneratedAnswer(*(
+                await self._generate_answer_with_tracking(
+                    question, 
+                    selection.chunk_metadata_for_context,
+                    query_type,  # Pass query type to generation
+                    selected_documents=documents,
+                )
+            ))
+            stage.count = len(generated.chunks_used)
+
+        logger.debug("LLM used %s chunks in answer", len(generated.chunks_used))
+        logger.debug("Chunks used: %s", generated.chunks_used)
+        logger.debug("Answer type: %s, Confidence: %.2f", generated.answer_type, generated.confidence)
+
+        with trace.stage("references") as stage:
+            final_references = self._build_final_references(generated, selection, query_type, document_ids)
+            stage.count = len(final_references)
+
+        answer = generated.answer
+        answer_type = generated.answer_type
+        confidence = generated.confidence
+        chunks_actually_used = generated.chunks_used
+        sentence_mapping = generated.sentence_mapping
+
+
+
+        # === ENHANCED LOGGING ===
+        if logger.isEnabledFor(logging.DEBUG):
+            documents_used = list({ref.document_id for ref in final_references if getattr(ref, "document_id", None)})
+            log_entry = {
+                "timestamp": datetime.utcnow().isoformat(),
+                "question": question[:100],
+                "document_ids": document_ids,  # ← THAY ĐỔI
+                "documents_searched": document_ids_used,
+                "query_type": detect_query_type_fast(question),
+                "answer_type": answer_type,
+                "confidence": confidence,
+                "chunks_retrieved": len(results) if 'results' in locals() else 0,
+                "documents_used": documents_used,
+                "chunks_selected": len(selected_results) if 'selected_results' in locals() else 0,
+                "chunks_used": [c.get("chunk_index") for c in chunks_actually_used],
+                "references_count": len(final_references),
+                "answer_length": len(answer),
+                "sentence_mapping_count": len(sentence_mapping),
+                "max_similarity": max(
+                    [item.get("similarity", 0) for item in selected_results]
+                ) if selected_results else 0
+            }
+            logger.debug("Query Log: %s", json.dumps(log_entry, ensure_ascii=False))
+
+        with trace.stage("history"):
+            history_id, final_conversation_id = await self._save_history(
+                db, user_id, question, answer, final_references, document_ids, document_ids_used, conversation_id
+            )
 
 
 
@@ -3326,7 +3675,7 @@ class RAGService:
             "documents": list(set([ref.document_id for ref in final_references if ref.document_id])),
             "documents_searched": document_ids_used,  # ← THÊM: list IDs đã search
             "conversation_id": final_conversation_id,
-            "history_id": history_record.id,
+            "history_id": history_id,
             "metadata": {
                 "answer_type": answer_type,
                 "confidence": confidence,
@@ -3351,9 +3700,6 @@ class RAGService:
         Generate answer and track which chunks were actually used.
         Returns: (answer, chunks_used, answer_type, confidence, sentence_mapping)
         """
-        # Build context với similarity scores
-        context_parts = []
-        chunk_similarities = []
         selected_docs_info: Optional[List[Dict[str, str]]] = None
         if selected_documents:
             selected_docs_info = []
@@ -3367,26 +3713,19 @@ class RAGService:
                     "filename": filename,
                 })
 
-        for chunk_meta in chunk_metadata_list:
-            idx = chunk_meta["chunk_index"]
-            content = chunk_meta["content"]
-            sim = chunk_meta.get("similarity", 0.5)
-            chunk_similarities.append(sim)
-            
-            # Compact marker format
-            parts = [f"[Chunk {idx}]"]
-            if chunk_meta.get("document_filename"):
-                parts.append(f"[{chunk_meta['document_filename']}]")
-            if chunk_meta.get("page_number"):
-                parts.append(f"[Page {chunk_meta['page_number']}]")
-            if chunk_meta.get("section"):
-                parts.append(f"[{chunk_meta['section']}]")
-            parts.append(f"[Sim:{sim:.2f}]")
-            
-            marker = " ".join(parts)
-            context_parts.append(f"{marker}\n{content}")
-        
-        context_text = "\n\n---\n\n".join(context_parts)
+        # Đóng gói context theo ngân sách token: bỏ text overlap giữa chunk liền kề,
+        # gộp chunk liền kề cùng section, chọn tham lam theo similarity
+        if query_type == "DOCUMENT_OVERVIEW":
+            token_budget = settings.rag_overview_context_tokens
+        else:
+            token_budget = settings.rag_max_context_length_tokens
+        context_text, packed_chunks, pack_stats = pack_context(
+            chunk_metadata_list,
+            max_tokens=token_budget,
+            by_score=query_type != "DOCUMENT_OVERVIEW",
+        )
+        chunk_similarities = [chunk_meta.get("similarity", 0.5) for chunk_meta in packed_chunks]
+        logger.debug("Context packed: %s/%s chunks, %s/%s tokens (merged %s, deduped %s chars, skipped %s)", pack_stats['chunks_packed'], pack_stats['chunks_in'], pack_stats['tokens'], token_budget, pack_stats['chunks_merged'], pack_stats['deduped_chars'], pack_stats['chunks_skipped'])
         
         # ENHANCED: Build prompt with query_type
         prompt = build_gemini_optimized_prompt(
@@ -3425,10 +3764,10 @@ class RAGService:
                 # Log error details if request fails
                 if response.status_code != 200:
                     error_detail = response.text
-                    print(f"[RAG] Gemini API error ({response.status_code}): {error_detail[:500]}")
+                    logger.error("Gemini API error (%s): %s", response.status_code, error_detail[:500])
                     try:
                         error_json = response.json()
-                        print(f"[RAG] Error JSON: {json.dumps(error_json, ensure_ascii=False, indent=2)}")
+                        logger.error("Error JSON: %s", json.dumps(error_json, ensure_ascii=False, indent=2))
                     except:
                         pass
                     raise Exception(f"Gemini API returned {response.status_code}")
@@ -3440,7 +3779,8 @@ class RAGService:
                 raw = None
                 
                 if "candidates" not in data or len(data["candidates"]) == 0:
-                    print(f"[RAG] No candidates in response. Full response: {json.dumps(data, indent=2, ensure_ascii=False)[:1000]}")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("No candidates in response. Full response: %s", json.dumps(data, indent=2, ensure_ascii=False)[:1000])
                     raise Exception("No candidates in Gemini response")
                 
                 candidate = data["candidates"][0]
@@ -3500,11 +3840,12 @@ class RAGService:
                     raw = extract_text_recursive(candidate)
                 
                 if not raw:
-                    print(f"[RAG] ❌ Could not extract text from candidate")
-                    print(f"[RAG] Full candidate structure: {json.dumps(candidate, indent=2, ensure_ascii=False)[:2000]}")
+                    logger.error("❌ Could not extract text from candidate")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Full candidate structure: %s", json.dumps(candidate, indent=2, ensure_ascii=False)[:2000])
                     raise Exception("Could not extract text from Gemini response")
                 
-                print(f"[RAG] ✅ Extracted response: {len(raw)} chars")
+                logger.debug("✅ Extracted response: %s chars", len(raw))
                 parsed = self._safe_parse_json(raw, query_type)
                 
                 answer = parsed.get("answer", "")
@@ -3516,7 +3857,7 @@ class RAGService:
                             answer_obj = json.loads(answer)
                             if isinstance(answer_obj, dict) and "answer" in answer_obj:
                                 answer = answer_obj["answer"]
-                                print(f"[RAG] ✅ Extracted nested answer from JSON string")
+                                logger.debug("✅ Extracted nested answer from JSON string")
                         except:
                             pass  # If parsing fails, keep original answer
                     # Check if answer contains escaped JSON format like: "answer": "...", "answer_type": "..."
@@ -3534,9 +3875,9 @@ class RAGService:
                                 except:
                                     # Fallback: manual unescape
                                     answer = match.group(1).replace('\\n', '\n').replace('\\"', '"').replace('\\\\', '\\')
-                                print(f"[RAG] ✅ Extracted answer from JSON-like string")
+                                logger.debug("✅ Extracted answer from JSON-like string")
                         except Exception as e:
-                            print(f"[RAG] ⚠️ Failed to extract answer from JSON-like string: {e}")
+                            logger.error("⚠️ Failed to extract answer from JSON-like string: %s", e)
                             pass
                     # Check if answer contains escaped newlines and JSON structure indicators
                     elif '\\n' in answer and ('"answer_type"' in answer or '"chunks_used"' in answer or '"reasoning_steps"' in answer):
@@ -3551,9 +3892,9 @@ class RAGService:
                                 answer = answer.replace('\\n', '\n').replace('\\"', '"').replace('\\\\', '\\')
                                 # Remove trailing JSON structure if any
                                 answer = re.sub(r'\s*,\s*"answer_type".*$', '', answer, flags=re.DOTALL)
-                                print(f"[RAG] ✅ Extracted answer text from escaped JSON string")
+                                logger.debug("✅ Extracted answer text from escaped JSON string")
                         except Exception as e:
-                            print(f"[RAG] ⚠️ Failed to extract from escaped JSON: {e}")
+                            logger.error("⚠️ Failed to extract from escaped JSON: %s", e)
                             pass
                 
                 answer_type = parsed.get("answer_type", "FALLBACK")
@@ -3563,16 +3904,16 @@ class RAGService:
                     original_length = len(answer)
                     answer = self._fix_numbered_list_formatting(answer)
                     if len(answer) != original_length or "\n\n" in answer:
-                        print(f"[RAG] ✅ Fixed numbered list formatting: {original_length} -> {len(answer)} chars, has_double_newlines={answer.count(chr(10)*2)}")
+                        logger.debug("✅ Fixed numbered list formatting: %s -> %s chars, has_double_newlines=%s", original_length, len(answer), answer.count(chr(10)*2))
                     else:
-                        print(f"[RAG] ⚠️ Numbered list formatting fix may not have worked (length unchanged)")
+                        logger.warning("⚠️ Numbered list formatting fix may not have worked (length unchanged)")
                 
                 # Post-process: Clean table citations for COMPARE_SYNTHESIZE
                 if answer_type == "COMPARE_SYNTHESIZE" and "|" in answer:
                     original_length = len(answer)
                     answer = self._clean_table_citations(answer)
                     if len(answer) != original_length:
-                        print(f"[RAG] ✅ Cleaned table citations: {original_length} -> {len(answer)} chars")
+                        logger.debug("✅ Cleaned table citations: %s -> %s chars", original_length, len(answer))
                 chunk_indices_raw = parsed.get("chunks_used", [])
                 # Normalize chunk_indices: convert to list of integers
                 chunk_indices = []
@@ -3594,7 +3935,7 @@ class RAGService:
                     has_table = "| Tiêu chí |" in answer or "|" in answer
                     
                     if has_table and len(chunk_indices) < 3:
-                        print(f"[RAG] ⚠️ COMPARE_SYNTHESIZE table found but only {len(chunk_indices)} chunks")
+                        logger.warning("⚠️ COMPARE_SYNTHESIZE table found but only %s chunks", len(chunk_indices))
                         
                         # Try to extract from selected_results
                         if hasattr(self, 'selected_results') and self.selected_results:
@@ -3618,7 +3959,7 @@ class RAGService:
                             
                             # If still empty, use top chunks from selected_results
                             if not chunk_indices:
-                                print(f"[RAG] COMPARE_SYNTHESIZE with table but no chunks → recovering from selected_results")
+                                logger.debug("COMPARE_SYNTHESIZE with table but no chunks → recovering from selected_results")
                                 for item in self.selected_results[:15]:  # Lấy top 15 chunks
                                     record = item.get("_record")
                                     if record:
@@ -3630,7 +3971,7 @@ class RAGService:
                             if chunk_indices:
                                 answer_type = "COMPARE_SYNTHESIZE"  # Giữ nguyên type
                                 confidence = max(0.85, confidence)  # Boost confidence
-                                print(f"[RAG] ✅ Enhanced chunks_used to {len(chunk_indices)} chunks for COMPARE")
+                                logger.debug("✅ Enhanced chunks_used to %s chunks for COMPARE", len(chunk_indices))
                 
                 # === VALIDATION LAYER ===
                 
@@ -3639,25 +3980,25 @@ class RAGService:
                     chunk_indices = []
                     sentence_mapping = []
                     confidence = 0.0
-                    print(f"[RAG] TOO_BROAD detected → enforcing 0 chunks")
+                    logger.debug("TOO_BROAD detected → enforcing 0 chunks")
                 
                 # ENHANCED: Validation for reasoning queries - More lenient
                 if query_type in ["CODE_ANALYSIS", "EXERCISE_GENERATION", "MULTI_CONCEPT_REASONING"]:
                     # NEW: More lenient - only reject if VERY short or VERY low confidence
                     if len(answer) < 50:  # Only reject if VERY short
-                        print(f"[RAG] Reasoning query but answer too short ({len(answer)} chars)")
+                        logger.debug("Reasoning query but answer too short (%s chars)", len(answer))
                         answer_type = "FALLBACK"
                         chunk_indices = []
                         confidence = 0.0
                     elif confidence < 0.4:  # Lower threshold (from 0.5 to 0.4)
-                        print(f"[RAG] Low confidence for reasoning query ({confidence:.2f})")
+                        logger.debug("Low confidence for reasoning query (%.2f)", confidence)
                         answer_type = "FALLBACK"
                         chunk_indices = []
                         confidence = 0.0
                     else:
                         # Accept even without reasoning_steps field if answer is substantial
                         if not reasoning_steps:
-                            print(f"[RAG] Reasoning answer accepted despite missing reasoning_steps field (answer length: {len(answer)})")
+                            logger.debug("Reasoning answer accepted despite missing reasoning_steps field (answer length: %s)", len(answer))
                 else:
                     # Original validation for non-reasoning queries
                     # CRITICAL FIX: Don't apply fallback detection for SECTION_OVERVIEW or DOCUMENT_OVERVIEW
@@ -3674,7 +4015,7 @@ class RAGService:
                             # Check if answer is actually good despite keywords
                             if answer_length > 500 and (answer_has_chunk_refs or answer_has_citations):
                                 # Answer has substance and citations → NOT a fallback
-                                print(f"[RAG] ⚠️ Fallback keywords detected BUT answer quality good ({answer_length} chars, has citations) → KEEP")
+                                logger.debug("Fallback keywords detected BUT answer quality good (%s chars, has citations) → KEEP", answer_length)
                                 # CRITICAL FIX: Always extract chunks from answer text if answer is good
                                 # Even if chunks were zeroed out earlier, we should restore them
                                 if answer_has_chunk_refs:
@@ -3683,10 +4024,10 @@ class RAGService:
                                     # Merge with existing chunks, remove duplicates
                                     if chunk_indices:
                                         all_chunks = list(set(chunk_indices + extracted_chunks))
-                                        print(f"[RAG] Extracted {len(extracted_chunks)} chunks from answer text, merged with existing {len(chunk_indices)} → total: {len(all_chunks)}")
+                                        logger.debug("Extracted %s chunks from answer text, merged with existing %s → total: %s", len(extracted_chunks), len(chunk_indices), len(all_chunks))
                                     else:
                                         all_chunks = extracted_chunks
-                                        print(f"[RAG] Extracted {len(extracted_chunks)} chunks from answer text (was empty)")
+                                        logger.debug("Extracted %s chunks from answer text (was empty)", len(extracted_chunks))
                                     chunk_indices = all_chunks[:20]  # Limit to 20 chunks max
                                 # Auto-correct type if needed
                                 if answer_type == "FALLBACK":
@@ -3704,14 +4045,14 @@ class RAGService:
                                         confidence = 0.80  # Medium-long answer
                                     else:
                                         confidence = 0.75  # Short but good answer
-                                print(f"[RAG] Auto-corrected: type={answer_type}, confidence={confidence:.2f}, chunks={len(chunk_indices)}")
+                                logger.debug("Auto-corrected: type=%s, confidence=%.2f, chunks=%s", answer_type, confidence, len(chunk_indices))
                             else:
                                 # Real fallback - short answer with fallback keywords
                                 answer_type = "FALLBACK"
                                 chunk_indices = []
                                 confidence = 0.0
                                 sentence_mapping = []
-                                print(f"[RAG] Fallback detected via keywords")
+                                logger.debug("Fallback detected via keywords")
                         
                         # Rule 2: Low confidence → force fallback (unless TOO_BROAD)
                         # BUT: Don't force FALLBACK if answer has good quality
@@ -3719,7 +4060,7 @@ class RAGService:
                             # Check if answer is actually good despite low confidence
                             if answer_length > 500 and (answer_has_chunk_refs or answer_has_citations or len(chunk_indices) > 0):
                                 # Answer has substance → NOT a fallback, just low confidence from LLM
-                                print(f"[RAG] ⚠️ Low confidence ({confidence:.2f}) BUT answer quality good ({answer_length} chars, has citations) → KEEP")
+                                logger.debug("Low confidence (%.2f) BUT answer quality good (%s chars, has citations) → KEEP", confidence, answer_length)
                                 # CRITICAL FIX: Always extract chunks from answer text if answer is good
                                 # Even if chunks were zeroed out earlier, we should restore them
                                 if answer_has_chunk_refs:
@@ -3728,10 +4069,10 @@ class RAGService:
                                     # Merge with existing chunks, remove duplicates
                                     if chunk_indices:
                                         all_chunks = list(set(chunk_indices + extracted_chunks))
-                                        print(f"[RAG] Extracted {len(extracted_chunks)} chunks from answer text, merged with existing {len(chunk_indices)} → total: {len(all_chunks)}")
+                                        logger.debug("Extracted %s chunks from answer text, merged with existing %s → total: %s", len(extracted_chunks), len(chunk_indices), len(all_chunks))
                                     else:
                                         all_chunks = extracted_chunks
-                                        print(f"[RAG] Extracted {len(extracted_chunks)} chunks from answer text (was empty)")
+                                        logger.debug("Extracted %s chunks from answer text (was empty)", len(extracted_chunks))
                                     chunk_indices = all_chunks[:20]  # Limit to 20 chunks max
                                 # Auto-correct type if needed
                                 if answer_type == "FALLBACK":
@@ -3748,13 +4089,13 @@ class RAGService:
                                     confidence = 0.80  # Medium-long answer
                                 else:
                                     confidence = 0.75  # Short but good answer
-                                print(f"[RAG] Auto-corrected: type={answer_type}, confidence={confidence:.2f}, chunks={len(chunk_indices)}")
+                                logger.debug("Auto-corrected: type=%s, confidence=%.2f, chunks=%s", answer_type, confidence, len(chunk_indices))
                             else:
                                 # Real fallback - short answer with low confidence
                                 answer_type = "FALLBACK"
                                 chunk_indices = []
                                 sentence_mapping = []
-                                print(f"[RAG] Low confidence ({confidence:.2f}) → forced fallback")
+                                logger.debug("Low confidence (%.2f) → forced fallback", confidence)
                     else:
                         # CRITICAL FIX: Special handling for SECTION_OVERVIEW
                         if answer_type == "SECTION_OVERVIEW":
@@ -3767,18 +4108,18 @@ class RAGService:
                                 # If we have chunks and substantial content → KEEP IT
                                 if confidence < 0.7:
                                     confidence = 0.85  # Boost confidence
-                                print(f"[RAG] SECTION_OVERVIEW validated: chunks={len(chunk_indices)}, length={len(answer)}")
+                                logger.debug("SECTION_OVERVIEW validated: chunks=%s, length=%s", len(chunk_indices), len(answer))
                             elif has_title and has_content:
                                 # Even without chunks, if answer looks structured → KEEP IT
                                 confidence = max(0.75, confidence)
-                                print(f"[RAG] SECTION_OVERVIEW kept despite missing chunks (has structure)")
+                                logger.debug("SECTION_OVERVIEW kept despite missing chunks (has structure)")
                             else:
                                 # Only fallback if answer is really empty/broken
                                 if len(answer) < 50:
                                     answer_type = "FALLBACK"
                                     chunk_indices = []
                                     confidence = 0.0
-                                    print(f"[RAG] SECTION_OVERVIEW too short → fallback")
+                                    logger.debug("SECTION_OVERVIEW too short → fallback")
                         
                         # 🔥 CRITICAL FIX: Validate DOCUMENT_OVERVIEW output
                         elif answer_type == "DOCUMENT_OVERVIEW":
@@ -3807,13 +4148,13 @@ class RAGService:
                                 has_gaps = len(section_nums) != len(expected_range)
                             
                             if sections_found < 3:
-                                print(f"[RAG] ⚠️ DOCUMENT_OVERVIEW validation FAILED: only {sections_found} sections found (section_nums: {section_nums})")
+                                logger.error("⚠️ DOCUMENT_OVERVIEW validation FAILED: only %s sections found (section_nums: %s)", sections_found, section_nums)
                                 confidence = max(0.5, confidence * 0.7)
                             elif has_gaps:
-                                print(f"[RAG] ⚠️ DOCUMENT_OVERVIEW has gaps: {section_nums} (expected: {list(expected_range)})")
+                                logger.warning("⚠️ DOCUMENT_OVERVIEW has gaps: %s (expected: %s)", section_nums, list(expected_range))
                                 confidence = max(0.75, confidence * 0.9)
                             else:
-                                print(f"[RAG] ✅ DOCUMENT_OVERVIEW validated: {sections_found} sections, no gaps (sections: {section_nums})")
+                                logger.debug("✅ DOCUMENT_OVERVIEW validated: %s sections, no gaps (sections: %s)", sections_found, section_nums)
                                 confidence = min(0.95, confidence)
                             
                             # Still require minimum length
@@ -3821,29 +4162,29 @@ class RAGService:
                                 answer_type = "FALLBACK"
                                 chunk_indices = []
                                 confidence = 0.0
-                                print(f"[RAG] DOCUMENT_OVERVIEW too short → fallback")
+                                logger.debug("DOCUMENT_OVERVIEW too short → fallback")
                         else:
                             # Original validation: Only fallback if EXPLICITLY no chunks
                             if not chunk_indices:
                                 answer_type = "FALLBACK"
                                 confidence = 0.0
                                 sentence_mapping = []
-                                print(f"[RAG] {answer_type} but no chunks → fallback")
+                                logger.debug("%s but no chunks → fallback", answer_type)
                             else:
-                                print(f"[RAG] {answer_type} with {len(chunk_indices)} chunks → keeping answer")
+                                logger.debug("%s with %s chunks → keeping answer", answer_type, len(chunk_indices))
                 
                 # Rule 3: CRITICAL - Enforce fallback=0 refs (and TOO_BROAD)
                 if answer_type in ["FALLBACK", "TOO_BROAD"]:
                     chunk_indices = []
                     sentence_mapping = []
                     confidence = 0.0
-                    print(f"[RAG] {answer_type} type → enforcing 0 chunks")
+                    logger.debug("%s type → enforcing 0 chunks", answer_type)
                 
                 # Rule 4: No chunks but claims document source → suspicious (skip for overviews)
                 if not chunk_indices and sources.get("from_document") and answer_type not in ["SECTION_OVERVIEW", "DOCUMENT_OVERVIEW"]:
                     answer_type = "FALLBACK"
                     confidence = 0.0
-                    print(f"[RAG] Suspicious: no chunks but claims document source")
+                    logger.debug("Suspicious: no chunks but claims document source")
                 
                 # Rule 5: Check sentence_mapping consistency (skip for overviews)
                 # CRITICAL FIX: Don't zero out chunks if answer is good (4000-6000 chars)
@@ -3860,14 +4201,14 @@ class RAGService:
                             # Keep reasonable confidence, don't zero chunks
                             if confidence > 0.9:
                                 confidence = 0.75  # Reduce but keep reasonable
-                            print(f"[RAG] >50% external but substantial answer ({answer_length} chars) → marked as SYNTHESIS, kept chunks")
+                            logger.debug(">50%% external but substantial answer (%s chars) → marked as SYNTHESIS, kept chunks", answer_length)
                         else:
                             # Short answer with >50% external → likely fallback
                             answer_type = "FALLBACK"
                             chunk_indices = []
                             sentence_mapping = []
                             confidence = 0.0
-                            print(f"[RAG] >50% external sentences + short answer → forced fallback")
+                            logger.debug(">50% external sentences + short answer → forced fallback")
                 
                 # Map to full chunk info
                 chunks_used = []
@@ -3883,28 +4224,28 @@ class RAGService:
                 # CRITICAL FIX: Confidence-Chunks Paradox Detection
                 # Flag inconsistency: high confidence but no chunks
                 if confidence > 0.7 and len(chunk_indices) == 0 and answer_type not in ["FALLBACK", "TOO_BROAD", "SYNTHESIS"]:
-                    print(f"[RAG] ⚠️ PARADOX DETECTED: confidence={confidence:.2f} but chunks=0!")
-                    print(f"[RAG] Answer type: {answer_type}, Answer length: {len(answer)}")
+                    logger.warning("⚠️ PARADOX DETECTED: confidence=%.2f but chunks=0!", confidence)
+                    logger.debug("Answer type: %s, Answer length: %s", answer_type, len(answer))
                     # Auto-correct: if answer is substantial, mark as SYNTHESIS
                     if len(answer) >= 2000:
                         answer_type = "SYNTHESIS"
                         confidence = 0.75  # Reduce to reasonable level
-                        print(f"[RAG] Auto-corrected to SYNTHESIS with confidence={confidence:.2f}")
+                        logger.debug("Auto-corrected to SYNTHESIS with confidence=%.2f", confidence)
                     else:
                         # Short answer with high confidence but no chunks → suspicious
                         answer_type = "FALLBACK"
                         confidence = 0.0
-                        print(f"[RAG] Auto-corrected to FALLBACK (short answer with no chunks)")
+                        logger.debug("Auto-corrected to FALLBACK (short answer with no chunks)")
                 
-                print(f"[RAG] Answer type: {answer_type}, Confidence: {confidence:.2f}")
-                print(f"[RAG] Chunks: {chunk_indices}, Sentences mapped: {len(sentence_mapping)}")
+                logger.debug("Answer type: %s, Confidence: %.2f", answer_type, confidence)
+                logger.debug("Chunks: %s, Sentences mapped: %s", chunk_indices, len(sentence_mapping))
                 
                 return answer, chunks_used, answer_type, confidence, sentence_mapping
                 
         except Exception as e:
-            print(f"[RAG] Error calling Gemini API: {e}")
+            logger.error("Error calling Gemini API: %s", e)
             import traceback
-            print(f"[RAG] Traceback: {traceback.format_exc()}")
+            logger.error("Traceback: %s", traceback.format_exc())
             return self._get_fallback_response()
 
         # Fallback for OpenAI or other providers
@@ -3968,7 +4309,7 @@ class RAGService:
                 
                 return answer, chunks_used, answer_type, confidence, sentence_mapping
             except Exception as e:
-                print(f"[RAG] OpenAI API call failed: {e}")
+                logger.error("OpenAI API call failed: %s", e)
                 return self._get_fallback_response()
         
         return self._get_fallback_response()
@@ -4127,6 +4468,10 @@ class RAGService:
                     page = chunk_metadata.get("page_number")
                     section = chunk_metadata.get("section")
                     heading = chunk_metadata.get("heading")
+                    if not section and not heading:
+                        node = find_section_for_chunk(doc.section_index or [], chunk_idx)
+                        if node:
+                            section = node["heading"]
                     
                     preview = content[:160] if content else None
                     
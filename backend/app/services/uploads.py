@@ -0,0 +1,153 @@
+"""Lưu file upload: đọc theo khối (async), giới hạn kích thước, tính sha256, lưu theo nội dung.
+
+File được ghi vào ``<upload_dir>/.tmp/<uuid>.part`` rồi đổi tên thành
+``<upload_dir>/<2 ký tự đầu hash>/<hash><ext>``. Hai upload cùng nội dung dùng
+chung 1 file và upload trùng tên không còn ghi đè nhau. Mỗi khối chỉ được đọc
+tiếp sau khi khối trước đã ghi xong (backpressure). Bộ nhớ dùng tối đa 1 khối
+mỗi upload. Việc ghi đĩa chạy trong thread nên không chặn event loop.
+
+File đã lưu không bao giờ bị xóa ngay trong request (upload khác cùng nội dung
+có thể đang parse file đó mà chưa có row ``documents``): sweeper xóa file không
+còn document nào trỏ tới sau thời gian chờ (``remove_unreferenced_uploads``).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import re
+import time
+import uuid
+from dataclasses import dataclass
+
+from fastapi import UploadFile
+
+from ..core.config import settings
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+TMP_DIRNAME = ".tmp"
+_CONTENT_FILE_RE = re.compile(r"^[0-9a-f]{64}(?:\.[A-Za-z0-9]+)?$")
+
+
+class UploadTooLargeError(Exception):
+    def __init__(self, max_bytes: int):
+        super().__init__(f"File vượt quá dung lượng cho phép ({max_bytes // (1024 * 1024)} MB)")
+        self.max_bytes = max_bytes
+
+
+@dataclass
+class StoredUpload:
+    path: str
+    size: int
+    content_hash: str
+
+
+def max_upload_bytes() -> int:
+    return settings.max_upload_size_mb * 1024 * 1024
+
+
+def max_batch_upload_bytes() -> int:
+    return settings.max_batch_upload_size_mb * 1024 * 1024
+
+
+def content_addressed_path(content_hash: str, filename: str) -> str:
+    ext = os.path.splitext(filename or "")[1].lower()
+    return os.path.join(settings.upload_dir, content_hash[:2], f"{content_hash}{ext}")
+
+
+def _finalize(tmp_path: str, final_path: str) -> None:
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    if os.path.exists(final_path):
+        # Cùng nội dung đã có trên đĩa → bỏ bản vừa ghi, làm mới mtime để
+        # sweeper không xóa file trong lúc upload này đang parse
+        os.remove(tmp_path)
+        os.utime(final_path)
+    else:
+        os.replace(tmp_path, final_path)
+
+
+async def save_upload(file: UploadFile, max_bytes: int | None = None) -> StoredUpload:
+    """Ghi ``file`` ra đĩa theo khối; quá ``max_bytes`` → UploadTooLargeError (file dở bị xóa)."""
+    limit = max_bytes if max_bytes is not None else max_upload_bytes()
+    tmp_dir = os.path.join(settings.upload_dir, TMP_DIRNAME)
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, f"{uuid.uuid4().hex}.part")
+
+    digest = hashlib.sha256()
+    size = 0
+    handle = await asyncio.to_thread(open, tmp_path, "wb")
+    try:
+        while True:
+            block = await file.read(UPLOAD_CHUNK_SIZE)
+            if not block:
+                break
+            size += len(block)
+            if size > limit:
+                raise UploadTooLargeError(limit)
+            digest.update(block)
+            await asyncio.to_thread(handle.write, block)
+        await asyncio.to_thread(handle.close)
+    except BaseException:
+        await asyncio.to_thread(handle.close)
+        await asyncio.to_thread(_remove_quietly, tmp_path)
+        raise
+
+    content_hash = digest.hexdigest()
+    final_path = content_addressed_path(content_hash, file.filename)
+    await asyncio.to_thread(_finalize, tmp_path, final_path)
+    return StoredUpload(path=final_path, size=size, content_hash=content_hash)
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_stale_partials(grace_seconds: float) -> int:
+    """Xóa file ``.part`` bị bỏ dở (server dừng giữa lúc upload)."""
+    tmp_dir = os.path.join(settings.upload_dir, TMP_DIRNAME)
+    if not os.path.isdir(tmp_dir):
+        return 0
+    cutoff = time.time() - grace_seconds
+    removed = 0
+    for name in os.listdir(tmp_dir):
+        path = os.path.join(tmp_dir, name)
+        if name.endswith(".part") and os.path.getmtime(path) < cutoff:
+            _remove_quietly(path)
+            removed += 1
+    return removed
+
+
+def is_content_addressed(path: str) -> bool:
+    """``path`` theo dạng ``<upload_dir>/<2 ký tự>/<sha256><ext>`` (file có thể dùng chung)."""
+    directory, name = os.path.split(os.path.normpath(path))
+    match = _CONTENT_FILE_RE.match(name)
+    return bool(match) and os.path.basename(directory) == name[:2]
+
+
+def remove_unreferenced_uploads(referenced: set[str], grace_seconds: float) -> int:
+    """Xóa file lưu theo nội dung không còn document nào trỏ tới (cũ hơn ``grace_seconds``)."""
+    root = settings.upload_dir
+    if not os.path.isdir(root):
+        return 0
+    referenced = {os.path.normpath(path) for path in referenced if path}
+    cutoff = time.time() - grace_seconds
+    removed = 0
+    for prefix in os.listdir(root):
+        directory = os.path.join(root, prefix)
+        if len(prefix) != 2 or not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not _CONTENT_FILE_RE.match(name) or os.path.normpath(path) in referenced:
+                continue
+            # File mới lưu / vừa được upload lại → có thể đang parse, chưa có document
+            if os.path.getmtime(path) > cutoff:
+                continue
+            _remove_quietly(path)
+            removed += 1
+    return removed
+